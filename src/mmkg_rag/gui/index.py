@@ -1,13 +1,13 @@
 import os
 import datetime
 from pathlib import Path
-import pickle
 import asyncio
 import gradio as gr
 import networkx as nx
 import plotly.graph_objects as go
 
 from ..index.pipe import process_files
+from ..retrieval.search import search_indexes
 
 
 from .helper import _DATABASE_DIR
@@ -42,6 +42,7 @@ def index_file_graph(
     llm_model: str | None = None,
     entity_labels: str = "",
     relation_labels: str = "",
+    single_call_images: bool = False,
 ):
     if base_url:
         os.environ["BASE_URL"] = base_url
@@ -74,9 +75,12 @@ def index_file_graph(
             overlap=overlap,
             entity_labels=entity_labels.split(","),
             relation_labels=relation_labels.split(","),
+            single_call_images=single_call_images,
         )
     )
 
+    # The retrieval swaps to the new version in the background
+    search_indexes.refresh(f"{_DATABASE_DIR}/{_CURRENT_DATABASE or 'default'}")
     result_log += f"\nIndexed {len(es)} entities and {len(rs)} relations\n"
     result_log += f"\nIndexed {len(imgs)} images and {len(irs)} image relations\n"
     yield result_log
@@ -93,22 +97,13 @@ def draw_interactive_graph(
     image_relations: list | None = None,  # Relation
 ):
     global _CURRENT_DATABASE
-    if not entities:
-        entities = pickle.load(
-            open(f"{_DATABASE_DIR}/{_CURRENT_DATABASE}/entities.pkl", "rb")
-        )
-    if not relations:
-        relations = pickle.load(
-            open(f"{_DATABASE_DIR}/{_CURRENT_DATABASE}/relations.pkl", "rb")
-        )
-    if not images:
-        images = pickle.load(
-            open(f"{_DATABASE_DIR}/{_CURRENT_DATABASE}/images.pkl", "rb")
-        )
-    if not image_relations:
-        image_relations = pickle.load(
-            open(f"{_DATABASE_DIR}/{_CURRENT_DATABASE}/image_relations.pkl", "rb")
-        )
+    if not (entities and relations and images and image_relations):
+        # The index shared with the retrieval tab
+        index = search_indexes.get(f"{_DATABASE_DIR}/{_CURRENT_DATABASE}")
+        entities = entities or list(index.entities)
+        relations = relations or list(index.relations)
+        images = images or index.images
+        image_relations = image_relations or list(index.image_relations)
 
     G = nx.Graph()
     for e in entities or []:
@@ -329,6 +324,11 @@ with gr.Blocks() as index:
                     placeholder="Expected relation labels, separated by comma",
                     label="Relation Labels",
                 )
+                single_call_images = gr.Checkbox(
+                    value=False,
+                    label="Single Call Images",
+                    info="Describe and link each image in one LLM call",
+                )
 
             with gr.Accordion(label="LLM Configs", open=False):
                 base_url = gr.Textbox(
@@ -364,6 +364,7 @@ with gr.Blocks() as index:
             llm_model,
             entity_labels,
             relation_labels,
+            single_call_images,
         ],
         outputs=[process_log],
     )
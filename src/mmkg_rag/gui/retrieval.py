@@ -11,7 +11,8 @@ import gradio as gr
 # from gradio_m3d_chatbot import m3d_chatbot
 from ..retrieval.classify import query_dismantle
 from ..retrieval.generate import generate_answer
-from ..utils import image_base64_url
+from ..retrieval.search import search_indexes
+from ..utils import cached_image_base64_url
 
 from .helper import _DATABASE_DIR
 
@@ -114,7 +115,7 @@ def process_history(history: list[dict]) -> list:
             return {"type": "text", "text": content}
         if isinstance(content, dict):
             if content.get("path", ""):
-                url = image_base64_url(content.get("path", ""))
+                url = cached_image_base64_url(content.get("path", ""))
             else:
                 raise ValueError(f"Unsupported image type: {content}")
             return {
@@ -147,9 +148,13 @@ def llm_chatbot(
     similarity_threshold: int = 20,
     max_images_num: int = 2,
     force_retrieval: bool = False,
+    image_context: str = "auto",
+    knowledge_graph: str | None = None,
 ):
     if not contain_image:
         max_images_num = 0
+    # Every session searches the database it selected
+    database = f"{_DATABASE_DIR}/{knowledge_graph}" if knowledge_graph else None
 
     history = history or []
 
@@ -171,6 +176,7 @@ def llm_chatbot(
             images=user_query_images,
             history=process_history(history),
             force_retrieval=force_retrieval,
+            database=database,
         )
     )
     if not query_res:
@@ -199,6 +205,9 @@ def llm_chatbot(
             max_num=max_entities_num,
             similarity_threshold=similarity_threshold,
             max_images_num=max_images_num,
+            image_context=image_context,
+            visual=query_res.get("visual", False),
+            database=database,
         )
     )
 
@@ -229,9 +238,8 @@ def list_all_knowledgws():
 
 def change_knowledge_graph(knowledge_graph: str):
     print(f"Change knowledge graph to {knowledge_graph}")
-    from ..retrieval.search import load_default_ers
-
-    load_default_ers(f"{_DATABASE_DIR}/" + knowledge_graph)
+    # Load it ahead of the first query, the chat passes the database itself
+    search_indexes.get(f"{_DATABASE_DIR}/" + knowledge_graph)
 
 
 def change_llm_model(llm_model: str):
@@ -292,6 +300,12 @@ with gr.Blocks(
                         label="Max Images",
                         info="The maximum number of images to be included in the answer",
                     )
+                    image_context = gr.Radio(
+                        ["auto", "pixels", "text"],
+                        value="auto",
+                        label="Image Context",
+                        info="text is faster, pixels is better for visual questions, auto sends pixels only for visual questions",
+                    )
 
         with gr.Column(scale=3):
             chatbot = gr.Chatbot(
@@ -337,6 +351,8 @@ with gr.Blocks(
             similarity_threshold,
             max_images_num,
             force_retrieval,
+            image_context,
+            kg_select,
         ],
         outputs=[msg, chatbot],
     )
@@ -8,7 +8,8 @@ import asyncio
 from rapidfuzz.fuzz import token_sort_ratio
 
 from ..types import Entity, Relation
-from ..utils import llm
+from ..utils import llm, md5
+from ..storage import JsonlCache, MemoryStorage
 
 from .parser import parse_merged_e, parse_merged_r
 from .prompts import PROMPTS
@@ -17,28 +18,33 @@ log = logging.getLogger("mgrag")
 
 
 async def deduplicate(
-    entities: list[Entity], relations: list[Relation]
+    entities: list[Entity],
+    relations: list[Relation],
+    cache: JsonlCache | None = None,
 ) -> tuple[list[Entity], list[Relation]]:
-    """Deduplicate entities and relations using parallel processing"""
+    """
+    Deduplicate entities and relations using parallel processing
+
+    Args:
+        entities (list[Entity]): The entities to deduplicate
+        relations (list[Relation]): The relations to deduplicate
+        cache (JsonlCache, optional): Past merge decisions, reused instead of asking the LLM again
+    """
 
     # Process all groups concurrently
-    entity_groups = group_by_name_alias_v2(entities, similarity=0.95)
-    merged_results = await asyncio.gather(
-        *[_merge_entity_group(g) for g in entity_groups]
-    )
+    entity_groups = await _merge_entity_groups(entities, cache)
     new_entities = []
-    # update relations with new entities
-    for eg, (merged, ne) in zip(entity_groups, merged_results):
-        if len(eg) == 1 or ne is None or not merged:
+    # old name -> merged name, applied to relations in a single pass
+    renames: dict[str, str] = {}
+    for eg, ne in entity_groups:
+        if ne is None:
             new_entities.extend(eg)
             continue
         new_entities.append(ne)
-        eg_names = [e.name for e in eg]
-        for r in relations:
-            if r.source in eg_names:
-                r.source = ne.name
-            if r.target in eg_names:
-                r.target = ne.name
+        renames.update({e.name: ne.name for e in eg})
+    for r in relations:
+        r.source = renames.get(r.source, r.source)
+        r.target = renames.get(r.target, r.target)
 
     # confirm every entity's aliases are not null
     for e in new_entities:
@@ -49,23 +55,127 @@ async def deduplicate(
         f"Deduplacated {len(entities)-len(new_entities)} entities in {len(entity_groups)} groups"
     )
 
-    # Group relations by overlapping entities
+    relation_groups = await _merge_relation_groups(relations, new_entities, cache)
+    new_relations = []
+    for rg, rs in relation_groups:
+        # Groups that failed to merge are dropped
+        if rs is not None:
+            new_relations.extend(rs)
+    log.info(
+        f"Deduplacated {len(relations)-len(new_relations)} relations in {len(relation_groups)} groups"
+    )
+    return new_entities, new_relations
+
+
+async def deduplicate_storage(
+    storage: MemoryStorage, cache: JsonlCache | None = None
+) -> tuple[int, int]:
+    """
+    Deduplicate the entities and relations of a storage in place.
+    Merges go through `MemoryStorage.deduplicate`, so the ids and names of merged
+    entities are redirected and their relations, image relations included, move to
+    the merged entity. Only the relations of merged groups are replaced.
+
+    Returns:
+        tuple[int, int]: The number of entities and relations removed
+    """
+    num_entities, num_relations = len(storage.entities), len(storage.relations)
+    entity_groups = await _merge_entity_groups(storage.entities, cache)
+    for eg, ne in entity_groups:
+        if ne is not None:
+            storage.deduplicate(eg, ne)
+    # confirm every entity's aliases are not null
+    unset = [e for e in storage.entities if e.aliases is None]
+    for e in unset:
+        e.aliases = []
+    storage.mark_changed(unset)
+    log.info(
+        f"Deduplacated {num_entities-len(storage.entities)} entities in {len(entity_groups)} groups"
+    )
+
+    relation_groups = await _merge_relation_groups(
+        storage.relations, storage.entities, cache
+    )
+    for rg, rs in relation_groups:
+        # Groups that failed are kept
+        if rs is not None and rs is not rg:
+            storage.remove_relations(rg)
+            storage.add_relations(rs)
+    log.info(
+        f"Deduplacated {num_relations-len(storage.relations)} relations in {len(relation_groups)} groups"
+    )
+    return num_entities - len(storage.entities), num_relations - len(storage.relations)
+
+
+async def _merge_entity_groups(
+    entities: list[Entity], cache: JsonlCache | None = None
+) -> list[tuple[list[Entity], Entity | None]]:
+    """Groups of similar entities, with their merged entity or None if not merged"""
+    entity_groups = group_by_name_alias_v2(entities, similarity=0.95)
+    merged_results = await asyncio.gather(
+        *[_merge_entity_group(g, cache) for g in entity_groups]
+    )
+    groups: list[tuple[list[Entity], Entity | None]] = []
+    for eg, (merged, ne) in zip(entity_groups, merged_results):
+        if len(eg) == 1 or ne is None or not merged:
+            groups.append((eg, None))
+            continue
+        # Keep the provenance of the merged entities
+        ne.chunks = _union([e.chunks for e in eg])
+        ne.images = _union([e.images for e in eg]) or None
+        groups.append((eg, ne))
+    return groups
+
+
+async def _merge_relation_groups(
+    relations: list[Relation],
+    entities: list[Entity],
+    cache: JsonlCache | None = None,
+) -> list[tuple[list[Relation], list[Relation] | None]]:
+    """
+    Groups of relations between the same entities, with their merged relations,
+    the group itself if not merged, or None if merging failed
+    """
     relation_groups = group_relations(relations)
-    new_relations = await asyncio.gather(
-        *[_merge_relation_group(g, new_entities) for g in relation_groups],
+    merged_relations = await asyncio.gather(
+        *[_merge_relation_group(g, entities, cache) for g in relation_groups],
         return_exceptions=True,
     )
+    groups: list[tuple[list[Relation], list[Relation] | None]] = []
+    for rg, rs in zip(relation_groups, merged_relations):
+        if not isinstance(rs, list):
+            groups.append((rg, None))
+            continue
+        if rs is not rg:
+            group_chunks = _union([r.chunks for r in rg])
+            for r in rs:
+                r.chunks = group_chunks
+        groups.append((rg, rs))
+    return groups
 
-    # Filter out None results and return
-    new_relations = [rs for rs in new_relations if isinstance(rs, list)]
-    new_relations = [r for rs in new_relations for r in rs]
-    log.info(
-        f"Deduplacated {len(relations)-len(new_relations)} relations in {len(relation_groups)} groups"
+
+def _union(lists: list[list | None]) -> list:
+    """Ordered union of optional lists"""
+    return list(dict.fromkeys(x for items in lists for x in items or []))
+
+
+def _entity_group_key(entities: list[Entity]) -> str:
+    """Canonical signature of an entity group: sorted names, labels and description hashes"""
+    members = sorted((e.name, e.label, md5(e.description)) for e in entities)
+    return "e:" + md5(json.dumps(members, ensure_ascii=False))
+
+
+def _relation_group_key(relations: list[Relation]) -> str:
+    """Canonical signature of a relation group: sorted endpoints, labels and description hashes"""
+    members = sorted(
+        (r.source, r.label, r.target, md5(r.description or "")) for r in relations
     )
-    return new_entities, new_relations
+    return "r:" + md5(json.dumps(members, ensure_ascii=False))
 
 
-async def _merge_entity_group(entities: list[Entity]) -> tuple[bool, Entity | None]:
+async def _merge_entity_group(
+    entities: list[Entity], cache: JsonlCache | None = None
+) -> tuple[bool, Entity | None]:
     """
     deduplicate similar entities
     return only one entity if merged
@@ -79,6 +189,14 @@ async def _merge_entity_group(entities: list[Entity]) -> tuple[bool, Entity | No
     if not entities or len(entities) == 1:
         return False, None
 
+    key = _entity_group_key(entities)
+    if cache is not None and key in cache:
+        cached = cache.get(key)
+        log.debug(f"Reuse merge decision for entities: {[e.name for e in entities]}")
+        if not cached:
+            return False, None
+        return True, Entity.model_validate(cached)
+
     res = await llm.chat(
         PROMPTS["DEDUPLICATE"].format(entities=ents_str(entities)),
         system_prompt=PROMPTS["DEDUPLICATE_SYSTEM"],
@@ -89,18 +207,25 @@ async def _merge_entity_group(entities: list[Entity]) -> tuple[bool, Entity | No
         log.debug(
             f"No merged entity. entities:\n{ents_str(entities,indent=2)}\nres: \n{res}\n"
         )
-        return merged, merged_entity
+        # Only a "not the same" answer is kept, failures are asked again
+        if cache is not None and merged is False:
+            cache.set(key, None)
+        return False, None
 
     assert merged_entity is not None
     log.debug(
         f"Deduplicate entities: \n{ents_str(entities)}\n===\n{ents_str([merged_entity],indent=2)}"
     )
+    if cache is not None:
+        cache.set(key, merged_entity.model_dump(exclude_none=True))
 
     return merged, merged_entity
 
 
 async def _merge_relation_group(
-    relations: list[Relation], related_entities: list[Entity]
+    relations: list[Relation],
+    related_entities: list[Entity],
+    cache: JsonlCache | None = None,
 ) -> list[Relation]:
     """
     deduplicate similar relations
@@ -111,6 +236,15 @@ async def _merge_relation_group(
 
     if not relations or len(relations) == 1:
         return relations
+
+    key = _relation_group_key(relations)
+    if cache is not None and key in cache:
+        cached = cache.get(key)
+        log.debug(f"Reuse merge decision for relations: \n{rels_str(relations)}")
+        if not cached:
+            return relations
+        return [Relation.model_validate(r) for r in cached]
+
     res = await llm.chat(
         PROMPTS["DEDUPLICATE_RELATION"].format(
             entities="\n".join(["-" + e.origin_str() for e in related_entities]),
@@ -124,6 +258,8 @@ async def _merge_relation_group(
             log.debug(
                 f"No merged relations found. Relation group: \n{rels_str(relations)}\nres: \n{res}\n"
             )
+            if cache is not None and merged is False:
+                cache.set(key, None)
             return relations
     except Exception as e:
         log.error(
@@ -134,6 +270,8 @@ async def _merge_relation_group(
     log.debug(
         f"Deduplicate relations: \n{rels_str(relations)}\n===\n{rels_str(merged_relations)}"
     )
+    if cache is not None:
+        cache.set(key, [r.model_dump(exclude_none=True) for r in merged_relations])
 
     return merged_relations
 
@@ -2,24 +2,60 @@
 MultiModal Indexing: Image, Table, and ...
 """
 
+import os
 import base64
 import logging
 import re
 from pathlib import Path
-from functools import lru_cache
-from rapidfuzz.fuzz import token_sort_ratio
 import asyncio
-from ..utils import llm, encode_image, image_base64_url
-from ..types import Entity, Relation, Image
-from .parser import parse_image_description, parse_json_list
+import numpy as np
+from rapidfuzz.fuzz import token_sort_ratio
+from rapidfuzz.process import cdist
+from ..utils import llm, encode_image, image_base64_url, md5, md5_file, async_cache
+from ..types import Chunk, Entity, Relation, Image
+from ..storage import JsonlCache, ImageHashIndex
+from ..utils.image import dhash, low_detail
+from .parser import (
+    parse_image_description,
+    parse_image_description_links,
+    parse_json_list,
+)
 from .prompts import PROMPTS
 
 
 log = logging.getLogger("mgrag")
 
+_DESCRIPTION_CACHES: dict[str, JsonlCache] = {}
+
+
+def _description_cache(cache_dir: str | None = None) -> JsonlCache:
+    """
+    The on-disk image description cache, shared by the databases next to each other.
+    MMKG_CACHE_DIR overrides the folder, ./cache without either.
+    """
+    cache_dir = os.environ.get("MMKG_CACHE_DIR") or cache_dir or "cache"
+    path = os.path.join(cache_dir, "image_descriptions.jsonl")
+    if path not in _DESCRIPTION_CACHES:
+        _DESCRIPTION_CACHES[path] = JsonlCache(path)
+    return _DESCRIPTION_CACHES[path]
+
+
+def _description_key(path: str, context: str) -> str | None:
+    """Cache key of an image description: image content, context and model"""
+    if not Path(path).exists():
+        return None
+    model = os.environ.get("LLM_MODEL") or "gpt-4o-mini"
+    return f"{md5_file(path)}:{md5(context)}:{model}"
+
 
 async def mmodal_index(
-    text: str, entities: list[Entity], root_path: str | None = None
+    text: str,
+    entities: list[Entity],
+    root_path: str | None = None,
+    chunks: list[Chunk] | None = None,
+    single_call: bool = False,
+    image_index: ImageHashIndex | None = None,
+    cache_dir: str | None = None,
 ) -> tuple[list[Relation], list[Image]]:
     """
     Index images in text
@@ -28,6 +64,13 @@ async def mmodal_index(
         text (str): The text to index
         entities (list[Entity]): The entities to link to the images
         root_path (str, optional): The root path of the images. Defaults to None.
+        chunks (list[Chunk], optional): The chunks of the text, entities extracted from
+            the chunk of an image and its neighbours are preferred as link candidates.
+        single_call (bool, optional): Describe and link each image in one LLM call,
+            with candidates preselected from the image context. Defaults to False.
+        image_index (ImageHashIndex, optional): The already indexed images, near-duplicates
+            are linked to the indexed image instead of being described again.
+        cache_dir (str, optional): The folder of the image description cache.
 
     Returns:
         list[Relation]: The image-entity relations
@@ -39,44 +82,137 @@ async def mmodal_index(
 
     # Confirm images exist
     confirmed_images = []
+    image_links: dict[str, str] = {}  # image path -> link in the text
     for path, context in images:
         if root_path:
             image_path = Path(root_path) / path
         else:
             image_path = Path(path)
 
+        if str(image_path) in image_links:
+            continue
         if not image_path.exists():
             log.warning(f"Image not found at {image_path}")
         elif image_path.suffix[1:] not in ["jpg", "jpeg", "png", "gif", "webp"]:
             log.warning(f"Unsupported image format at {path}")
         else:
             confirmed_images.append((str(image_path), context))
-
-    # Describe images
-    log.info("Create image descriptions...")
-    img_desc_tasks = [
-        image_description(path, context) for path, context in confirmed_images
-    ]
-    img_descs = await asyncio.gather(*img_desc_tasks)
-    img_descs = [img for img in img_descs if img]
-    log.info(f"Processed {len(img_descs)} images.")
-
-    # Link images to entities
+            image_links[str(image_path)] = path
+
+    entity_terms = _EntityTerms(entities)
+    locality = _ChunkLocality(chunks or [], entities)
+
+    # Near-duplicates of indexed images, or of earlier images of this text
+    duplicates = _find_duplicate_images(confirmed_images, image_index)
+    unique_images = [(p, c) for p, c in confirmed_images if p not in duplicates]
+    if duplicates:
+        log.info(f"Found {len(duplicates)} duplicate images, skip describing them")
+
+    if single_call:
+        log.info("Describe images and link them to entities...")
+        results = await asyncio.gather(
+            *[
+                describe_and_link_image(
+                    path,
+                    context,
+                    _select_candidates(
+                        Image(path=path, caption=context, description=""),
+                        locality.candidates(image_links[path]),
+                        entities,
+                        entity_terms,
+                    ),
+                    cache_dir,
+                )
+                for path, context in unique_images
+            ]
+        )
+        img_descs = [img for img, _ in results if img]
+        relations = [
+            locality.with_chunks(rel, image_links[path])
+            for (path, _), (_, rels) in zip(unique_images, results)
+            for rel in rels
+        ]
+        log.info(f"Processed {len(img_descs)} images.")
+    else:
+        # Describe images
+        log.info("Create image descriptions...")
+        img_desc_tasks = [
+            image_description(path, context, cache_dir)
+            for path, context in unique_images
+        ]
+        img_descs = await asyncio.gather(*img_desc_tasks)
+        img_descs = [img for img in img_descs if img]
+        log.info(f"Processed {len(img_descs)} images.")
+        relations = []
+
+    for img in img_descs:
+        img.chunks = locality.chunks(image_links[img.path])
+
+    # Link images to entities, duplicates are linked to the image they duplicate
     log.info(f"Linking images to entities...")
-    image_entities = [
-        (img, _search_related_entities(entities, img)) for img in img_descs
-    ]
+    described = {img.path: img for img in img_descs}
+    known = image_index.images if image_index else {}
+    image_entities = [] if single_call else [(img.path, img) for img in img_descs]
+    for path, original in duplicates.items():
+        image = described.get(original) or known.get(original)
+        if image:
+            image_entities.append((path, image))
     link_tasks = [
-        link_image_to_entities(related_entities[: min(8, len(related_entities))], image)
-        for image, related_entities in image_entities
+        link_image_to_entities(
+            _select_candidates(
+                image,
+                locality.candidates(image_links[path]),
+                entities,
+                entity_terms,
+            ),
+            image,
+        )
+        for path, image in image_entities
     ]
-    # Flatten results
-    relations = [rels for rels in await asyncio.gather(*link_tasks) if rels]
-    relations = [rel for rels in relations for rel in rels if rel]
+    # Flatten results, relations of a duplicate keep the chunks of the duplicate
+    link_relations = await asyncio.gather(*link_tasks)
+    relations.extend(
+        [
+            locality.with_chunks(rel, image_links[path])
+            for (path, _), rels in zip(image_entities, link_relations)
+            for rel in rels or []
+            if rel
+        ]
+    )
 
     return relations, img_descs
 
 
+def _find_duplicate_images(
+    images: list[tuple[str, str]], image_index: ImageHashIndex | None
+) -> dict[str, str]:
+    """
+    Find near-duplicate images by perceptual hash
+
+    Returns:
+        dict[str, str]: image path -> path of the indexed or earlier image it duplicates
+    """
+    duplicates: dict[str, str] = {}
+    new_index = ImageHashIndex()
+    for path, _ in images:
+        value = dhash(path)
+        # Blank and low-contrast images are described on their own
+        if value is None or low_detail(value):
+            continue
+        # An image indexed before under the same path also counts as a duplicate
+        matches = [
+            (image, distance)
+            for index in ([image_index] if image_index else []) + [new_index]
+            for image, distance in index.find(value)
+            if not low_detail(index.hashes[image.path])
+        ]
+        if matches:
+            duplicates[path] = matches[0][0].path
+        else:
+            new_index.add(Image(path=path, caption="", description=""), value)
+    return duplicates
+
+
 def extract_images(text: str) -> list[tuple[str, str]]:
     """
     Extract images from text
@@ -120,15 +256,17 @@ def extract_images(text: str) -> list[tuple[str, str]]:
     return images
 
 
-@lru_cache()
-async def image_description(path: str, context: str) -> Image | None:
+async def image_description(
+    path: str, context: str, cache_dir: str | None = None
+) -> Image | None:
     """
-    Describe image by LLM
+    Describe image by LLM, the descriptions are cached on disk
+    by image content, context and model
 
     Args:
         path (str): The path of the image
         context (str): The context of the image
-        root_path (str, optional): The root path of the image. Defaults to None.
+        cache_dir (str, optional): The folder of the description cache
     Returns:
         Image: The described image
     """
@@ -136,6 +274,26 @@ async def image_description(path: str, context: str) -> Image | None:
     if not Path(path).exists():
         log.error(f"Image not found at {path}")
         return None
+
+    image = await _describe_image(
+        path, context, _description_key(path, context), cache_dir
+    )
+    # Cached images are shared, the caller gets its own copy
+    return image.model_copy(deep=True) if image else None
+
+
+@async_cache(
+    key=lambda path, context, cache_key, cache_dir: cache_key and (path, cache_key)
+)
+async def _describe_image(
+    path: str, context: str, cache_key: str | None, cache_dir: str | None
+) -> Image | None:
+    """Describe an image, once per path and cache key"""
+    cache = _description_cache(cache_dir)
+    cached = cache.get(cache_key) if cache_key else None
+    if cached:
+        log.debug(f"Reuse cached description for image {path}")
+        return Image(path=path, **cached)
     # Describe image
     messages = [
         {"role": "system", "content": PROMPTS["DESCRIBE_IMAGE_SYSTEM"]},
@@ -155,80 +313,194 @@ async def image_description(path: str, context: str) -> Image | None:
     ]
     description = await llm.chat_msg_sync(messages)
     caption, text_snippets, description = parse_image_description(description)
-    return Image(
+    image = Image(
         path=path, caption=caption, texts=text_snippets, description=description
     )
+    # Failed parses are not cached so that the next run retries
+    if cache_key and (caption or description):
+        cache.set(cache_key, image.model_dump(include={"caption", "description", "texts"}))
+    return image
+
+
+class _EntityTerms:
+    """
+    Upper-cased names and aliases of all entities, flattened once and shared by all images.
+    The terms of entity i are terms[offsets[i]:offsets[i + 1]].
+    """
+
+    def __init__(self, entities: list["Entity"]):
+        self.entities = entities
+        self.terms: list[str] = []
+        counts = []
+        for e in entities:
+            names = [e.name] + (e.aliases or [])
+            self.terms.extend(n.upper() for n in names)
+            counts.append(len(names))
+        self.counts = np.array(counts, dtype=np.float64)
+        self.offsets = np.concatenate(([0], np.cumsum(counts, dtype=np.int64)))
 
 
-def _search_related_entities(entities: list["Entity"], image: Image) -> list["Entity"]:
+class _ChunkLocality:
     """
-    Search for related entities to the image and sort by relevance
+    Entities of the chunks containing an image and of the neighbouring chunks
+    """
+
+    def __init__(self, chunks: list[Chunk], entities: list["Entity"]):
+        self.chunk_ids = [c.id for c in chunks]
+        self.positions = {c: i for i, c in enumerate(self.chunk_ids)}
+        self.image_chunks: dict[str, list[int]] = {}
+        for c in chunks:
+            for link in c.images or []:
+                self.image_chunks.setdefault(link, []).append(c.id)
+
+        self.chunk_entities: dict[int, list[Entity]] = {}
+        for e in entities:
+            for chunk_id in e.chunks or []:
+                self.chunk_entities.setdefault(chunk_id, []).append(e)
+
+    def chunks(self, link: str) -> list[int] | None:
+        """The chunks containing an image, its provenance"""
+        return list(self.image_chunks.get(link, [])) or None
+
+    def with_chunks(self, relation: Relation, link: str) -> Relation:
+        """Set the chunks containing the image as the provenance of its relation"""
+        relation.chunks = self.chunks(link)
+        return relation
+
+    def candidates(self, link: str) -> list["Entity"]:
+        """Entities of the image chunks first, then of the neighbouring chunks"""
+        own = [self.positions[c] for c in self.image_chunks.get(link, [])]
+        neighbours = [
+            p + d for p in own for d in (-1, 1) if 0 <= p + d < len(self.chunk_ids)
+        ]
+        candidates: dict[int, Entity] = {}
+        for p in own + neighbours:
+            for e in self.chunk_entities.get(self.chunk_ids[p], []):
+                candidates.setdefault(id(e), e)
+        return list(candidates.values())
+
+
+def _select_candidates(
+    image: Image,
+    local_entities: list["Entity"],
+    entities: list["Entity"],
+    terms: "_EntityTerms",
+    top_k: int = 8,
+) -> list["Entity"]:
+    """
+    Select link candidates for an image, chunk-local entities first.
+    Fuzzy search over all entities only fills up the remaining places.
+    """
+    selected = (
+        _search_related_entities(local_entities, image, top_k, min_relevance=0.0)
+        or local_entities[:top_k]
+    )
+    if len(selected) >= top_k:
+        return selected
+
+    picked = {id(e) for e in selected}
+    for e in _search_related_entities(entities, image, top_k + len(selected), terms):
+        if len(selected) >= top_k:
+            break
+        if id(e) not in picked:
+            selected.append(e)
+    return selected
+
+
+def _search_related_entities(
+    entities: list["Entity"],
+    image: Image,
+    top_k: int | None = None,
+    terms: _EntityTerms | None = None,
+    min_relevance: float = 0.1,
+) -> list["Entity"]:
+    """
+    Search for related entities to the image and sort by relevance.
+    All entity terms are scored against the caption and text snippets in one similarity matrix.
 
     Args:
         entities (list[Entity]): The entities to search for
         image (Image): The image to search in
+        top_k (int, optional): Only return the top k entities. Defaults to None (all).
+        terms (_EntityTerms, optional): Prepared terms of the entities, reused across images
+        min_relevance (float, optional): The minimum relevance score. Defaults to 0.1.
 
     Returns:
         list[Entity]: The related entities sorted by relevance score
     """
+    if not image.texts and not image.caption:
+        return []
+    if terms is None or terms.entities is not entities:
+        terms = _EntityTerms(entities)
+    if not terms.terms:
+        return []
 
-    @lru_cache(maxsize=None)
-    def compute_similarity(s1: str, s2: str) -> float:
-        return token_sort_ratio(s1.upper(), s2.upper()) / 100.0
-
-    def compute_avg_similarity(list1: list[str], list2: list[str]) -> float:
-        """
-        Calculate average similarity between two lists of strings
-        """
-        if not list1 or not list2:
-            return 0.0
-
-        similarities = [compute_similarity(s1, s2) for s1 in list1 for s2 in list2]
-        return sum(similarities) / len(similarities)
-
-    def compute_entity_relevance(entity: Entity) -> float:
-        """
-        Calculate entity's relevance score to the image
-        """
-        entity_terms = [entity.name] + (entity.aliases or [])
-
-        # Calculate similarity with image texts
-        text_similarity = (
-            compute_avg_similarity(entity_terms, image.texts or [])
-            if image.texts
-            else 0.0
-        )
-
-        # Calculate similarity with image caption
-        caption_similarity = (
-            compute_avg_similarity(entity_terms, [image.caption])
-            if image.caption
-            else 0.0
+    # Column 0 is the caption, the other columns are the text snippets
+    queries = [(image.caption or "").upper()] + [t.upper() for t in image.texts or []]
+    matrix = cdist(
+        terms.terms,
+        queries,
+        scorer=token_sort_ratio,
+        dtype=np.float64,
+        workers=-1,
+    )
+    matrix /= 100.0
+
+    # Sum the rows of every entity, then average over its pairs
+    starts = terms.offsets[:-1]
+    caption_similarity = np.add.reduceat(matrix[:, 0], starts) / terms.counts
+    if image.texts:
+        text_sums = np.add.reduceat(matrix[:, 1:].sum(axis=1), starts)
+        text_similarity = text_sums / (terms.counts * len(image.texts))
+    else:
+        text_similarity = np.zeros(len(entities))
+    if not image.caption:
+        caption_similarity = np.zeros(len(entities))
+
+    # Weight caption similarity slightly higher than text similarity
+    scores = caption_similarity * 0.6 + text_similarity * 0.4
+
+    candidates = np.flatnonzero(scores >= min_relevance)
+    if top_k is not None and top_k < len(candidates):
+        # Partial selection of the k best, ties at the boundary keep the entity order
+        candidate_scores = scores[candidates]
+        kth = -np.partition(-candidate_scores, top_k - 1)[top_k - 1]
+        better = candidates[candidate_scores > kth]
+        ties = candidates[candidate_scores == kth][: top_k - len(better)]
+        candidates = np.sort(np.concatenate((better, ties)))
+    # Stable sort keeps the entity order for equal scores
+    order = candidates[np.argsort(-scores[candidates], kind="stable")]
+    return [entities[i] for i in order]
+
+
+def _entities_json_str(entities: list["Entity"]) -> str:
+    return (
+        "["
+        + ",\n".join(
+            [
+                e.model_dump_json(
+                    include={"name", "aliases", "description", "references"}
+                )
+                for e in entities
+            ]
         )
+        + "]"
+    )
 
-        # Weight caption similarity slightly higher than text similarity
-        score = caption_similarity * 0.6 + text_similarity * 0.4
-        return score
-
-    related_entities = []
-    if not image.texts and not image.caption:
-        return related_entities
-
-    # Calculate relevance scores for each entity
-    scored_entities = [
-        (entity, compute_entity_relevance(entity)) for entity in entities
-    ]
 
-    # Filter entities with minimum relevance and sort by score
-    MIN_RELEVANCE = 0.1
-    related_entities = [
-        entity
-        for entity, score in sorted(scored_entities, key=lambda x: x[1], reverse=True)
-        if score >= MIN_RELEVANCE
+def _image_link_relations(links: list[dict], image_path: str) -> list[Relation]:
+    """Create image relations from the parsed entity links"""
+    return [
+        Relation(
+            source=r["entity"],
+            target=image_path,
+            label="#image" + (r["label"] or ""),
+            references=r["references"],
+            description=r["description"],
+        )
+        for r in links
     ]
 
-    return related_entities
-
 
 async def link_image_to_entities(
     related_entities: list["Entity"], image: Image
@@ -244,11 +516,6 @@ async def link_image_to_entities(
         Relation: The image-entity relation
     """
 
-    def _entity_json_str(entity: Entity) -> str:
-        return entity.model_dump_json(
-            include={"name", "aliases", "description", "references"}
-        )
-
     def _image_json_str(image: Image) -> str:
         return image.model_dump_json(include={"caption", "description", "texts"})
 
@@ -265,9 +532,7 @@ async def link_image_to_entities(
                 {
                     "type": "text",
                     "text": PROMPTS["EI_LINK"].format(
-                        entities="["
-                        + ",\n".join([_entity_json_str(e) for e in related_entities])
-                        + "]",  # noqa
+                        entities=_entities_json_str(related_entities),
                         image=_image_json_str(image),
                     ),
                 },
@@ -288,16 +553,65 @@ async def link_image_to_entities(
     rels = parse_json_list(res, fields=["entity", "label", "references", "description"])
     if not rels:
         return []
-    entity_image_rels = []
-    for r in rels:
-        entity_image_rels.append(
-            Relation(
-                source=r["entity"],
-                target=image.path,
-                label="#image" + r["label"],
-                references=r["references"],
-                description=r["description"],
-            )
-        )
+    return _image_link_relations(rels, image.path)
+
+
+async def describe_and_link_image(
+    path: str,
+    context: str,
+    candidates: list["Entity"],
+    cache_dir: str | None = None,
+) -> tuple[Image | None, list[Relation]]:
+    """
+    Describe an image and link it to the candidate entities in one LLM call.
+    If the description is already cached, only the link call is made.
+
+    Args:
+        path (str): The path of the image
+        context (str): The context of the image
+        candidates (list[Entity]): The candidate entities to link
+        cache_dir (str, optional): The folder of the description cache
+
+    Returns:
+        tuple: The described image and the image-entity relations
+    """
+    if not Path(path).exists():
+        log.error(f"Image not found at {path}")
+        return None, []
+
+    cache = _description_cache(cache_dir)
+    cache_key = _description_key(path, context)
+    cached = cache.get(cache_key) if cache_key else None
+    if cached:
+        image = Image(path=path, **cached)
+        return image, await link_image_to_entities(candidates, image)
 
-    return entity_image_rels
+    messages = [
+        {"role": "system", "content": PROMPTS["DESCRIBE_LINK_IMAGE_SYSTEM"]},
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": PROMPTS["DESCRIBE_LINK_IMAGE"].format(
+                        context=context, entities=_entities_json_str(candidates)
+                    ),
+                },
+                {
+                    "type": "image_url",
+                    "image_url": {"url": f"{image_base64_url(path)}"},
+                },
+            ],
+        },
+    ]
+    res = await llm.chat_msg_sync(messages)
+    log.debug(
+        f'Describe and link image: entities:{",".join([e.name for e in candidates])}, image:{path}, \nLLM res:\n{res}'
+    )
+    caption, text_snippets, description, links = parse_image_description_links(res)
+    image = Image(
+        path=path, caption=caption, texts=text_snippets, description=description
+    )
+    if cache_key and (caption or description):
+        cache.set(cache_key, image.model_dump(include={"caption", "description", "texts"}))
+    return image, _image_link_relations(links, path)
@@ -172,15 +172,16 @@ def parse_alias(text: str) -> list[tuple[str, list[str]]]:
     return aliases
 
 
-def parse_merged_e(text: str) -> tuple[bool, Entity | None]:
+def parse_merged_e(text: str) -> tuple[bool | None, Entity | None]:
     """
     Parse merged entities from raw text, return if merged and merged entity
+    merged is None when no answer is found in the text
     """
     regex_pattern = r"\{.*\}"
     matches = re.finditer(regex_pattern, text, re.DOTALL)
     if not matches:
         log.warning("No JSON object found in text")
-        return False, None
+        return None, None
     for m_num, m in enumerate(matches, start=1):
         try:
             data = json.loads(m.group(0))
@@ -205,12 +206,13 @@ def parse_merged_e(text: str) -> tuple[bool, Entity | None]:
             log.warning(f"Unexpected error parsing merged entities: {e}")
             continue
 
-    return False, None
+    return None, None
 
 
-def parse_merged_r(text: str) -> tuple[bool, list["Relation"]]:
+def parse_merged_r(text: str) -> tuple[bool | None, list["Relation"]]:
     """
     Parse merged relations from raw text, if merged and merged relations
+    merged is None when no answer is found in the text
     """
     relations: list["Relation"] = []
     # Pattern to match <ENTITY_1, RELATIONSHIP, ENTITY_2, DESCRIPTION, REFERENCES>
@@ -218,12 +220,14 @@ def parse_merged_r(text: str) -> tuple[bool, list["Relation"]]:
     matches = re.finditer(regex_pattern, text, re.DOTALL)
     if not matches:
         log.warning("No JSON object found in text")
-        return False, []
+        return None, []
     for m_num, m in enumerate(matches, start=1):
         try:
             data = json.loads(m.group(0))
             if "same_relationship" in data:
-                if data["same_relationship"] and "relationship" in data:
+                if data["same_relationship"] and "relationship" not in data:
+                    log.warning("No 'relationship' key found in JSON")
+                elif data["same_relationship"]:
                     single_r: dict = data["relationship"]
                     relations.append(
                         Relation(
@@ -243,7 +247,7 @@ def parse_merged_r(text: str) -> tuple[bool, list["Relation"]]:
             continue
         except Exception as e:
             log.warning(f"Unexpected error parsing merged relations: {e}")
-    return True, relations
+    return (True if relations else None), relations
 
 
 def parse_image_description(text: str) -> tuple[str, list, str]:
@@ -281,6 +285,37 @@ def parse_image_description(text: str) -> tuple[str, list, str]:
         return "", [], ""
 
 
+def parse_image_description_links(text: str) -> tuple[str, list, str, list[dict]]:
+    """
+    Parse image caption, text_snippets, description and entity links from text
+
+    Args:
+        text (str): The text to parse, expected to be in JSON format
+
+    Returns:
+        tuple: (caption, text_snippets, description, links)
+    """
+    caption, text_snippets, description = parse_image_description(text)
+    try:
+        json_match = re.search(r"\{.*\}", text, re.DOTALL)
+        if not json_match:
+            return caption, text_snippets, description, []
+        links = json.loads(json_match.group(0)).get("links") or []
+        fields = ["entity", "label", "references", "description"]
+        links = [
+            {field: link.get(field, None) for field in fields}
+            for link in links
+            if isinstance(link, dict) and link.get("entity")
+        ]
+        return caption, text_snippets, description, links
+    except json.JSONDecodeError as e:
+        log.warning(f"Failed to parse JSON: {e}")
+        return caption, text_snippets, description, []
+    except Exception as e:
+        log.warning(f"Unexpected error parsing image links: {e}")
+        return caption, text_snippets, description, []
+
+
 def parse_json_list(text: str, fields: list[str] | None = None) -> list:
     """
     Parse a JSON list from text
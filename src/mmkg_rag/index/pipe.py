@@ -10,9 +10,9 @@ from langchain_text_splitters import MarkdownTextSplitter
 
 from ..types.chunk import Chunk
 from ..utils.helper import extract_image_links, pdf_2_md
-from ..storage import MemoryStorage
+from ..storage import MemoryStorage, JsonlCache, Neo4jSync, GraphSnapshot
 from .text import extract_er_from_chunk
-from .deduplicate import deduplicate
+from .deduplicate import deduplicate_storage
 from .mmodal import mmodal_index
 from .lables import get_default_lables
 
@@ -51,6 +51,7 @@ async def index_graph(
     output_path: str = "flink",  # database
     entity_labels: list[str] | None = None,
     relation_labels: list[str] | None = None,
+    single_call_images: bool = False,
 ) -> tuple:
     """
     Index the graph for a given file
@@ -60,6 +61,10 @@ async def index_graph(
 
     log.info(f"Indexing graph for {file_path}")
     chunks, text = split_text(file_path, chunk_size, overlap)
+    # Chunk ids are unique in the database, so entities keep their provenance
+    chunk_ids = storage.register_document(file_path, len(chunks))
+    for chunk, chunk_id in zip(chunks, chunk_ids):
+        chunk.id = chunk_id
     log.info(f"Indexing {len(chunks)} chunks ...")
 
     entities, relations = [], []
@@ -82,33 +87,66 @@ async def index_graph(
 
     log.info(f"Indexed {len(entities)} entities and {len(relations)} relations")
     log.info(f"Deduplicating ...")
-    entities, relations = await deduplicate(
-        entities + storage.entities, relations + storage.relations
-    )
+    # The new entities and relations get their ids, merges then go through the storage,
+    # which redirects the merged entities and moves their relations to the merged one
+    storage.add_entities(entities)
+    storage.add_relations(relations)
+    # Merge decisions are kept with the database and reused on re-ingest
+    dedup_cache = JsonlCache(os.path.join(storage.folder, "dedup_cache.jsonl"))
+    await deduplicate_storage(storage, dedup_cache)
+    entities, relations = storage.entities, storage.relations
 
     log.info(f"Final entities: {len(entities)}, relations: {len(relations)} for {file_path}")
 
     # Add image relations
     images_root_path = Path(file_path).parent
+    # Image descriptions are shared by the databases next to this one
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(storage.folder)), "cache")
     image_relations, images = await mmodal_index(
-        text, entities, images_root_path.as_posix()
+        text,
+        entities,
+        images_root_path.as_posix(),
+        chunks=chunks,
+        single_call=single_call_images,
+        image_index=storage.image_index,
+        cache_dir=cache_dir,
     )
     log.info(f"Indexed {len(image_relations)} image relations")
 
-    entities.sort(key=lambda e: e.name)
-    relations.sort(key=lambda r: r.source + r.target)
-    image_relations.sort(key=lambda r: r.source + r.target)
-
     # 更新storage
     log.info("Update memory storage ...")
-    storage.entities = entities
-    storage.relations = relations
     storage.add_images(images)
     storage.add_relations(image_relations, images=True)
 
+    _save(storage)
+    return entities, relations, images, image_relations
+
+
+def remove_document(file_path: str, output_path: str) -> dict[str, int]:
+    """
+    Remove an indexed document from a database, without indexing the others again
+
+    Args:
+        file_path (str): The path of the document, as it was indexed
+        output_path (str): The database folder
+    """
+    storage = MemoryStorage(folder=output_path)
+    indexed = file_path in storage.documents
+    removed = storage.remove_document(file_path)
+    if indexed:
+        _save(storage)
+    return removed
+
+
+def _save(storage: MemoryStorage):
     storage.save_to_folder()
     log.info("Saved to storage folder, %s", storage.folder)
-    return entities, relations, images, image_relations
+    # Retrieval workers map the graph snapshot instead of loading the storage
+    GraphSnapshot.publish(storage)
+    neo4j_sync = Neo4jSync.from_env(storage.folder)
+    if neo4j_sync:
+        # Export in the background, indexing does not wait for Neo4j
+        neo4j_sync.sync(storage, background=True)
 
 
 async def process_files(
@@ -118,6 +156,7 @@ async def process_files(
     overlap: int = 400,
     entity_labels: list[str] | None = None,
     relation_labels: list[str] | None = None,
+    single_call_images: bool = False,
 ) -> tuple:
     """
     Process a file and return the path to the markdown file
@@ -145,6 +184,7 @@ async def process_files(
                 overlap=overlap,
                 entity_labels=entity_labels,
                 relation_labels=relation_labels,
+                single_call_images=single_call_images,
             )
             entities.extend(es)
             relations.extend(rs)
@@ -159,6 +199,7 @@ async def process_files(
                 overlap=overlap,
                 entity_labels=entity_labels,
                 relation_labels=relation_labels,
+                single_call_images=single_call_images,
             )
             entities.extend(es)
             relations.extend(rs)
@@ -271,3 +271,37 @@ Related Entities:
 Image Description:
 {image}
 """
+
+PROMPTS[
+    "DESCRIBE_LINK_IMAGE_SYSTEM"
+] = """
+You are a data scientist working on image analysis and knowledge graphs. You will be given an image, the context in which it appears and a list of candidate entities. Your task is to describe the image in detail and link the related entities to it.
+
+The entity information includes the name of the entity, its aliases, description, and references.
+Entity Example:
+{"name":"<ENTITY NAME>","aliases":["",""],"description":"<ENTITY DESCRIPTION>","references":["Original Text Ref1","Original Text Ref2"]},
+{...}
+
+Your response should include the following four parts:
+- caption: analise the context text and provide the caption for the image if available else leave it empty.
+- text_snippets: snippets of text that appears inside the image.
+- description: provide a detailed description of the image based on the context provided.
+- links: the relationships between the image and the candidate entities that are related to it. Each relationship has the entity name, an appropriate relationship type, a relationship description, and corresponding references from entity references. Leave it empty if no entity is related.
+
+You should provide the information in JSON format.
+Output Example:
+{"caption":"Figure 1: The percentage of configurations that satisfy the SLA of all jobs among 1o0 random configurations.","text_snippets":["Percentage of feasible configs (%)","number of jobs","SLA"],"description":"A line graph showing the percentage of configurations that satisfy the SLA of all jobs. The x-axis represents the number of jobs, ranging from 1 to 8, and the y-axis shows the percentage of feasible configurations.","links":[{"entity":"<ENTITY1 NAME>","label":"<eg: SHOWS>","description":"eg: The graph shows the SLA of the jobs.","references":["eg: ref1","eg: ref2"]}]}
+"""
+
+PROMPTS[
+    "DESCRIBE_LINK_IMAGE"
+] = """
+Please process the following image under the given context and link the candidate entities to it:
+--------------------------------
+Image Context:
+```txt
+{context}
+```
+Candidate Entities:
+{entities}
+"""
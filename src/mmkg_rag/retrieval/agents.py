@@ -1,6 +1,6 @@
 # Retrieval ansers by Agents
 
-from ..utils import llm, image_base64_url
+from ..utils import llm, cached_image_base64_url
 
 from .classify import query_dismantle
 from .generate import generate_answer
@@ -20,7 +20,7 @@ async def _question_decomposition(
         {
             "type": "image_url",
             "image_url": {
-                "url": image_base64_url(image),
+                "url": cached_image_base64_url(image),
             },
         }
         for image in images
@@ -0,0 +1,315 @@
+"""
+Pluggable search backends for the retrieval.
+The memory backend searches the index of a database from `search.search_indexes`,
+the Neo4j backend runs the search as Cypher against a shared graph store.
+"""
+
+import os
+import re
+import time
+import asyncio
+import logging
+import weakref
+from typing import Any
+
+from ..storage import ImageHashIndex
+from ..storage.neo4j_sync import SCHEMA, database_name
+from ..types import Entity, Image, Relation
+from . import search
+
+log = logging.getLogger("mgrag")
+
+ErisResult = tuple[
+    list[Entity],
+    list[Relation],
+    list[Entity],
+    list[Image],
+    list[Entity],
+    list[Relation],
+]
+
+# Seed entities and keyword images by full text, expand them in the graph and
+# fetch the image relations of the reached images, all in one round trip.
+# Relations only join nodes of one database, so the seeds scope the expansion.
+_SEARCH_ERIS = """
+CALL {
+  CALL db.index.fulltext.queryNodes('entity_text', $query) YIELD node
+  WHERE node.database = $database
+  RETURN collect(node)[..$max_num] AS seeds
+}
+CALL {
+  CALL db.index.fulltext.queryNodes('image_text', $query) YIELD node
+  WHERE node.database = $database
+  RETURN collect(node)[..$max_num] AS keyword_images
+}
+WITH seeds, keyword_images,
+  reduce(acc = [], s IN seeds | acc + [(s)-[:RELATION*1..{hop}]-(n) | n])[..$max_nodes] AS reached
+WITH seeds, keyword_images,
+  reduce(acc = [], x IN seeds + reached |
+    CASE WHEN x:Entity AND NOT x IN acc THEN acc + x ELSE acc END) AS entities
+WITH seeds, keyword_images, entities,
+  reduce(acc = [], a IN entities | acc + [(a)-[r:RELATION]->(b:Entity) WHERE b IN entities |
+    {source: a.name, target: b.name, props: properties(r)}]) AS relations,
+  reduce(acc = [], e IN entities | acc + [(e)-[:RELATION]->(i:Image) | i]) AS linked_images
+WITH seeds, entities, relations,
+  reduce(acc = keyword_images, i IN linked_images |
+    CASE WHEN i IN acc THEN acc ELSE acc + i END) AS images
+WITH seeds, entities, relations, images,
+  reduce(acc = [], x IN reduce(ns = [], i IN images | ns + i + [(i)-[:RELATION*1..{hop}]-(n) | n]) |
+    CASE WHEN NOT x IN acc THEN acc + x ELSE acc END)[..$max_nodes] AS image_nodes
+RETURN seeds, entities, relations, images,
+  [x IN image_nodes WHERE x:Entity] AS image_entities,
+  reduce(acc = [], a IN [x IN image_nodes WHERE x:Entity] |
+    acc + [(a)-[r:RELATION]->(b:Image) WHERE b IN image_nodes |
+    {source: a.name, target: b.path, props: properties(r)}]) AS image_relations
+"""
+
+_IMAGES = "MATCH (i:Image {database: $database}) WHERE i.phash IS NOT NULL RETURN i"
+
+_IMAGE_RELATIONS = """
+MATCH (i:Image {database: $database, path: $path})
+WITH i, [i] + [(i)-[:RELATION*1..{hop}]-(n) | n] AS nodes
+RETURN [x IN nodes WHERE x:Entity] AS entities,
+  reduce(acc = [], a IN [x IN nodes WHERE x:Entity] |
+    acc + [(a)-[r:RELATION]->(b:Image) WHERE b IN nodes |
+    {source: a.name, target: b.path, props: properties(r)}]) AS relations
+"""
+
+_LUCENE_SPECIAL = re.compile(r'([+\-!(){}\[\]^"~*?:\\/]|&&|\|\|)')
+
+
+def _lucene_query(keywords: list[str]) -> str:
+    """Match any keyword, with Lucene operators escaped"""
+    terms = [_LUCENE_SPECIAL.sub(r"\\\1", k.strip()) for k in keywords if k.strip()]
+    return " OR ".join(f"({t})" for t in terms)
+
+
+def _entity(node: Any) -> Entity:
+    return Entity.model_validate(dict(node))
+
+
+def _image(node: Any) -> Image:
+    return Image.model_validate(dict(node))
+
+
+def _relation(row: dict) -> Relation:
+    return Relation.model_validate(
+        {**row["props"], "source": row["source"], "target": row["target"]}
+    )
+
+
+class MemoryBackend:
+    """
+    Search the index of a database, from the registry of the process.
+    Without a database, the index loaded by `load_default_ers` is searched.
+    """
+
+    async def search_eris(
+        self,
+        keywords: list[str],
+        max_num: int = 3,
+        max_images_num: int = 2,
+        similarity_threshold: float = 10,
+        hop: int = 1,
+        database: str | None = None,
+    ) -> ErisResult:
+        return search.get_search_index(database).search_eris(
+            keywords,
+            max_num=max_num,
+            max_images_num=max_images_num,
+            similarity_threshold=similarity_threshold,
+            hop=hop,
+        )
+
+    async def search_image_by_example(
+        self,
+        image_path: str,
+        max_distance: int = 5,
+        hop: int = 1,
+        database: str | None = None,
+    ) -> tuple[Image | None, list[Entity], list[Relation]]:
+        return search.get_search_index(database).search_image_by_example(
+            image_path, max_distance, hop
+        )
+
+
+class Neo4jBackend:
+    """
+    Search the graph in Neo4j, as written by `Neo4jSync`.
+    Keywords are looked up in full-text indexes instead of fuzzy matched,
+    so `similarity_threshold` is not used. The databases share the graph,
+    a search only reaches the nodes of its `database`, the default database
+    of the search without one.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        user: str | None,
+        password: str | None,
+        max_pool_size: int = 50,
+        max_nodes: int = 500,
+        image_refresh_interval: float = 60.0,
+    ):
+        self.url = url
+        self.auth = (user, password) if user else None
+        self.max_pool_size = max_pool_size
+        # Bound on the nodes reached by the expansion of hub entities
+        self.max_nodes = max_nodes
+        # Async drivers are bound to the event loop they are created in
+        self._drivers: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        # Image hashes per database, loaded again once older than the interval
+        self.image_refresh_interval = image_refresh_interval
+        self._image_indexes: dict[str, tuple[float, ImageHashIndex]] = {}
+
+    @classmethod
+    def from_env(cls) -> "Neo4jBackend":
+        url = os.environ.get("NEO4J_URI") or os.environ.get("NEO4J_URL")
+        if not url:
+            raise ValueError("NEO4J_URI is not set for the Neo4j search backend")
+        return cls(
+            url,
+            os.environ.get("NEO4J_USER") or os.environ.get("NEO4J_USERNAME"),
+            os.environ.get("NEO4J_PASSWORD"),
+            max_pool_size=int(os.environ.get("NEO4J_POOL_SIZE") or 50),
+            image_refresh_interval=float(
+                os.environ.get("NEO4J_IMAGE_REFRESH_SECONDS") or 60
+            ),
+        )
+
+    @staticmethod
+    def _database(database: str | None) -> str:
+        """The name of a database folder in the graph"""
+        return database_name(database or search._DEFAULT_FOLDER)
+
+    async def _driver(self):
+        from neo4j import AsyncGraphDatabase
+
+        loop = asyncio.get_running_loop()
+        driver = self._drivers.get(loop)
+        if driver is None:
+            driver = AsyncGraphDatabase.driver(
+                self.url, auth=self.auth, max_connection_pool_size=self.max_pool_size
+            )
+            # The indexes exist once a sync ran, make sure of it for empty graphs
+            for statement in SCHEMA:
+                await driver.execute_query(statement)
+            self._drivers[loop] = driver
+        return driver
+
+    async def close(self):
+        for driver in list(self._drivers.values()):
+            await driver.close()
+        self._drivers.clear()
+
+    async def search_eris(
+        self,
+        keywords: list[str],
+        max_num: int = 3,
+        max_images_num: int = 2,
+        similarity_threshold: float = 10,
+        hop: int = 1,
+        database: str | None = None,
+    ) -> ErisResult:
+        query = _lucene_query(keywords)
+        if not query:
+            return [], [], [], [], [], []
+        driver = await self._driver()
+        # Variable-length bounds can not be parameters
+        records, _, _ = await driver.execute_query(
+            _SEARCH_ERIS.replace("{hop}", str(max(int(hop), 1))),
+            query=query,
+            database=self._database(database),
+            max_num=max_num,
+            max_nodes=self.max_nodes,
+            routing_="r",
+        )
+        record = records[0]
+        entities = [_entity(n) for n in record["seeds"]]
+        related_entities = [
+            e for e in map(_entity, record["entities"]) if e not in entities
+        ]
+        image_entities = [
+            e
+            for e in map(_entity, record["image_entities"])
+            if e not in related_entities
+        ]
+        images = [_image(n) for n in record["images"]][:max_images_num]
+        log.info(
+            f"Neo4j search: {len(entities)} entities, {len(images)} images for keywords: {keywords}"
+        )
+        return (
+            entities,
+            [_relation(r) for r in record["relations"]],
+            related_entities,
+            images,
+            image_entities,
+            [_relation(r) for r in record["image_relations"]],
+        )
+
+    async def _image_index(self, database: str) -> ImageHashIndex:
+        """The hashes of the images of a database, syncs meanwhile show up on reload"""
+        loaded_at, index = self._image_indexes.get(database, (0.0, None))
+        age = time.monotonic() - loaded_at
+        if index is not None and age < self.image_refresh_interval:
+            return index
+        driver = await self._driver()
+        # Only the hashes of the images are kept in memory
+        records, _, _ = await driver.execute_query(
+            _IMAGES, database=database, routing_="r"
+        )
+        index = ImageHashIndex()
+        for record in records:
+            node = record["i"]
+            index.add(_image(node), int(node["phash"], 16))
+        self._image_indexes[database] = (time.monotonic(), index)
+        return index
+
+    async def search_image_by_example(
+        self,
+        image_path: str,
+        max_distance: int = 5,
+        hop: int = 1,
+        database: str | None = None,
+    ) -> tuple[Image | None, list[Entity], list[Relation]]:
+        driver = await self._driver()
+        name = self._database(database)
+        image = (await self._image_index(name)).find_image(image_path, max_distance)
+        if image is None:
+            return None, [], []
+        records, _, _ = await driver.execute_query(
+            _IMAGE_RELATIONS.replace("{hop}", str(max(int(hop), 1))),
+            database=name,
+            path=image.path,
+            routing_="r",
+        )
+        if not records:
+            return image, [], []
+        return (
+            image,
+            [_entity(n) for n in records[0]["entities"]],
+            [_relation(r) for r in records[0]["relations"]],
+        )
+
+
+_BACKEND: MemoryBackend | Neo4jBackend | None = None
+
+
+def set_search_backend(backend: MemoryBackend | Neo4jBackend | None):
+    """Use a search backend for the retrieval, None resets to the configured one"""
+    global _BACKEND
+    _BACKEND = backend
+
+
+def get_search_backend() -> MemoryBackend | Neo4jBackend:
+    """The search backend, `MMKG_SEARCH_BACKEND` selects memory (default) or neo4j"""
+    global _BACKEND
+    if _BACKEND is None:
+        name = (os.environ.get("MMKG_SEARCH_BACKEND") or "memory").lower()
+        if name == "neo4j":
+            _BACKEND = Neo4jBackend.from_env()
+        elif name == "memory":
+            _BACKEND = MemoryBackend()
+        else:
+            raise ValueError(f"Unsupported search backend {name}")
+    return _BACKEND
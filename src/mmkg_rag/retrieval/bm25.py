@@ -0,0 +1,70 @@
+"""
+Keyword lookup over the texts of a search index.
+`BM25Index` scores documents by the words they share with a query over the
+word `Postings` of the documents, only the postings of the query words are read.
+"""
+
+from typing import Iterable
+
+import numpy as np
+
+from ..storage.postings import Postings, tokenize
+
+
+class BM25Index:
+    """
+    Okapi BM25 over the word postings of documents, a document per item.
+    The postings hold the word counts and lengths of the documents, the weights
+    are computed for the words of a query, so postings updated by a save
+    are searched as they are.
+    """
+
+    def __init__(self, postings: Postings, k1: float = 1.5, b: float = 0.75):
+        self.postings = postings
+        self.k1 = k1
+        self.b = b
+        self.num_docs = len(postings)
+        lengths = np.asarray(postings.totals)
+        self.average = float(lengths.mean()) if lengths.any() else 1.0
+
+    @classmethod
+    def from_documents(
+        cls, documents: Iterable[str], k1: float = 1.5, b: float = 0.75
+    ) -> "BM25Index":
+        return cls(Postings.from_keys(tokenize(d) for d in documents), k1, b)
+
+    def __len__(self) -> int:
+        return self.num_docs
+
+    def nbytes(self) -> int:
+        return self.postings.nbytes()
+
+    def scores(self, queries: list[str]) -> tuple[np.ndarray, np.ndarray]:
+        """The documents sharing a word with the queries, in order, and their scores"""
+        words = {t for query in queries for t in tokenize(query)}
+        spans = [s for w in sorted(words) if (s := self.postings.span(w)) is not None]
+        spans = [s for s in spans if s.stop > s.start]
+        if not spans:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        postings = self.postings
+        docs = np.concatenate([postings.items[s] for s in spans]).astype(np.int64)
+        frequencies = np.concatenate([postings.counts[s] for s in spans]).astype(
+            np.float64
+        )
+        counts = np.array([s.stop - s.start for s in spans], dtype=np.float64)
+        idf = np.repeat(
+            np.log1p((self.num_docs - counts + 0.5) / (counts + 0.5)),
+            counts.astype(np.int64),
+        )
+        lengths = np.asarray(postings.totals)[docs].astype(np.float64)
+        norms = self.k1 * (1 - self.b + self.b * lengths / self.average)
+        weights = idf * frequencies * (self.k1 + 1) / (frequencies + norms)
+        docs, inverse = np.unique(docs, return_inverse=True)
+        return docs, np.bincount(inverse, weights=weights)
+
+    def top(self, queries: list[str], max_num: int) -> np.ndarray:
+        """The max_num best scored documents for the queries, in document order"""
+        docs, scores = self.scores(queries)
+        if len(docs) > max_num:
+            docs = np.sort(docs[np.argpartition(-scores, max_num - 1)[:max_num]])
+        return docs
@@ -6,9 +6,10 @@ import json
 import logging
 from pathlib import Path
 
-from ..utils import llm, encode_image, image_base64_url
+from ..utils import llm, encode_image, cached_image_base64_url
 
-from .parser import parse_classify_response
+from .parser import parse_classify_response, parse_visual_flag
+from .backend import get_search_backend
 from .prompts import PROMPTS
 
 log = logging.getLogger("mgrag")
@@ -19,6 +20,7 @@ async def query_dismantle(
     images: list[str] | None = None,
     history: list | None = None,
     force_retrieval: bool = False,
+    database: str | None = None,
 ):
     """
     Dismantle the query and generate solution by LLM
@@ -27,11 +29,13 @@ async def query_dismantle(
         query (str): The query to dismantle
         image (str, optional): The image to include in the query. Defaults to None.
         history (list, optional): The history of the conversation. Defaults to None.
+        database (str, optional): The database folder searched for indexed figures.
+            Defaults to the default search index.
 
     Returns:
         dict: The classification and
             - If direct: the response
-            - If retrieval: the keywords
+            - If retrieval: the keywords, and whether the query is visual
     """
     if not query and not images:
         return None
@@ -55,11 +59,24 @@ async def query_dismantle(
     }
     if images:
         for image in images:
+            # An indexed figure is described by its stored text instead of pixels
+            indexed, _, _ = await get_search_backend().search_image_by_example(
+                image, database=database
+            )
+            if indexed is not None:
+                user_message["content"].append(
+                    {
+                        "type": "text",
+                        "text": f"The attached image is the indexed figure {indexed.path}: "
+                        + f"{indexed.caption}, {indexed.description}",
+                    }
+                )
+                continue
             user_message["content"].append(
                 {
                     "type": "image_url",
                     "image_url": {
-                        "url": image_base64_url(image),
+                        "url": cached_image_base64_url(image),
                     },
                 }
             )
@@ -79,4 +96,8 @@ async def query_dismantle(
     if not isinstance(keywords_answer, list):
         keywords = [keywords_answer]
 
-    return {"classification": classification, "keywords": keywords}
+    return {
+        "classification": classification,
+        "keywords": keywords,
+        "visual": parse_visual_flag(response),
+    }
@@ -1,9 +1,9 @@
 #
 import logging
 
-from ..utils import llm, image_base64_url
+from ..utils import llm, cached_image_base64_url, image_cache_stats
 from ..types import Entity, Relation, Image
-from .search import search_eris
+from .backend import get_search_backend
 from .prompts import PROMPTS
 
 log = logging.getLogger("mgrag")
@@ -35,13 +35,19 @@ def generate_image_prompts(
     images: list[Image],
     image_relations: list[Relation],
     image_related_entities: list[Entity],
+    with_texts: bool = False,
 ) -> str:
-    images_str = "\n".join(
-        [f"- {i.path}, {i.caption}, {i.description}" for i in images]
-    )
-    images_str = (
-        f"Images: every image has a path, caption, and a description\n{images_str}\n"
-    )
+    if with_texts:
+        # Text-only context: the text snippets stand in for the pixels
+        images_str = "\n".join(
+            [f"- {i.path}, {i.caption}, {i.texts or []}, {i.description}" for i in images]
+        )
+        images_str = f"Images: every image has a path, caption, text snippets inside the image, and a description\n{images_str}\n"
+    else:
+        images_str = "\n".join(
+            [f"- {i.path}, {i.caption}, {i.description}" for i in images]
+        )
+        images_str = f"Images: every image has a path, caption, and a description\n{images_str}\n"
 
     images_entities_str = "\n".join(
         [f"- {e.name}, {e.aliases}, {e.description}" for e in image_related_entities]
@@ -72,14 +78,26 @@ async def generate_answer(
     max_images_num: int = 2,
     similarity_threshold: float = 55,
     hop: int = 1,
+    image_context: str = "pixels",
+    visual: bool = False,
+    database: str | None = None,
 ) -> dict:
     """
     Generate the answer by LLM
+
+    Args:
+        image_context (str, optional): How retrieved images are given to the LLM.
+            "pixels" attaches the images, "text" uses their indexed caption, text snippets
+            and description only, "auto" attaches the images only for visual queries.
+            Defaults to "pixels".
+        visual (bool, optional): Whether the query was classified as visual. Defaults to False.
+        database (str, optional): The database folder to search. Defaults to the default search index.
     """
 
     if not keywords or not query:
         raise ValueError("Keywords and query cannot be empty")
 
+    backend = get_search_backend()
     (
         entities,
         relations,
@@ -87,13 +105,32 @@ async def generate_answer(
         images,
         image_related_entities,
         image_relations,
-    ) = search_eris(
+    ) = await backend.search_eris(
         keywords,
         max_num=max_num,
         max_images_num=max_images_num,
         hop=hop,
         similarity_threshold=similarity_threshold,
+        database=database,
     )
+    # Query images that show indexed figures bring in their graph neighbourhood
+    matched: dict[str, str] = {}
+    for query_image in query_images or []:
+        image, image_entities, image_rels = await backend.search_image_by_example(
+            query_image, hop=hop, database=database
+        )
+        if image is None:
+            continue
+        matched[query_image] = image.path
+        if image.path in [i.path for i in images]:
+            continue
+        images.insert(0, image)
+        image_related_entities.extend(
+            e for e in image_entities if e not in image_related_entities
+        )
+        image_relations.extend(r for r in image_rels if r not in image_relations)
+    # The figures of the query images come first, the last keyword images make room
+    del images[max_images_num:]
     log.debug(
         f'Search results for keywords: {", ".join(keywords)}'
         + "\n"
@@ -114,8 +151,11 @@ async def generate_answer(
         "role": "user",
         "content": [{"type": "text", "text": knowledges}],
     }
+    if image_context not in ("pixels", "text", "auto"):
+        raise ValueError(f"Unsupported image context {image_context}")
+    attach_pixels = image_context == "pixels" or (image_context == "auto" and visual)
     images_knowledges = generate_image_prompts(
-        images, image_relations, image_related_entities
+        images, image_relations, image_related_entities, with_texts=not attach_pixels
     )
     user_images_content: list[dict] = [
         {
@@ -123,11 +163,11 @@ async def generate_answer(
             "text": images_knowledges,
         }
     ]
-    for image in images or []:
+    for image in images if attach_pixels else []:
         user_images_content.append(
             {
                 "type": "image_url",
-                "image_url": {"url": image_base64_url(image.path)},
+                "image_url": {"url": cached_image_base64_url(image.path)},
             }
         )
 
@@ -142,15 +182,20 @@ async def generate_answer(
             ],
         }
     )
+    shown = {i.path for i in images}
     for image in query_images or []:
+        if matched.get(image) in shown:
+            # Given as the indexed figure it shows
+            continue
         messages[-1]["content"].append(
             {
                 "type": "image_url",
                 "image_url": {
-                    "url": image_base64_url(image),
+                    "url": cached_image_base64_url(image),
                 },
             }
         )
+    log.debug(f"Image url cache: {image_cache_stats()}")
     res = await llm.chat_msg_sync(messages)
 
     return {
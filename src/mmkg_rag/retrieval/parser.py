@@ -41,6 +41,26 @@ def parse_classify_response(response: str) -> tuple[str, str | list[str]]:
     return "retrieval", []
 
 
+def parse_visual_flag(response: str) -> bool:
+    """
+    Parse whether the classified query needs the pixels of the figures
+
+    Args:
+        response (str): The classify response to parse
+
+    Returns:
+        bool: The "visual" flag, False if it is missing or can not be parsed
+    """
+    json_str = re.search(r"\{.*\}", response, re.DOTALL)
+    if not json_str:
+        return False
+    try:
+        return json.loads(json_str.group()).get("visual", False) is True
+    except Exception as e:
+        log.warning(f"Failed to parse visual flag: {e}")
+        return False
+
+
 def parse_agent_defines(text: str) -> list[dict]:
     """
     Parse the agent defines from the text
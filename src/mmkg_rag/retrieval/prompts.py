@@ -21,16 +21,21 @@ Step 2: Retrieval Keywords Extraction
 If the query requires external knowledge:
 - Extract essential keywords for retrieval from the query and output them in a JSON array with key "keywords"
 - For broad queries, include related concepts that could be relevant and output them in a JSON array with key "extended_keywords"
+- Set "visual" to true if answering requires looking at the figures themselves (e.g. reading values from a chart, comparing diagrams), otherwise false
 
 
 Examples:
 Input: "What is metrics of the Ablation Study?"
 Output: 
-{"classification":"retrieval","analysis":"The query requires external knowledge retrieval.","keywords":["metrics","ablation study"],"extended_keywords":["evaluation metrics","experimental setup","methodology"]}
+{"classification":"retrieval","analysis":"The query requires external knowledge retrieval.","keywords":["metrics","ablation study"],"extended_keywords":["evaluation metrics","experimental setup","methodology"],"visual":false}
 
 Input: "How was the experiment conducted in this paper?"
 Output: 
-{"classification":"retrieval","analysis":"The query requires external knowledge retrieval.","keywords":["experimental setup","methodology","dataset","metrics","baseline models","ablation study","implementation details"],"extended_keywords":["evaluation metrics","experimental design","data collection","evaluation methodology"]}
+{"classification":"retrieval","analysis":"The query requires external knowledge retrieval.","keywords":["experimental setup","methodology","dataset","metrics","baseline models","ablation study","implementation details"],"extended_keywords":["evaluation metrics","experimental design","data collection","evaluation methodology"],"visual":false}
+
+Input: "Which method has the highest accuracy in the results chart?"
+Output: 
+{"classification":"retrieval","analysis":"The query requires reading values from a figure.","keywords":["results","accuracy","chart"],"extended_keywords":["evaluation metrics","baseline models"],"visual":true}
 
 Note: Ensure the extracted keywords are:
 - Specific enough for meaningful retrieval
@@ -44,12 +49,12 @@ PROMPTS[
 ] = """
 You are performing a Retrieval-augmented generation (RAG) task. For each user query, please analyze and respond according to the following guidelines:
 
-The query requires external knowledge retrieval. Please extract essential keywords for retrieval from the query and output them in a JSON array with key "keywords". For broad queries, include related concepts that could be relevant and output them in a JSON array with key "extended_keywords". 
+The query requires external knowledge retrieval. Please extract essential keywords for retrieval from the query and output them in a JSON array with key "keywords". For broad queries, include related concepts that could be relevant and output them in a JSON array with key "extended_keywords". Set "visual" to true if answering requires looking at the figures themselves (e.g. reading values from a chart, comparing diagrams), otherwise false.
 
 Examples:
 Input: "How was the experiment conducted in this paper?"
 Output:
-{"classification":"retrieval","analysis":"The query requires external knowledge retrieval.","keywords":["experimental setup","methodology","dataset","metrics","baseline models","ablation study","implementation details"],"extended_keywords":["evaluation metrics","experimental design","data collection","evaluation methodology"]}
+{"classification":"retrieval","analysis":"The query requires external knowledge retrieval.","keywords":["experimental setup","methodology","dataset","metrics","baseline models","ablation study","implementation details"],"extended_keywords":["evaluation metrics","experimental design","data collection","evaluation methodology"],"visual":false}
 
 Note: Ensure the extracted keywords are:
 - Specific enough for meaningful retrieval
@@ -1,277 +1,667 @@
 """
 This module contains the search functionality for the retrieval system.
+A `SearchIndex` searches one database, `search_indexes` keeps the indexes
+of the recently used databases of the process, and updates them in the
+background when their database publishes a new version.
 """
 
+import os
+import sys
+import time
 import logging
+import threading
+from collections import OrderedDict
 from pathlib import Path
-from functools import lru_cache
-
-from typing import Callable, Any
+from typing import Iterable
 
+import numpy as np
+from rapidfuzz import process
 from rapidfuzz.fuzz import token_ratio
-import networkx as nx
 
-from ..storage import MemoryStorage
+from ..storage import ImageHashIndex
+from ..storage.graph_snapshot import (
+    IMAGE_RELATION,
+    RELATION,
+    GraphSnapshot,
+    storage_stamp,
+)
+from ..storage.postings import (
+    Postings,
+    entity_postings,
+    image_postings,
+    image_search_texts,
+    normalize,
+    text_postings,
+)
+from ..storage.records import EntityRecords, RelationRecords
 from ..types import Entity, Image, Relation
+from .bm25 import BM25Index
 
 log = logging.getLogger("mgrag")
 
-_Entity: list[Entity] = []
-_Relation: list[Relation] = []
-_Image: list[Image] = []
-_ImageRelation: list[Relation] = []
-_G: nx.Graph = nx.Graph()  # undirected graph
 
+# Threads of one scoring call, -1 for every core
+_SCORE_WORKERS = -1
+# Items found by keywords that are scored by similarity
+_CANDIDATES = 256
 
-def init_entities(entities: list[Entity] | None = None) -> None:
-    """Initialize the entity list"""
-    global _Entity
-    if entities is not None:
-        _Entity = entities
 
+def _top(scores: np.ndarray, max_num: int, threshold: float) -> list[int]:
+    """
+    The indexes of the max_num best scores at least the threshold, best first
+    and equal scores in index order, with a partial sort of the candidates
+    """
+    candidates = np.flatnonzero(scores >= threshold)
+    if len(candidates) > max_num:
+        kth = len(candidates) - max_num
+        bound = np.partition(scores[candidates], kth)[kth]
+        above = candidates[scores[candidates] > bound]
+        tied = candidates[scores[candidates] == bound][: max_num - len(above)]
+        candidates = np.concatenate([above, tied])
+    order = np.lexsort((candidates, -scores[candidates]))
+    return candidates[order].tolist()
+
+
+class _SearchTexts:
+    """
+    The texts of items matched against keywords, with the `Postings` of their
+    normalized texts and of the words of their documents, e.g. mapped from the
+    graph snapshot. Only the texts of the scored items are read, every text is
+    decoded once keywords are scored against every item.
+
+    A search looks the keywords up in three stages: items with a text equal to a
+    keyword, up to `_CANDIDATES` items found by BM25 over their documents, and the
+    fuzzy scores of these candidates only. Keywords sharing no word with any
+    document are scored against every item, to still match misspellings.
+    """
 
-def load_default_ers(file_path: str) -> None:
-    """Load default entities from data source"""
-    global _Entity, _Relation, _Image, _ImageRelation
-    file_path = str(Path(file_path))
-    try:
-        storage = MemoryStorage(file_path)
-        _Entity = storage.get_entities()
-        _Relation = storage.get_relations()
-        _Image = storage.get_images()
-        _ImageRelation = storage.image_relations
-    except Exception as e:
-        print(f"Failed to load entities: {e}")
-        _Entity, _Relation, _Image, _ImageRelation = [], [], [], []
+    def __init__(
+        self,
+        texts: list[list[str]] | EntityRecords,
+        exact: Postings,
+        documents: BM25Index,
+    ):
+        # The texts of every item, or the entities to read their names and aliases from
+        self._texts = texts
+        self._all_texts = texts if isinstance(texts, list) else None
+        self.exact = exact
+        self.documents = documents
+
+    @classmethod
+    def from_texts(
+        cls, texts: Iterable[list[str]], documents: Iterable[str] | None = None
+    ) -> "_SearchTexts":
+        """Texts found by these and their documents, the texts joined by default"""
+        texts = [list(t) for t in texts]
+        exact, words = text_postings(texts, documents)
+        return cls(texts, exact, BM25Index(words))
+
+    def __len__(self) -> int:
+        return len(self.exact)
+
+    def nbytes(self) -> int:
+        """Memory of the decoded texts, the postings are counted by their owner"""
+        if self._all_texts is None:
+            return 0
+        return sys.getsizeof(self._all_texts) + sum(
+            sys.getsizeof(t) for texts in self._all_texts for t in texts
+        )
 
-    # init _G
-    global _G
-    _G = nx.Graph()  # undirected graph
-    for e in _Entity:
-        _G.add_node(e.name, e=e)
-    for r in _Relation:
-        _G.add_edge(r.source, r.target, label=r.label, r=r, type="relation")
-    for i in _Image:
-        _G.add_node(i.path, e=i, type="image")
-    for r in _ImageRelation:
-        _G.add_edge(r.source, r.target, label=r.label, r=r, type="image_relation")
+    def _item_texts(self, items: list[int]) -> list[list[str]]:
+        if self._all_texts is not None:
+            return [self._all_texts[i] for i in items]
+        assert isinstance(self._texts, EntityRecords)
+        return [self._texts.search_texts(i) for i in items]
+
+    def scores(
+        self, keywords: list[str], items: np.ndarray | None = None
+    ) -> np.ndarray:
+        """The best token ratio of the items, all by default, over their texts"""
+        if items is None:
+            if self._all_texts is None:
+                assert isinstance(self._texts, EntityRecords)
+                self._all_texts = self._texts.all_search_texts()
+            item_texts = self._all_texts
+        else:
+            item_texts = self._item_texts(items.tolist())
+        texts = [t for item in item_texts for t in item or [""]]
+        counts = [len(item) or 1 for item in item_texts]
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+        scores = process.cdist(
+            keywords,
+            texts,
+            scorer=token_ratio,
+            dtype=np.float64,
+            workers=_SCORE_WORKERS,
+        )
+        return np.maximum.reduceat(scores.max(axis=0), starts)
+
+    def matches(self, keywords: list[str]) -> list[int]:
+        """The items with a text equal to a keyword once normalized, in keyword order"""
+        found = {}
+        for keyword in keywords:
+            span = self.exact.span(normalize(keyword))
+            if span is not None:
+                found.update(dict.fromkeys(self.exact.items[span].tolist()))
+        return list(found)
+
+    def search(
+        self, keywords: list[str], max_num: int = 3, similarity_threshold: float = 15
+    ) -> list[int]:
+        """The most similar items to the keywords, exact matches first, best first"""
+        if not keywords or not len(self) or max_num <= 0:
+            return []
+        exact = self.matches(keywords)[:max_num]
+        candidates = self.documents.top(keywords, _CANDIDATES)
+        if not len(candidates) and not exact:
+            return _top(self.scores(keywords), max_num, similarity_threshold)
+        candidates = candidates[~np.isin(candidates, exact)]
+        if not len(candidates) or len(exact) == max_num:
+            return exact
+        scores = self.scores(keywords, candidates)
+        best = _top(scores, max_num - len(exact), similarity_threshold)
+        return exact + candidates[best].tolist()
+
+
+class SearchIndex:
+    """
+    Search over the entities, relations and images of one database.
+    Entities and relations are compact records, models are built for the results only.
+    """
 
+    def __init__(self, graph: GraphSnapshot | None = None, folder: str | None = None):
+        self.folder = folder
+        # Undirected graph over the entity names and image paths, memory-mapped
+        self.graph = graph
+        if graph is None:
+            self.entities = EntityRecords()
+            self.relations = RelationRecords()
+            self.image_relations = RelationRecords()
+            self.images: list[Image] = []
+        else:
+            self.entities = graph.entities
+            self.relations = graph.relations
+            self.image_relations = graph.image_relations
+            self.images = graph.images
+        # The published version of the database the index was built from
+        self.stamp = graph.stamp if graph is not None else None
+        self._image_index: ImageHashIndex | None = None
+        self._entity_texts: _SearchTexts | None = None
+        self._image_texts: _SearchTexts | None = None
+
+    @classmethod
+    def load(cls, folder: str, previous: "SearchIndex | None" = None) -> "SearchIndex":
+        """
+        Load the graph snapshot of a database, updated or rebuilt if the storage changed
+
+        Args:
+            previous (SearchIndex, optional): The index in use, its snapshot is updated with the new saves
+        """
+        folder = str(Path(folder))
+        graph = previous.graph if previous is not None else None
+        return cls(GraphSnapshot.load(folder, graph), folder)
+
+    @property
+    def image_index(self) -> ImageHashIndex:
+        if self._image_index is None:
+            self._image_index = (
+                self.graph.image_index if self.graph is not None else ImageHashIndex()
+            )
+        return self._image_index
+
+    def build_search_texts(self):
+        """
+        The texts searched by keywords, otherwise on the first search.
+        The postings are mapped from the graph snapshot, or built without one.
+        """
+        if self.graph is not None:
+            entity_exact = self.graph.postings("entities.search.exact")
+            entity_words = self.graph.postings("entities.search.words")
+            image_exact = self.graph.postings("images.search.exact")
+            image_words = self.graph.postings("images.search.words")
+        else:
+            entity_exact, entity_words = entity_postings(self.entities)
+            image_exact, image_words = image_postings(self.images)
+        self._entity_texts = _SearchTexts(
+            self.entities, entity_exact, BM25Index(entity_words)
+        )
+        self._image_texts = _SearchTexts(
+            [image_search_texts(i) for i in self.images],
+            image_exact,
+            BM25Index(image_words),
+        )
 
-@lru_cache(maxsize=1024)
-def _calculate_similarity(s1: str, s2: str) -> float:
-    """Calculate similarity between two strings with caching"""
-    return token_ratio(s1, s2)  # 0-100
+    @property
+    def entity_texts(self) -> _SearchTexts:
+        """The names and aliases of the entities, found by these and their descriptions"""
+        if self._entity_texts is None:
+            self.build_search_texts()
+        assert self._entity_texts is not None
+        return self._entity_texts
+
+    @property
+    def image_texts(self) -> _SearchTexts:
+        """The captions and texts of the images, found by these and their descriptions"""
+        if self._image_texts is None:
+            self.build_search_texts()
+        assert self._image_texts is not None
+        return self._image_texts
+
+    def nbytes(self) -> int:
+        """Memory of the index, the mapped arrays count once they are paged in"""
+        texts = sum(
+            t.nbytes() for t in (self._entity_texts, self._image_texts) if t is not None
+        )
+        if self.graph is None:
+            postings = sum(
+                t.exact.nbytes() + t.documents.nbytes()
+                for t in (self._entity_texts, self._image_texts)
+                if t is not None
+            )
+            return (
+                self.entities.nbytes() + self.relations.nbytes() + postings + texts
+            )
+        return self.graph.nbytes() + texts
+
+    def _neighbourhood(self, start_nodes: list[str], max_hop: int) -> list[int]:
+        """The graph nodes within max_hop of the start nodes, in code order"""
+        if self.graph is None:
+            return []
+        codes = [c for node in start_nodes if (c := self.graph.node(node)) is not None]
+        return sorted(self.graph.neighbourhood(codes, max_hop))
+
+    def _subgraph_relations(self, nodes: list[int], kind: int) -> list[int]:
+        """The rows of the relations of a kind between the given nodes"""
+        assert self.graph is not None
+        node_set = set(nodes)
+        return sorted(
+            row
+            for node in nodes
+            for neighbour, row, edge_kind in self.graph.edges(node)
+            if edge_kind == kind and neighbour in node_set and node <= neighbour
+        )
 
+    def search_entities(
+        self, keywords: list[str], max_num: int = 3, similarity_threshold: float = 15
+    ) -> list[Entity]:
+        """Search for entities based on keywords"""
+        rows = self.entity_texts.search(keywords, max_num, similarity_threshold)
+        return [self.entities.model(row) for row in rows]
+
+    def search_images(
+        self, keywords: list[str], max_num: int = 3, similarity_threshold: float = 15
+    ) -> list[Image]:
+        """Search for images based on keywords"""
+
+        for k in keywords:
+            if "architecture" in k.lower() and "Graph" in k and "Light" in k:
+                keywords = [
+                    "Overall architecture of the proposed LightRAG",
+                    "Figure 1: Graph RAG pipeline",
+                ]
+        rows = self.image_texts.search(keywords, max_num, similarity_threshold)
+        return [self.images[row] for row in rows]
+
+    def search_nearest_entities(
+        self,
+        entities: list[Entity],
+        max_hop: int = 1,
+    ) -> tuple[list[Entity], list[Relation], list[Image]]:
+        """
+        Search for nearest entities to the given entity within max_hop distance.\n
+        Also search for related images by image relations in one hop.
+
+        Args:
+            entities: Starting entities to search from
+            max_hop: Maximum number of hops to search
+
+        Returns:
+            Tuple of (found_entities, found_relations, found_images)
+        """
+        if not entities:
+            return [], [], []
+
+        nodes = self._neighbourhood([e.name for e in entities], max_hop)
+        if not nodes:
+            return [], [], []
+        graph = self.graph
+        assert graph is not None
+
+        # Collect entities and relations from the subgraph, image nodes are skipped
+        entity_nodes = [
+            (node, row) for node in nodes if (row := graph.entity_row(node)) is not None
+        ]
+        found_entities = [self.entities.model(row) for _, row in entity_nodes]
+        found_relations = [
+            self.relations.model(row)
+            for row in self._subgraph_relations(nodes, RELATION)
+        ]
+
+        # search related images by image relations
+        found_images: list[Image] = []
+        for node, _ in entity_nodes:
+            for neighbour, _, kind in graph.edges(node):
+                image = graph.image(neighbour) if kind == IMAGE_RELATION else None
+                if image is not None:
+                    found_images.append(image)
+
+        return found_entities, found_relations, found_images
+
+    def search_ers_related_to_images(
+        self,
+        images: list[Image],
+        max_hop: int = 1,
+    ) -> tuple[list[Entity], list[Relation]]:
+        """Search for nearest images to the given image within max_hop distance
+
+        Args:
+            images: Starting images to search from
+            max_hop: Maximum number of hops to search
+
+        Returns:
+            Tuple of (found_entities, found_image_relations)
+        """
+        if not images:
+            return [], []
+
+        nodes = self._neighbourhood([i.path for i in images], max_hop)
+        if not nodes:
+            return [], []
+        graph = self.graph
+        assert graph is not None
+
+        # Collect the entities and image relations from the subgraph
+        found_entities: list["Entity"] = [
+            self.entities.model(row)
+            for node in nodes
+            if (row := graph.entity_row(node)) is not None
+        ]
+        found_relations: list["Relation"] = [
+            self.image_relations.model(row)
+            for row in self._subgraph_relations(nodes, IMAGE_RELATION)
+        ]
+
+        return found_entities, found_relations
+
+    def search_eris(
+        self,
+        keywords: list[str],
+        max_num: int = 3,
+        max_images_num: int = 2,
+        similarity_threshold: float = 10,
+        hop: int = 1,
+    ) -> tuple[
+        list[Entity],
+        list[Relation],
+        list[Entity],
+        list[Image],
+        list[Entity],
+        list[Relation],
+    ]:
+        """
+        Search for entities based on keywords and return related entities, relations, images, and image relations
+        """
+        entities = self.search_entities(keywords, max_num, similarity_threshold)
+        log.info(f"Search entities: {len(entities)} for keywords: {keywords.__str__()}")
+        images = self.search_images(keywords, max_num, similarity_threshold)
+        log.info(f"Search images: {len(images)} for keywords: {keywords.__str__()}")
+        # Search for related entities and relations within hop distance
+        related_entities, related_relations, related_images = (
+            self.search_nearest_entities(entities, hop)
+        )
+        # Merge related images by image.path
+        related_images = images + [
+            i for i in related_images if i.path not in [i.path for i in images]
+        ]
 
-def _compute_str_list_similarity(strs1: list[str], strs2: list[str]) -> float:
-    """Compute similarity between a list of strings and a query string"""
-    if not strs1 or not strs2:
-        return 0.0
+        image_entities, image_relations = self.search_ers_related_to_images(
+            related_images, hop
+        )
 
-    # Compute average similarity
-    return max(_calculate_similarity(s1, s2) for s1 in strs1 for s2 in strs2)
+        related_entities = [e for e in related_entities if e not in entities]
+        image_entities = [e for e in image_entities if e not in related_entities]
 
+        if len(related_images) > max_images_num:
+            related_images = related_images[:max_images_num]
 
-def _generic_search_v2(
-    items: list,
-    keywords: list[str],
-    max_num: int = 3,
-    item_transform: Callable[[Any], list[str]] = lambda x: [""],
-    similarity_threshold: float = 15,
-) -> list:
+        return (
+            entities,
+            related_relations,
+            related_entities,
+            related_images,
+            image_entities,
+            image_relations,
+        )
+
+    def search_image_by_example(
+        self, image_path: str, max_distance: int = 5, hop: int = 1
+    ) -> tuple[Image | None, list[Entity], list[Relation]]:
+        """
+        Resolve a query image to the indexed image it shows, by perceptual hash
+
+        Args:
+            image_path: The path of the query image, e.g. a screenshot of an indexed figure
+            max_distance: The maximum hamming distance between the hashes
+            hop: Maximum number of hops to search the related entities
+
+        Returns:
+            Tuple of (indexed image or None, related entities, image relations)
+        """
+        image = self.image_index.find_image(image_path, max_distance)
+        if image is None:
+            return None, [], []
+        log.info(f"Query image {image_path} resolved to indexed image {image.path}")
+        entities, relations = self.search_ers_related_to_images([image], hop)
+        return image, entities, relations
+
+
+class SearchIndexRegistry:
     """
-    Search most similar items from a list of items based on keywords
+    The search indexes of the databases used by the process, shared by every
+    tab and request. The least recently used indexes are dropped once there are
+    more than `max_indexes`, or once they hold more than `max_bytes` together.
+
+    A database is checked for a new published version at most every
+    `refresh_interval` seconds when its index is used. The index is then updated
+    in the background and replaced at once, queries that already got the old
+    index finish on it.
     """
 
-    if not keywords or not items:
-        return []
-
-    if not items:
-        return []
-
-    if item_transform is None and not isinstance(items[0], str):
-        raise ValueError(
-            "get_primary_text and get_auxiliary_texts cannot be None for non-string items"
+    def __init__(
+        self,
+        max_indexes: int = 4,
+        max_bytes: int | None = None,
+        refresh_interval: float = 1.0,
+    ):
+        self.max_indexes = max_indexes
+        self.max_bytes = max_bytes
+        self.refresh_interval = refresh_interval
+        self._indexes: OrderedDict[str, SearchIndex] = OrderedDict()
+        self._sizes: dict[str, int] = {}
+        self._lock = threading.Lock()
+        # One load per database at a time, other databases are not blocked
+        self._loading: dict[str, threading.Lock] = {}
+        self._refreshing: dict[str, threading.Thread] = {}
+        self._checked: dict[str, float] = {}
+
+    @classmethod
+    def from_env(cls) -> "SearchIndexRegistry":
+        """Limits from `MMKG_SEARCH_INDEXES`, `MMKG_SEARCH_MEMORY_MB` and `MMKG_SEARCH_REFRESH_SECONDS`"""
+        memory_mb = os.environ.get("MMKG_SEARCH_MEMORY_MB")
+        return cls(
+            max_indexes=int(os.environ.get("MMKG_SEARCH_INDEXES") or 4),
+            max_bytes=int(float(memory_mb) * 1024 * 1024) if memory_mb else None,
+            refresh_interval=float(os.environ.get("MMKG_SEARCH_REFRESH_SECONDS") or 1),
         )
 
-    queries = [
-        [item] if item_transform is None else item_transform(item) for item in items
-    ]
+    @staticmethod
+    def _key(folder: str) -> str:
+        return os.path.abspath(folder)
+
+    def __len__(self) -> int:
+        return len(self._indexes)
+
+    def __contains__(self, folder: str) -> bool:
+        return self._key(folder) in self._indexes
+
+    def _cached(self, key: str) -> SearchIndex | None:
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is not None:
+                self._indexes.move_to_end(key)
+            return index
+
+    def get(self, folder: str) -> SearchIndex:
+        """The search index of a database, loaded on first use"""
+        key = self._key(folder)
+        index = self._cached(key)
+        if index is not None:
+            self._watch(key, index)
+            return index
+        with self._lock:
+            loading = self._loading.setdefault(key, threading.Lock())
+        with loading:
+            index = self._cached(key)
+            if index is not None:
+                return index
+            index = SearchIndex.load(folder)
+            with self._lock:
+                self._indexes[key] = index
+                self._sizes[key] = index.nbytes()
+                self._checked[key] = time.monotonic()
+                self._loading.pop(key, None)
+                self._evict()
+        log.info(f"Loaded the search index of {folder}, {len(self._indexes)} loaded")
+        return index
+
+    def _watch(self, key: str, index: SearchIndex):
+        """Refresh an index whose database published a new version, checked once per interval"""
+        now = time.monotonic()
+        with self._lock:
+            if (
+                key in self._refreshing
+                or now - self._checked.get(key, 0) < self.refresh_interval
+            ):
+                return
+            self._checked[key] = now
+        if storage_stamp(key) != index.stamp:
+            self.refresh(key)
+
+    def refresh(self, folder: str, wait: bool = False):
+        """
+        Update the index of a database to its published version in the background.
+        Queries use the current index until the updated one replaces it.
+
+        Args:
+            wait (bool, optional): Return once the updated index is in use. Defaults to False.
+        """
+        key = self._key(folder)
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is None:
+                # Loaded on the next use
+                return
+            thread = self._refreshing.get(key)
+            if thread is None:
+                thread = threading.Thread(
+                    target=self._refresh, args=(key, index), daemon=True
+                )
+                self._refreshing[key] = thread
+                thread.start()
+        if wait:
+            thread.join()
+
+    def _refresh(self, key: str, index: SearchIndex):
+        try:
+            refreshed = SearchIndex.load(key, index)
+            with self._lock:
+                # Not when it was dropped meanwhile
+                if self._indexes.get(key) is index:
+                    self._indexes[key] = refreshed
+                    self._sizes[key] = refreshed.nbytes()
+                    self._evict()
+            log.info(f"Refreshed the search index of {key} to {refreshed.stamp}")
+        except Exception as e:
+            log.warning(f"Failed to refresh the search index of {key}: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.pop(key, None)
+
+    def _evict(self):
+        """Drop the least recently used indexes over the limits, the last used one stays"""
+        while len(self._indexes) > 1 and (
+            len(self._indexes) > self.max_indexes
+            or (
+                self.max_bytes is not None
+                and sum(self._sizes.values()) > self.max_bytes
+            )
+        ):
+            key, _ = self._indexes.popitem(last=False)
+            self._sizes.pop(key, None)
+            self._checked.pop(key, None)
+            log.info(f"Evicted the search index of {key}")
+
+    def invalidate(self, folder: str):
+        """Drop the index of a database, the next `get` loads it again"""
+        key = self._key(folder)
+        with self._lock:
+            self._indexes.pop(key, None)
+            self._sizes.pop(key, None)
+            self._checked.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._indexes.clear()
+            self._sizes.clear()
+            self._checked.clear()
+
+
+search_indexes = SearchIndexRegistry.from_env()
+# The index used without a database, set by `init_entities`
+_DEFAULT = SearchIndex()
+# The database used without one, set by `load_default_ers`
+_DEFAULT_FOLDER: str | None = None
+
+
+def get_search_index(folder: str | None = None) -> SearchIndex:
+    """The index of a database from the registry, or the default one"""
+    folder = folder or _DEFAULT_FOLDER
+    return search_indexes.get(folder) if folder else _DEFAULT
 
-    similarity_scores = []
-    for qs in queries:
-        similarity_scores.append(_compute_str_list_similarity(keywords, qs))
-        pass
 
-    # Sort and return top matches
-    sorted_items = [
-        item
-        for score, item in sorted(
-            zip(similarity_scores, items), key=lambda x: x[0], reverse=True
-        )
-        if score >= similarity_threshold
-    ]
+def init_entities(entities: list[Entity] | None = None) -> None:
+    """Initialize the default index with the entities only"""
+    global _DEFAULT, _DEFAULT_FOLDER
+    if entities is not None:
+        _DEFAULT = SearchIndex()
+        _DEFAULT.entities = EntityRecords.from_items(entities)
+        _DEFAULT_FOLDER = None
 
-    return sorted_items[: max_num if max_num < len(sorted_items) else len(sorted_items)]
+
+def load_default_ers(file_path: str) -> None:
+    """Load the default index from a database, it follows the new versions of the database"""
+    global _DEFAULT, _DEFAULT_FOLDER
+    try:
+        search_indexes.get(file_path)
+        _DEFAULT_FOLDER = file_path
+    except Exception as e:
+        print(f"Failed to load entities: {e}")
+        _DEFAULT = SearchIndex()
+        _DEFAULT_FOLDER = None
 
 
 def _search_entities(
     keywords: list[str], max_num: int = 3, similarity_threshold: float = 15
 ) -> list[Entity]:
-    """Search for entities based on keywords"""
-    return _generic_search_v2(
-        items=_Entity,
-        keywords=keywords,
-        max_num=max_num,
-        item_transform=lambda x: [x.name] + (x.aliases or []),
-        similarity_threshold=similarity_threshold,
-    )
+    """Search for entities of the default index based on keywords"""
+    return get_search_index().search_entities(keywords, max_num, similarity_threshold)
 
 
 def _search_images(
     keywords: list[str], max_num: int = 3, similarity_threshold: float = 15
 ) -> list[Image]:
-    """Search for images based on keywords"""
-
-    for k in keywords:
-        if "architecture" in k.lower() and "Graph" in k and "Light" in k:
-            keywords = [
-                "Overall architecture of the proposed LightRAG",
-                "Figure 1: Graph RAG pipeline",
-            ]
-    return _generic_search_v2(
-        items=_Image,
-        keywords=keywords,
-        max_num=max_num,
-        item_transform=lambda x: [x.caption] + (x.texts or []),
-        similarity_threshold=similarity_threshold,
-    )
-
-
-def _search_nearest_entities(
-    entities: list[Entity],
-    max_hop: int = 1,
-) -> tuple[list[Entity], list[Relation], list[Image]]:
-    """
-    Search for nearest entities to the given entity within max_hop distance.\n
-    Also search for related images by image relations in one hop.
-
-    Args:
-        entities: Starting entities to search from
-        all_entities: All available entities
-        all_relations: All available relations
-        max_hop: Maximum number of hops to search
-
-    Returns:
-        Tuple of (found_entities, found_relations)
-    """
-    if not entities:
-        return [], [], []
-
-    # Get starting nodes
-    start_nodes = [e.name for e in entities]
-
-    # Get subgraph within max_hop distance
-    nodes = set()
-    for start_node in start_nodes:
-        if start_node not in _G:
-            continue
-        # Use breadth-first search to get nodes within max_hop
-        for node, distance in nx.single_source_shortest_path_length(
-            _G, start_node, cutoff=max_hop
-        ).items():
-            nodes.add(node)
-
-    # Get the subgraph
-    subgraph = _G.subgraph(nodes)
-
-    # Collect entities and relations from subgraph
-    found_entities = []
-    found_relations = []
-
-    # Add nodes (entities)
-    for node in subgraph.nodes():
-        node_data = subgraph.nodes[node]
-        if "e" in node_data and "type" in node_data and node_data["type"] == "image":
-            # Skip image nodes
-            continue
-        if "e" in node_data and "type" not in node_data:  # Skip image nodes
-            found_entities.append(node_data["e"])
-
-    # Add edges (relations)
-    for u, v, edge_data in subgraph.edges(data=True):
-        if edge_data.get("type") != "image_relation":  # Skip image relations
-            if "r" in edge_data:
-                found_relations.append(edge_data["r"])
-
-    # search related images by image relations
-    found_images: list[Image] = []
-    for entity in found_entities:
-        for r in _G[entity.name]:
-            if _G[entity.name][r].get("type") == "image_relation":
-                image = _G.nodes[r]["e"]
-                found_images.append(image)
-
-    return found_entities, found_relations, found_images
-
-
-def _search_ers_related_to_images(
-    images: list[Image],
-    max_hop: int = 1,
-) -> tuple[list[Entity], list[Relation]]:
-    """Search for nearest images to the given image within max_hop distance
-
-    Args:
-        images: Starting images to search from
-        all_images: All available images
-        all_relations: All available relations
-        max_hop: Maximum number of hops to search
-
-    Returns:
-        Tuple of (found_images, found_relations)
-    """
-    if not images:
-        return [], []
-
-    # Get starting nodes
-    start_nodes = [e.path for e in images]
-
-    # Get subgraph within max_hop distance
-    nodes = set()
-    for start_node in start_nodes:
-        if start_node not in _G:
-            continue
-        # Use breadth-first search to get nodes within max_hop
-        for node, distance in nx.single_source_shortest_path_length(
-            _G, start_node, cutoff=max_hop
-        ).items():
-            nodes.add(node)
-
-    # Get the subgraph
-    subgraph = _G.subgraph(nodes)
-
-    # Collect images and relations from subgraph
-    found_entities: list["Entity"] = []
-    found_relations: list["Relation"] = []
-
-    # Add nodes (images)
-    for node in subgraph.nodes():
-        node_data = subgraph.nodes[node]
-        if "e" in node_data and "type" in node_data and node_data["type"] == "image":
-            # Skip image nodes
-            continue
-        if "e" in node_data:
-            found_entities.append(node_data["e"])
-        else:
-            print("type node_data", type(node_data), node_data)
-
-    # Add edges (relations)
-    for u, v, edge_data in subgraph.edges(data=True):
-        if edge_data.get("type") == "image_relation":  # Skip entity relations
-            if "r" in edge_data:
-                found_relations.append(edge_data["r"])
-
-    return found_entities, found_relations
+    """Search for images of the default index based on keywords"""
+    return get_search_index().search_images(keywords, max_num, similarity_threshold)
 
 
 def search_eris(
@@ -288,35 +678,18 @@ def search_eris(
     list[Entity],
     list[Relation],
 ]:
-    """
-    Search for entities based on keywords and return related entities, relations, images, and image relations
-    """
-    entities = _search_entities(keywords, max_num, similarity_threshold)
-    log.info(f"Search entities: {len(entities)} for keywords: {keywords.__str__()}")
-    images = _search_images(keywords, max_num, similarity_threshold)
-    log.info(f"Search images: {len(images)} for keywords: {keywords.__str__()}")
-    # Search for related entities and relations within hop distance
-    related_entities, related_relations, related_images = _search_nearest_entities(
-        entities, hop
-    )
-    # Merge related images by image.path
-    related_images = images + [
-        i for i in related_images if i.path not in [i.path for i in images]
-    ]
-
-    image_entities, image_relations = _search_ers_related_to_images(related_images, hop)
-
-    related_entities = [e for e in related_entities if e not in entities]
-    image_entities = [e for e in image_entities if e not in related_entities]
-
-    if len(related_images) > max_images_num:
-        related_images = related_images[:max_images_num]
-
-    return (
-        entities,
-        related_relations,
-        related_entities,
-        related_images,
-        image_entities,
-        image_relations,
+    """`SearchIndex.search_eris` of the default index"""
+    return get_search_index().search_eris(
+        keywords,
+        max_num=max_num,
+        max_images_num=max_images_num,
+        similarity_threshold=similarity_threshold,
+        hop=hop,
     )
+
+
+def search_image_by_example(
+    image_path: str, max_distance: int = 5, hop: int = 1
+) -> tuple[Image | None, list[Entity], list[Relation]]:
+    """`SearchIndex.search_image_by_example` of the default index"""
+    return get_search_index().search_image_by_example(image_path, max_distance, hop)
@@ -1 +1,9 @@
-from .index import MemoryStorage
\ No newline at end of file
+from .index import MemoryStorage
+from .cache import JsonlCache
+from .phash import ImageHashIndex
+from .graph_index import GraphIndex
+from .records import EntityRecords, RelationRecords
+from .snapshot import SnapshotReader, SNAPSHOT_VERSION
+from .neo4j_sync import Neo4jSync
+from .graph_snapshot import GraphSnapshot
+from .export import export_jsonl, import_jsonl
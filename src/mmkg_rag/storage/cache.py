@@ -0,0 +1,49 @@
+import os
+import json
+import logging
+from typing import Any
+
+log = logging.getLogger("mgrag")
+
+
+class JsonlCache:
+    """
+    Key-value cache persisted as an append-only JSON lines file.
+    Every `set` appends one line, the last line of a key wins on load.
+    """
+
+    def __init__(self, path: str | None = None):
+        self.path = path
+        self._data: dict[str, Any] = {}
+        if path and os.path.exists(path):
+            self._load(path)
+
+    def _load(self, path: str):
+        with open(path, "r", encoding="utf-8") as f:
+            for line_no, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    item = json.loads(line)
+                    self._data[item["key"]] = item["value"]
+                except (json.JSONDecodeError, KeyError) as e:
+                    # A crash may leave a truncated last line
+                    log.warning(f"Skip invalid cache line {line_no} in {path}: {e}")
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self._data.get(key, default)
+
+    def set(self, key: str, value: Any):
+        self._data[key] = value
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"key": key, "value": value}, ensure_ascii=False))
+            f.write("\n")
@@ -0,0 +1,234 @@
+"""
+Line-delimited export and import of a whole storage.
+
+An export is a folder with one JSON lines file per record type, gzip compressed
+by default, the indexes as one JSON document and a manifest with the counts.
+Lines are the items as stored in a snapshot, so the records are streamed in
+both directions without holding a section in memory, and the record types are
+imported in parallel, each into its own section of a new snapshot.
+"""
+
+import os
+import gzip
+import json
+import shutil
+import logging
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import IO
+from pydantic import TypeAdapter
+
+from ..types import Entity, Relation, Image
+from .index import MemoryStorage, SNAPSHOT_FILE
+from .snapshot import (
+    ITEM_ADAPTERS,
+    SECTIONS,
+    dump_item,
+    encode_section,
+    section_compressor,
+    write_snapshot,
+)
+from .versions import (
+    collect_versions,
+    folder_lock,
+    new_version,
+    read_current,
+    write_current,
+)
+
+log = logging.getLogger("mgrag")
+
+EXPORT_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+INDEXES_FILE = "indexes.json"
+RECORD_TYPES = tuple(ITEM_ADAPTERS)
+_COMPRESS_LEVEL = 3
+# Lines written to the compressor, and validated, at once
+_BATCH_LINES = 1024
+_BATCH_ADAPTERS: dict[str, TypeAdapter] = {
+    "entities": TypeAdapter(list[Entity]),
+    "relations": TypeAdapter(list[Relation]),
+    "images": TypeAdapter(list[Image]),
+    "image_relations": TypeAdapter(list[Relation]),
+}
+
+
+def _record_file(record_type: str, compressed: bool) -> str:
+    return f"{record_type}.jsonl.gz" if compressed else f"{record_type}.jsonl"
+
+
+def _open(path: str, mode: str, compressed: bool) -> IO[bytes]:
+    if compressed:
+        return gzip.open(path, mode, compresslevel=_COMPRESS_LEVEL)  # type: ignore[return-value]
+    return open(path, mode)
+
+
+def export_jsonl(storage: MemoryStorage, folder: str, compress: bool = True) -> dict:
+    """
+    Export the records and indexes of a storage to JSON lines files
+
+    Args:
+        storage (MemoryStorage): The storage, sections it did not load are streamed from its snapshot
+        folder (str): The export folder
+        compress (bool, optional): Gzip the record files. Defaults to True.
+
+    Returns:
+        dict: The manifest of the export
+    """
+    os.makedirs(folder, exist_ok=True)
+    counts = {}
+    for record_type in RECORD_TYPES:
+        count = 0
+        path = os.path.join(folder, _record_file(record_type, compress))
+        with _open(path, "wb", compress) as f:
+            batch = []
+            for line in storage.iter_lines(record_type):
+                batch.append(line)
+                if len(batch) == _BATCH_LINES:
+                    f.write(b"\n".join(batch) + b"\n")
+                    count += len(batch)
+                    batch = []
+            if batch:
+                f.write(b"\n".join(batch) + b"\n")
+                count += len(batch)
+        counts[record_type] = count
+
+    with open(os.path.join(folder, INDEXES_FILE), "w", encoding="utf-8") as f:
+        json.dump(storage._section_value("indexes"), f, ensure_ascii=False)
+
+    manifest = {"version": EXPORT_VERSION, "compressed": compress, "counts": counts}
+    with open(os.path.join(folder, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    log.info(f"Exported {counts} to {folder}")
+    return manifest
+
+
+def _encode_records(
+    path: str, compressed: bool, record_type: str, part_path: str
+) -> dict:
+    """
+    Validate the lines of a record file and compress them into a snapshot section.
+    Runs in a worker, the section payload is written to `part_path`.
+    """
+    adapter = ITEM_ADAPTERS[record_type]
+    batch_adapter = _BATCH_ADAPTERS[record_type]
+    compressor = section_compressor()
+    count, raw_size = 0, 0
+
+    def encode(batch: list[bytes], first_line: int) -> bytes:
+        """Validate a batch of lines at once, and dump them again as the storage does"""
+        try:
+            items = batch_adapter.validate_json(b"[" + b",".join(batch) + b"]")
+        except ValueError:
+            # Find the line to report
+            for line_no, line in enumerate(batch, start=first_line):
+                try:
+                    adapter.validate_json(line)
+                except ValueError as e:
+                    raise ValueError(f"Invalid record at line {line_no} of {path}: {e}")
+            raise
+        for line_no, item in enumerate(items, start=first_line):
+            if getattr(item, "id", 0) is None:
+                raise ValueError(f"Record at line {line_no} of {path} has no id")
+        return b"\n".join(dump_item(item) for item in items)
+
+    with _open(path, "rb", compressed) as f, open(part_path, "wb") as out:
+        batch, first_line = [], 1
+        for line_no, line in enumerate(f, start=1):
+            line = line.rstrip(b"\r\n")
+            if line:
+                batch.append(line)
+            if len(batch) == _BATCH_LINES:
+                raw = (b"\n" if count else b"") + encode(batch, first_line)
+                out.write(compressor.compress(raw))
+                count += len(batch)
+                raw_size += len(raw)
+                batch, first_line = [], line_no + 1
+        if batch:
+            raw = (b"\n" if count else b"") + encode(batch, first_line)
+            out.write(compressor.compress(raw))
+            count += len(batch)
+            raw_size += len(raw)
+        out.write(compressor.flush())
+    return {
+        "codec": "zlib-lines",
+        "count": count,
+        "raw_size": raw_size,
+        "size": os.path.getsize(part_path),
+    }
+
+
+def import_jsonl(
+    source: str, folder: str, workers: int | None = None
+) -> MemoryStorage:
+    """
+    Import an export into a new storage folder.
+    The record files are validated and compressed by parallel workers,
+    one per record type, straight into the sections of a published snapshot.
+
+    Args:
+        source (str): The export folder
+        folder (str): The storage folder, without a saved storage
+        workers (int, optional): Worker processes, 1 imports in this process. Defaults to one per record type.
+
+    Returns:
+        MemoryStorage: The imported storage, loaded lazily
+    """
+    with open(os.path.join(source, MANIFEST_FILE), "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest["version"] > EXPORT_VERSION:
+        raise ValueError(
+            f"Export version {manifest['version']} of {source} is newer than "
+            + f"the supported version {EXPORT_VERSION}"
+        )
+    if read_current(folder) is not None or os.path.exists(
+        os.path.join(folder, SNAPSHOT_FILE)
+    ):
+        raise FileExistsError(f"{folder} already holds a storage")
+    os.makedirs(folder, exist_ok=True)
+    compressed = manifest["compressed"]
+
+    with tempfile.TemporaryDirectory(dir=folder) as parts:
+        jobs = [
+            (
+                os.path.join(source, _record_file(record_type, compressed)),
+                compressed,
+                record_type,
+                os.path.join(parts, record_type),
+            )
+            for record_type in RECORD_TYPES
+        ]
+        workers = workers or len(jobs)
+        if workers == 1:
+            encoded = [_encode_records(*job) for job in jobs]
+        else:
+            with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+                encoded = list(executor.map(_encode_records, *zip(*jobs)))
+
+        with open(os.path.join(source, INDEXES_FILE), "rb") as f:
+            indexes = encode_section("indexes", json.load(f))
+        with folder_lock(folder):
+            version, path = new_version(folder)
+        payloads = [open(job[3], "rb") for job in jobs]
+        try:
+            sections = {}
+            for record_type, section, payload in zip(RECORD_TYPES, encoded, payloads):
+                sections[record_type] = {**section, "payload": payload, "lines": None}
+            sections["indexes"] = indexes
+            write_snapshot(
+                os.path.join(path, SNAPSHOT_FILE),
+                {name: sections[name] for name in SECTIONS},
+            )
+        finally:
+            for payload in payloads:
+                payload.close()
+
+    with folder_lock(folder):
+        if read_current(folder) is not None:
+            shutil.rmtree(path, ignore_errors=True)
+            raise FileExistsError(f"{folder} was saved during the import")
+        write_current(folder, version, 0)
+        collect_versions(folder)
+    counts = {t: section["count"] for t, section in zip(RECORD_TYPES, encoded)}
+    log.info(f"Imported {counts} into {folder}")
+    return MemoryStorage(folder)
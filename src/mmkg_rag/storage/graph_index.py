@@ -0,0 +1,72 @@
+from collections import defaultdict
+from ..types import Entity, Relation, Image
+
+
+class GraphIndex:
+    """
+    Lookup maps over the entities, relations and images of a storage,
+    updated incrementally so that queries run in O(degree).
+    Relations are indexed by the ids of their endpoints.
+    """
+
+    def __init__(self):
+        self.aliases: dict[str, set[int]] = defaultdict(set)
+        self.labels: dict[str, set[int]] = defaultdict(set)
+        # Entity id -> relation id -> relation
+        self.out_relations: dict[int, dict[int, Relation]] = defaultdict(dict)
+        self.in_relations: dict[int, dict[int, Relation]] = defaultdict(dict)
+        self.entity_image_relations: dict[int, dict[int, Relation]] = defaultdict(dict)
+        # Image path -> image, and -> relation id -> relation
+        self.images: dict[str, Image] = {}
+        self.image_relations: dict[str, dict[int, Relation]] = defaultdict(dict)
+
+    @staticmethod
+    def _discard(index: dict, key, value):
+        """Remove a value from an index entry, dropping the entry once empty"""
+        values = index.get(key)
+        if values is None:
+            return
+        if isinstance(values, set):
+            values.discard(value)
+        else:
+            values.pop(value, None)
+        if not values:
+            del index[key]
+
+    def add_entity(self, entity: Entity):
+        assert entity.id is not None
+        for alias in entity.aliases or []:
+            self.aliases[alias].add(entity.id)
+        self.labels[entity.label].add(entity.id)
+
+    def remove_entity(self, entity: Entity):
+        for alias in entity.aliases or []:
+            self._discard(self.aliases, alias, entity.id)
+        self._discard(self.labels, entity.label, entity.id)
+
+    def add_relation(self, relation: Relation):
+        assert relation.id is not None
+        if relation.source_id is not None:
+            self.out_relations[relation.source_id][relation.id] = relation
+        if relation.target_id is not None:
+            self.in_relations[relation.target_id][relation.id] = relation
+
+    def remove_relation(self, relation: Relation):
+        self._discard(self.out_relations, relation.source_id, relation.id)
+        self._discard(self.in_relations, relation.target_id, relation.id)
+
+    def add_image(self, image: Image):
+        self.images[image.path] = image
+
+    def remove_image(self, image: Image):
+        self.images.pop(image.path, None)
+
+    def add_image_relation(self, relation: Relation):
+        assert relation.id is not None
+        if relation.source_id is not None:
+            self.entity_image_relations[relation.source_id][relation.id] = relation
+        self.image_relations[relation.target][relation.id] = relation
+
+    def remove_image_relation(self, relation: Relation):
+        self._discard(self.entity_image_relations, relation.source_id, relation.id)
+        self._discard(self.image_relations, relation.target, relation.id)
@@ -0,0 +1,831 @@
+"""
+Read-only graph snapshot for the retrieval, memory-mapped by every worker.
+
+Layout: magic, header length, JSON header, then 8-byte aligned arrays.
+The header records the offset, dtype and length of every array. Strings are
+packed tables with offsets, the graph is CSR adjacency over the name codes:
+the neighbours of node `c` are `nodes[offsets[c]:offsets[c + 1]]`, reached by
+the relation `rows` of the same slice, of the `kinds` relation or image relation.
+The texts searched by keywords are `Postings` of the entities and images.
+Nothing is decoded on open, so N workers share one page-cache copy.
+"""
+
+import os
+import json
+import mmap
+import struct
+import logging
+import threading
+from typing import Any
+
+import numpy as np
+
+from ..types import Image
+from ..utils.image import dhash
+from .index import MemoryStorage, OPLOG_FILE, SNAPSHOT_FILE
+from .oplog import OpLog
+from .phash import ImageHashIndex
+from .postings import Postings, entity_postings, image_postings
+from .versions import CURRENT_FILE, read_current, version_folder
+from .records import (
+    EntityRecords,
+    RelationRecords,
+    StringPool,
+    StringTable,
+    TextArena,
+)
+
+log = logging.getLogger("mgrag")
+
+GRAPH_FILE = "graph.mmkg"
+GRAPH_VERSION = 2
+GRAPH_MAGIC = b"MMKGGRPH"
+_HEADER_LEN = struct.Struct("<I")
+_ALIGN = 8
+
+RELATION = 1
+IMAGE_RELATION = 2
+
+# Files whose change makes the graph snapshot stale
+_STORAGE_FILES = (
+    SNAPSHOT_FILE,
+    OPLOG_FILE,
+    "entities.pkl",
+    "relations.pkl",
+    "images.pkl",
+    "image_relations.pkl",
+    "image_hashes.pkl",
+)
+
+
+def storage_stamp(folder: str) -> list:
+    """
+    The published version of a storage folder,
+    or the size and modification time of its files before versions
+    """
+    current = read_current(folder)
+    if current is not None:
+        return [[CURRENT_FILE, current["version"], current["log_seq"]]]
+    stamp = []
+    for name in _STORAGE_FILES:
+        path = os.path.join(folder, name)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            stamp.append([name, stat.st_size, stat.st_mtime_ns])
+    return stamp
+
+
+def _adjacency(
+    num_nodes: int,
+    relations: tuple[np.ndarray, np.ndarray],
+    image_relations: tuple[np.ndarray, np.ndarray],
+) -> dict[str, np.ndarray]:
+    """CSR adjacency of the undirected graph of the (sources, targets) of the relations"""
+    sources = np.concatenate([relations[0], image_relations[0]]).astype(np.int64)
+    targets = np.concatenate([relations[1], image_relations[1]]).astype(np.int64)
+    num_relations, num_image_relations = len(relations[0]), len(image_relations[0])
+    rows = np.concatenate(
+        [np.arange(num_relations), np.arange(num_image_relations)]
+    ).astype(np.int64)
+    kinds = np.concatenate(
+        [
+            np.full(num_relations, RELATION, dtype=np.uint8),
+            np.full(num_image_relations, IMAGE_RELATION, dtype=np.uint8),
+        ]
+    )
+    # One edge per pair of nodes, the last added one as in an undirected networkx graph
+    keys = np.minimum(sources, targets) * num_nodes + np.maximum(sources, targets)
+    _, last = np.unique(keys[::-1], return_index=True)
+    keep = np.sort(len(keys) - 1 - last)
+    sources, targets, rows, kinds = sources[keep], targets[keep], rows[keep], kinds[keep]
+
+    # Both directions, self loops once
+    back = sources != targets
+    ends = np.concatenate([sources, targets[back]])
+    order = np.argsort(ends, kind="stable")
+    offsets = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(ends, minlength=num_nodes), out=offsets[1:])
+    return {
+        "offsets": offsets,
+        "nodes": np.concatenate([targets, sources[back]])[order].astype(np.uint32),
+        "rows": np.concatenate([rows, rows[back]])[order],
+        "kinds": np.concatenate([kinds, kinds[back]])[order],
+    }
+
+
+def _strings(prefix: str, strings: StringPool | StringTable) -> dict[str, Any]:
+    if isinstance(strings, StringPool):
+        strings = StringTable.from_strings(strings.strings)
+    return {
+        f"{prefix}.data": strings.data,
+        f"{prefix}.offsets": strings.offsets,
+        f"{prefix}.order": strings.order,
+    }
+
+
+def _texts(prefix: str, texts: TextArena) -> dict[str, Any]:
+    data, offsets = texts.buffers()
+    return {
+        f"{prefix}.data": np.frombuffer(data, dtype=np.uint8),
+        f"{prefix}.offsets": np.asarray(offsets, dtype=np.uint64),
+    }
+
+
+def _postings(prefix: str, postings: tuple[Postings, Postings]) -> dict[str, Any]:
+    """The exact and word postings of the searched texts"""
+    arrays = {}
+    for name, p in zip(("exact", "words"), postings):
+        arrays.update(
+            {
+                **_strings(f"{prefix}.{name}.keys", p.keys),
+                f"{prefix}.{name}.offsets": p.offsets,
+                f"{prefix}.{name}.items": p.items,
+                f"{prefix}.{name}.counts": p.counts,
+                f"{prefix}.{name}.totals": p.totals,
+            }
+        )
+    return arrays
+
+
+def _records(prefix: str, records: EntityRecords | RelationRecords) -> dict[str, Any]:
+    arrays = {
+        **_strings(f"{prefix}.labels", records.labels),
+        **_texts(f"{prefix}.texts", records.texts),
+    }
+    for name in records.COLUMNS:
+        arrays[f"{prefix}.{name}"] = np.asarray(getattr(records, name))
+    return arrays
+
+
+def _graph_arrays(
+    num_nodes: int,
+    images: list[Image],
+    image_codes: list[int],
+    hashes: list[int | None],
+    relations: tuple[np.ndarray, np.ndarray],
+    image_relations: tuple[np.ndarray, np.ndarray],
+) -> dict[str, Any]:
+    """The images, their hashes and texts, and the adjacency over the name codes"""
+    image_rows = np.full(num_nodes, -1, dtype=np.int64)
+    image_rows[image_codes] = np.arange(len(images))
+    images_data = TextArena()
+    images_data.add_all([i.model_dump_json() for i in images])
+    return {
+        **_texts("images", images_data),
+        "images.hashes": np.array([h or 0 for h in hashes], dtype=np.uint64),
+        "images.hashed": np.array([h is not None for h in hashes], dtype=np.uint8),
+        **_postings("images.search", image_postings(images)),
+        "graph.image_rows": image_rows,
+        **{
+            f"graph.{k}": v
+            for k, v in _adjacency(num_nodes, relations, image_relations).items()
+        },
+    }
+
+
+def _log_records(
+    folder: str, stamp: list | None, new_stamp: list
+) -> list[dict] | None:
+    """
+    The saves logged between two stamps of the same published version,
+    None if they are not all in its log, e.g. after a compaction or a full save
+    """
+    if not stamp or not new_stamp or stamp[0][0] != CURRENT_FILE:
+        return None
+    (_, version, log_seq), (name, new_version, new_log_seq) = stamp[0], new_stamp[0]
+    if name != CURRENT_FILE or version != new_version or log_seq > new_log_seq:
+        return None
+    oplog = OpLog(os.path.join(version_folder(folder, version), OPLOG_FILE))
+    records = oplog.read(log_seq, new_log_seq)
+    if [r["seq"] for r in records] != list(range(log_seq + 1, new_log_seq + 1)):
+        return None
+    return records
+
+
+def _fold(records: list[dict], section: str, old_ids: set) -> tuple[set, dict, dict]:
+    """
+    The changes of a section by id over saves, as a storage replays them: the old
+    ids deleted, the old items replaced in place and the new items in insertion order
+    """
+    removed: set = set()
+    changed: dict = {}
+    added: dict = {}
+    for record in records:
+        if section not in record:
+            continue
+        for key in record[section]["delete"]:
+            if added.pop(key, None) is None and key in old_ids:
+                removed.add(key)
+                changed.pop(key, None)
+        for item in record[section]["put"]:
+            key = item["id"]
+            if key in old_ids and key not in removed:
+                changed[key] = item
+            else:
+                added[key] = item
+    return removed, changed, added
+
+
+def _merged_rows(
+    old_ids: np.ndarray, removed: set, changed: dict, num_added: int
+) -> np.ndarray:
+    """
+    The rows of updated records, indexing the old rows followed by the rows
+    of the changed then the added items
+    """
+    num_old = len(old_ids)
+    rows = np.arange(num_old, dtype=np.int64)
+    if changed:
+        keys = np.fromiter(changed, dtype=np.int64, count=len(changed))
+        hit = np.isin(old_ids, keys)
+        order = np.argsort(keys)
+        rows[hit] = num_old + order[np.searchsorted(keys, old_ids[hit], sorter=order)]
+    if removed:
+        keys = np.fromiter(removed, dtype=np.int64, count=len(removed))
+        rows = rows[~np.isin(old_ids, keys)]
+    added = num_old + len(changed) + np.arange(num_added, dtype=np.int64)
+    return np.concatenate([rows, added])
+
+
+def _gather_ragged(
+    offsets: np.ndarray, values: np.ndarray, rows: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """The slices `values[offsets[r]:offsets[r + 1]]` of the rows, packed with their offsets"""
+    offsets = offsets.astype(np.int64)
+    starts = offsets[rows]
+    lengths = offsets[rows + 1] - starts
+    packed = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=packed[1:])
+    index = np.repeat(starts - packed[:-1], lengths) + np.arange(packed[-1])
+    return packed, values[index]
+
+
+def _merged_columns(
+    old: EntityRecords | RelationRecords,
+    new: EntityRecords | RelationRecords,
+    rows: np.ndarray,
+    name_codes: np.ndarray,
+) -> dict[str, np.ndarray]:
+    """
+    The columns of updated records, from the old records and the records of the
+    changed and added items. Names are left as codes of `_MergedNames`.
+    """
+    labels = [old.labels[c] for c in range(len(old.labels))]
+    label_codes = {label: code for code, label in enumerate(labels)}
+    new_labels = np.array(
+        [label_codes.setdefault(s, len(label_codes)) for s in new.labels.strings],
+        dtype=np.int64,
+    )
+    labels.extend(list(label_codes)[len(labels) :])
+    # Texts of the changed and added items are appended, replaced ones stay until a rebuild
+    old_data, old_offsets = old.texts.buffers()
+    new_data, new_offsets = new.texts.buffers()
+    text_shift = len(old.texts)
+    arrays = {
+        **_strings("labels", StringTable.from_strings(labels)),
+        "texts.data": np.frombuffer(old_data + new_data, dtype=np.uint8),
+        "texts.offsets": np.concatenate(
+            [
+                np.asarray(old_offsets, dtype=np.uint64),
+                np.asarray(new_offsets, dtype=np.uint64)[1:] + len(old_data),
+            ]
+        ),
+    }
+
+    for column in old.COLUMNS:
+        if column in ("alias_offsets", "alias_codes"):
+            continue
+        old_values = np.asarray(getattr(old, column))
+        new_values = np.asarray(getattr(new, column)).astype(np.int64)
+        if column in ("name_codes", "sources", "targets"):
+            new_values = name_codes[new_values]
+        elif column == "label_codes":
+            new_values = new_labels[new_values]
+        elif column in ("descriptions", "extras"):
+            new_values = np.where(new_values >= 0, new_values + text_shift, -1)
+        values = np.concatenate([old_values.astype(np.int64), new_values])[rows]
+        arrays[column] = values.astype(old_values.dtype)
+    if isinstance(old, EntityRecords):
+        offsets = np.asarray(old.alias_offsets, dtype=np.int64)
+        new_offsets = np.asarray(new.alias_offsets, dtype=np.int64)
+        offsets, codes = _gather_ragged(
+            np.concatenate([offsets, offsets[-1] + new_offsets[1:]]),
+            np.concatenate(
+                [
+                    np.asarray(old.alias_codes, dtype=np.int64),
+                    name_codes[np.asarray(new.alias_codes, dtype=np.int64)],
+                ]
+            ),
+            rows,
+        )
+        arrays["alias_offsets"] = offsets.astype(np.uint32)
+        arrays["alias_codes"] = codes.astype(np.uint32)
+    return arrays
+
+
+class _MergedNames:
+    """
+    The names of a snapshot followed by the new names of its saves.
+    `StringPool` codes of the saved items map to these codes, and once every
+    code is known they are renumbered in the order a rebuild adds them to its pool.
+    """
+
+    def __init__(self, names: StringTable, pool: StringPool):
+        self.names = names
+        num_old = len(names)
+        new: list[bytes] = []
+        positions: list[int] = []
+        codes = np.empty(len(pool), dtype=np.int64)
+        for code, value in enumerate(pool.strings):
+            key = value.encode("utf-8")
+            position = names.bisect(key)
+            if position < len(names.order) and names[names.order[position]] == value:
+                codes[code] = names.order[position]
+            else:
+                codes[code] = num_old + len(new)
+                new.append(key)
+                positions.append(position)
+        # Pool codes -> merged codes
+        self.codes = codes
+        self.new = new
+        self._positions = positions
+
+    def table(self, sequence: list[np.ndarray]) -> tuple[StringTable, np.ndarray]:
+        """
+        The table of the names used by the code arrays, numbered by first use
+
+        Returns:
+            tuple: The table, and the new code by merged code, -1 for unused names
+        """
+        num_old = len(self.names)
+        used_codes = np.concatenate([s.astype(np.int64) for s in sequence])
+        unique, first = np.unique(used_codes, return_index=True)
+        used = unique[np.argsort(first)]
+        renumber = np.full(num_old + len(self.new), -1, dtype=np.int64)
+        renumber[used] = np.arange(len(used))
+
+        lengths = np.array([len(key) for key in self.new], dtype=np.int64)
+        offsets, data = _gather_ragged(
+            np.concatenate(
+                [
+                    np.asarray(self.names.offsets, dtype=np.int64),
+                    int(self.names.offsets[num_old]) + np.cumsum(lengths),
+                ]
+            ),
+            np.concatenate(
+                [
+                    np.asarray(self.names.data),
+                    np.frombuffer(b"".join(self.new), dtype=np.uint8),
+                ]
+            ),
+            used,
+        )
+        # The new names inserted in the sorted old ones
+        inserted = sorted(
+            range(len(self.new)), key=lambda i: (self._positions[i], self.new[i])
+        )
+        order = np.insert(
+            np.asarray(self.names.order, dtype=np.int64),
+            [self._positions[i] for i in inserted],
+            [num_old + i for i in inserted],
+        )
+        order = renumber[order]
+        order = order[order >= 0]
+        table = StringTable(
+            data.astype(np.uint8), offsets.astype(np.uint64), order.astype(np.uint32)
+        )
+        return table, renumber
+
+
+class GraphSnapshot:
+    """
+    The entities, relations, images and adjacency of a storage, as searched by the retrieval.
+    `open` maps a written snapshot read-only, `load` also (re)builds it when the storage changed.
+    """
+
+    def __init__(
+        self,
+        arrays: dict[str, np.ndarray],
+        images: list[Image],
+        stamp: list | None = None,
+    ):
+        self.arrays = arrays
+        self.stamp = stamp
+        self.images = images
+        names = StringTable(
+            arrays["names.data"], arrays["names.offsets"], arrays["names.order"]
+        )
+        self.names = names
+        self.entities = EntityRecords.from_columns(
+            names,
+            *self._strings_and_texts("entities"),
+            self._columns("entities", EntityRecords.COLUMNS),
+            arrays["entities.name_rows"],
+        )
+        self.relations = RelationRecords.from_columns(
+            names,
+            *self._strings_and_texts("relations"),
+            self._columns("relations", RelationRecords.COLUMNS),
+        )
+        self.image_relations = RelationRecords.from_columns(
+            names,
+            *self._strings_and_texts("image_relations"),
+            self._columns("image_relations", RelationRecords.COLUMNS),
+        )
+        self.entity_rows = arrays["entities.name_rows"]
+        self.image_rows = arrays["graph.image_rows"]
+        self.offsets = arrays["graph.offsets"]
+        self.nodes = arrays["graph.nodes"]
+        self.rows = arrays["graph.rows"]
+        self.kinds = arrays["graph.kinds"]
+        self._image_index: ImageHashIndex | None = None
+
+    def _strings_and_texts(self, prefix: str) -> tuple[StringTable, TextArena]:
+        a = self.arrays
+        return (
+            StringTable(
+                a[f"{prefix}.labels.data"],
+                a[f"{prefix}.labels.offsets"],
+                a[f"{prefix}.labels.order"],
+            ),
+            TextArena(a[f"{prefix}.texts.data"], a[f"{prefix}.texts.offsets"]),
+        )
+
+    def _columns(self, prefix: str, columns: tuple[str, ...]) -> dict[str, np.ndarray]:
+        return {name: self.arrays[f"{prefix}.{name}"] for name in columns}
+
+    @classmethod
+    def from_storage(cls, storage: MemoryStorage) -> "GraphSnapshot":
+        entities, relations, image_relations = storage.records()
+        names = entities.names
+        images = storage.get_images()
+        # Hashes missing in the storage are computed from the image files
+        image_index = storage.image_index
+        image_codes = [names.code(i.path) for i in images]
+
+        hashes = [image_index.hashes.get(i.path) for i in images]
+        arrays = {
+            **_strings("names", names),
+            **_records("entities", entities),
+            "entities.name_rows": entities.name_rows(),
+            **_postings("entities.search", entity_postings(entities)),
+            **_records("relations", relations),
+            **_records("image_relations", image_relations),
+            **_graph_arrays(
+                len(names),
+                images,
+                image_codes,
+                hashes,
+                (np.asarray(relations.sources), np.asarray(relations.targets)),
+                (
+                    np.asarray(image_relations.sources),
+                    np.asarray(image_relations.targets),
+                ),
+            ),
+        }
+        graph = cls(arrays, images)
+        graph._image_index = image_index
+        return graph
+
+    def update(self, folder: str, stamp: list) -> "GraphSnapshot | None":
+        """
+        Apply the saves logged since the snapshot was built, instead of rebuilding it.
+        Only the saved items are decoded, the other rows are copied by column and
+        the postings of the searched texts are updated with the saved entities.
+        Those of the images are rebuilt, the images are decoded on open anyway.
+        Names are coded as in a rebuild, replaced texts stay in the arenas until one.
+
+        Args:
+            folder (str): The storage folder of the snapshot
+            stamp (list): The published version to update to, see `storage_stamp`
+
+        Returns:
+            GraphSnapshot: The updated snapshot in memory, None when the saves are
+                not all in the log of the version it was built from
+        """
+        records = _log_records(folder, self.stamp, stamp)
+        if records is None:
+            return None
+        pool = StringPool()
+        sections = {}
+        for section, old in (
+            ("entities", self.entities),
+            ("relations", self.relations),
+            ("image_relations", self.image_relations),
+        ):
+            old_ids = np.asarray(old.ids)
+            removed, changed, added = _fold(records, section, set(old_ids.tolist()))
+            new = type(old).from_items(iter([*changed.values(), *added.values()]), pool)
+            rows = _merged_rows(old_ids, removed, changed, len(added))
+            sections[section] = (old, new, rows)
+
+        images, hashes = self._updated_images(records)
+        image_codes = np.flatnonzero(self.image_rows >= 0)
+        old_codes = {
+            self.images[int(self.image_rows[c])].path: int(c) for c in image_codes
+        }
+        for image in images:
+            if image.path not in old_codes:
+                pool.code(image.path)
+        names = _MergedNames(self.names, pool)
+        codes = np.array(
+            [
+                old_codes[i.path]
+                if i.path in old_codes
+                else names.codes[pool.code(i.path)]
+                for i in images
+            ],
+            dtype=np.int64,
+        )
+
+        columns = {
+            section: _merged_columns(old, new, rows, names.codes)
+            for section, (old, new, rows) in sections.items()
+        }
+        _, saved, rows = sections["entities"]
+        search = tuple(
+            self.postings(f"entities.search.{name}").update(rows, postings)
+            for name, postings in zip(("exact", "words"), entity_postings(saved))
+        )
+        entities = columns["entities"]
+        relations = columns["relations"]
+        image_relations = columns["image_relations"]
+        table, renumber = names.table(
+            [
+                entities["name_codes"],
+                entities["alias_codes"],
+                relations["sources"],
+                relations["targets"],
+                image_relations["sources"],
+                image_relations["targets"],
+                codes,
+            ]
+        )
+        for arrays, code_columns in (
+            (entities, ("name_codes", "alias_codes")),
+            (relations, ("sources", "targets")),
+            (image_relations, ("sources", "targets")),
+        ):
+            for column in code_columns:
+                arrays[column] = renumber[arrays[column]].astype(np.uint32)
+        num_nodes = len(table)
+        name_rows = np.full(num_nodes, -1, dtype=np.int64)
+        unique, first = np.unique(entities["name_codes"], return_index=True)
+        name_rows[unique] = first
+
+        arrays = {
+            **_strings("names", table),
+            **{f"entities.{k}": v for k, v in entities.items()},
+            "entities.name_rows": name_rows,
+            **_postings("entities.search", search),
+            **{f"relations.{k}": v for k, v in relations.items()},
+            **{f"image_relations.{k}": v for k, v in image_relations.items()},
+            **_graph_arrays(
+                num_nodes,
+                images,
+                renumber[codes].tolist(),
+                hashes,
+                (relations["sources"], relations["targets"]),
+                (image_relations["sources"], image_relations["targets"]),
+            ),
+        }
+        log.info(f"Applied {len(records)} saves to the graph snapshot of {folder}")
+        return GraphSnapshot(arrays, images, stamp)
+
+    def _updated_images(
+        self, records: list[dict]
+    ) -> tuple[list[Image], list[int | None]]:
+        """
+        The images after the saves and their hashes.
+        Replayed save by save as a storage does, paths are not unique.
+        """
+        hashes: dict[str, int | None] = {
+            image.path: value if hashed else None
+            for image, value, hashed in zip(
+                self.images,
+                self.arrays["images.hashes"].tolist(),
+                self.arrays["images.hashed"].tolist(),
+            )
+        }
+        images = self.images
+        saved: set[str] = set()
+        for record in records:
+            if "images" in record:
+                delete = set(record["images"]["delete"])
+                put = {
+                    d["path"]: Image.model_validate(d) for d in record["images"]["put"]
+                }
+                saved.update(put)
+                images = [put.pop(i.path, i) for i in images if i.path not in delete]
+                images += list(put.values())
+            changes = record.get("indexes", {}).get("image_hashes")
+            if changes is None:
+                continue
+            for path in changes["delete"]:
+                hashes.pop(path, None)
+            for path, value in changes["put"]:
+                hashes[path] = value
+        # Hashes missing in the storage are computed from the image files, as on a rebuild
+        for path in saved:
+            if hashes.get(path) is None:
+                hashes[path] = dhash(path)
+        return images, [hashes.get(i.path) for i in images]
+
+    def write(self, path: str, stamp: list | None = None):
+        """Write the snapshot, atomically replacing the old one"""
+        header: dict[str, Any] = {
+            "version": GRAPH_VERSION,
+            "stamp": stamp,
+            "arrays": {},
+        }
+        offset = 0
+        for name, values in self.arrays.items():
+            header["arrays"][name] = [offset, values.dtype.str, len(values)]
+            offset += -(-values.nbytes // _ALIGN) * _ALIGN
+        header_bytes = json.dumps(header).encode("utf-8")
+        start = len(GRAPH_MAGIC) + _HEADER_LEN.size + len(header_bytes)
+        padding = -start % _ALIGN
+
+        # Unique per thread, the retrieval writes it while refreshing in the background
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(GRAPH_MAGIC)
+            f.write(_HEADER_LEN.pack(len(header_bytes) + padding))
+            f.write(header_bytes + b" " * padding)
+            for values in self.arrays.values():
+                data = np.ascontiguousarray(values).tobytes()
+                f.write(data + b"\0" * (-len(data) % _ALIGN))
+        os.replace(tmp_path, path)
+        self.stamp = stamp
+
+    @classmethod
+    def open(cls, path: str) -> "GraphSnapshot":
+        """Map a snapshot file read-only, only the header and the images are decoded"""
+        with open(path, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if buffer[: len(GRAPH_MAGIC)] != GRAPH_MAGIC:
+            raise ValueError(f"Not a graph snapshot: {path}")
+        start = len(GRAPH_MAGIC) + _HEADER_LEN.size
+        (header_len,) = _HEADER_LEN.unpack(buffer[len(GRAPH_MAGIC) : start])
+        header = json.loads(buffer[start : start + header_len])
+        if header["version"] != GRAPH_VERSION:
+            raise ValueError(
+                f"Graph snapshot version {header['version']} of {path} is not "
+                + f"the supported version {GRAPH_VERSION}"
+            )
+        start += header_len
+        arrays = {
+            name: np.frombuffer(buffer, dtype=dtype, count=count, offset=start + offset)
+            for name, (offset, dtype, count) in header["arrays"].items()
+        }
+        image_texts = TextArena(arrays["images.data"], arrays["images.offsets"])
+        images = [
+            Image.model_validate_json(image_texts.get(i))
+            for i in range(len(image_texts))
+        ]
+        return cls(arrays, images, header["stamp"])
+
+    @classmethod
+    def _written(cls, path: str) -> "GraphSnapshot | None":
+        """The written snapshot, None if missing or invalid"""
+        if not os.path.exists(path):
+            return None
+        try:
+            return cls.open(path)
+        except (OSError, ValueError) as e:
+            log.warning(f"Rebuild the invalid graph snapshot {path}: {e}")
+            return None
+
+    @classmethod
+    def load(
+        cls, folder: str, graph: "GraphSnapshot | None" = None
+    ) -> "GraphSnapshot":
+        """
+        Map the graph snapshot of a storage folder.
+        When missing or stale, it is updated with the saves logged since it was written,
+        or rebuilt from the storage, and written for the other workers.
+        A folder without a storage gets an empty graph, and nothing is written to it.
+
+        Args:
+            graph (GraphSnapshot, optional): A snapshot of the folder to update first, e.g. the one in use
+        """
+        path = os.path.join(folder, GRAPH_FILE)
+        stamp = storage_stamp(folder)
+        written = cls._written(path)
+        if written is not None and written.stamp == stamp:
+            return written
+        for base in (graph, written):
+            updated = base.update(folder, stamp) if base is not None else None
+            if updated is None:
+                continue
+            try:
+                updated.write(path, stamp)
+            except OSError as e:
+                log.warning(f"Failed to write the graph snapshot {path}: {e}")
+                return updated
+            return cls.open(path)
+
+        storage = MemoryStorage(folder)
+        # Nothing is written for a folder without a storage
+        if stamp:
+            try:
+                return cls.publish(storage, stamp)
+            except OSError as e:
+                log.warning(f"Failed to write the graph snapshot {path}: {e}")
+        graph = cls.from_storage(storage)
+        graph.stamp = stamp
+        return graph
+
+    @classmethod
+    def publish(cls, storage: MemoryStorage, stamp: list | None = None) -> "GraphSnapshot":
+        """
+        Write the graph snapshot of a saved storage for the retrieval workers.
+        The written snapshot is updated with the logged saves when it is of the same version.
+
+        Args:
+            stamp (list, optional): The storage files it is built from, as before reading the storage
+        """
+        path = os.path.join(storage.folder, GRAPH_FILE)
+        if stamp is None:
+            stamp = storage_stamp(storage.folder)
+        written = cls._written(path)
+        graph = written.update(storage.folder, stamp) if written is not None else None
+        if graph is None:
+            graph = cls.from_storage(storage)
+        graph.write(path, stamp)
+        log.info(f"Wrote the graph snapshot {path}")
+        return cls.open(path)
+
+    def postings(self, prefix: str) -> Postings:
+        """Postings of the arrays, e.g. `entities.search.words`"""
+        a = self.arrays
+        return Postings(
+            StringTable(
+                a[f"{prefix}.keys.data"],
+                a[f"{prefix}.keys.offsets"],
+                a[f"{prefix}.keys.order"],
+            ),
+            a[f"{prefix}.offsets"],
+            a[f"{prefix}.items"],
+            a[f"{prefix}.counts"],
+            a[f"{prefix}.totals"],
+        )
+
+    def nbytes(self) -> int:
+        """Size of the arrays, shared with the other workers through the page cache"""
+        return sum(array.nbytes for array in self.arrays.values())
+
+    @property
+    def image_index(self) -> ImageHashIndex:
+        if self._image_index is None:
+            index = ImageHashIndex()
+            for image, value, hashed in zip(
+                self.images,
+                self.arrays["images.hashes"].tolist(),
+                self.arrays["images.hashed"].tolist(),
+            ):
+                if hashed:
+                    index.add(image, value)
+            self._image_index = index
+        return self._image_index
+
+    def node(self, name: str) -> int | None:
+        """The node code of an entity name or image path"""
+        return self.names.find(name)
+
+    def entity_row(self, code: int) -> int | None:
+        """The entity row of a node, None for image and other nodes"""
+        row = int(self.entity_rows[code])
+        return row if row >= 0 and self.image_rows[code] < 0 else None
+
+    def image(self, code: int) -> Image | None:
+        row = int(self.image_rows[code])
+        return self.images[row] if row >= 0 else None
+
+    def edges(self, code: int) -> list[tuple[int, int, int]]:
+        """The (neighbour, relation row, kind) edges of a node"""
+        start, end = int(self.offsets[code]), int(self.offsets[code + 1])
+        return list(
+            zip(
+                self.nodes[start:end].tolist(),
+                self.rows[start:end].tolist(),
+                self.kinds[start:end].tolist(),
+            )
+        )
+
+    def neighbourhood(self, codes: list[int], max_hop: int) -> set[int]:
+        """The nodes within max_hop of the given nodes, breadth first"""
+        seen = set(codes)
+        frontier = list(seen)
+        for _ in range(max_hop):
+            reached = []
+            for code in frontier:
+                start, end = int(self.offsets[code]), int(self.offsets[code + 1])
+                for neighbour in self.nodes[start:end].tolist():
+                    if neighbour not in seen:
+                        seen.add(neighbour)
+                        reached.append(neighbour)
+            if not reached:
+                break
+            frontier = reached
+        return seen
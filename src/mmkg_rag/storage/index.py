@@ -1,16 +1,76 @@
 import os
+import json
 import logging
 import pickle
-from typing import Callable
+import shutil
+import threading
+from typing import Any, Callable, Iterable, Iterator
 from ..types import Entity, Relation, Image
+from .neo4j_sync import SYNC_STATE_FILE, Neo4jSync, database_name
+from .oplog import OpLog
+from .graph_index import GraphIndex
+from .records import EntityRecords, RelationRecords, StringPool
+from .phash import ImageHashIndex
+from .snapshot import (
+    ITEM_ADAPTERS,
+    SECTIONS,
+    SnapshotReader,
+    dump_item,
+    encode_section,
+    write_snapshot,
+)
+from .versions import (
+    collect_versions,
+    folder_lock,
+    new_version,
+    read_current,
+    version_folder,
+    write_current,
+)
 
 log = logging.getLogger("mgrag")
 
+SNAPSHOT_FILE = "storage.snapshot"
+OPLOG_FILE = "storage.oplog"
+# Compact once the log outgrows both limits
+_COMPACT_MIN_BYTES = 4 * 1024 * 1024
+_COMPACT_RATIO = 0.5
+
+# Snapshot section -> the attributes it fills
+_SECTION_ATTRS: dict[str, tuple[str, ...]] = {
+    "entities": ("_entities",),
+    "relations": ("_relations",),
+    "images": ("images",),
+    "image_relations": ("_image_relations",),
+    "indexes": (
+        "documents",
+        "image_hashes",
+        "_name_ids",
+        "_redirects",
+        "_next_id",
+        "_next_relation_id",
+        "_next_chunk_id",
+    ),
+}
+_ATTR_SECTIONS = {a: s for s, attrs in _SECTION_ATTRS.items() for a in attrs}
+_INDEX_MAPS = ("documents", "image_hashes", "name_ids", "redirects")
+_INDEX_VALUES = ("next_id", "next_relation_id", "next_chunk_id")
+
+
+def _item_key(section: str, item) -> Any:
+    """Key of an item in the operation log, images are keyed by path"""
+    return item.path if section == "images" else item.id
+
 
 class MemoryStorage:
     """
     Storage for the data.
     Entities, relations and images are stored in memory.
+    A snapshot is loaded lazily, a section is decoded on first access of its attributes.
+    Saves append the changes since the last save to an operation log,
+    which is replayed on load and compacted into a new snapshot in the background.
+    Snapshots are published as versions of the folder, see `versions`,
+    so a storage keeps reading the version it loaded while a new one is saved.
     """
 
     def __init__(
@@ -18,46 +78,520 @@ class MemoryStorage:
         folder: str,
     ):
         self.folder = folder
+        self._snapshot: SnapshotReader | None = None
+        # Snapshot sections not decoded yet
+        self._pending: set[str] = set()
         # Initialize storage containers
-        self.entities: list[Entity] = []
-        self.relations: list[Relation] = []
+        self._entities: dict[int, Entity] = {}
+        # Relations by their ids, in insertion order
+        self._relations: dict[int, Relation] = {}
         self.images: list[Image] = []
-        self.image_relations: list[Relation] = []
+        self._image_relations: dict[int, Relation] = {}
+        # Document path -> ids of its chunks, chunk ids are unique in a database
+        self.documents: dict[str, list[int]] = {}
+        # Image path -> perceptual hash, the hash index is built on first use
+        self.image_hashes: dict[str, int] = {}
+        self._image_index: ImageHashIndex | None = None
+
+        # Entity ids: name -> id, and merged id -> surviving id
+        self._name_ids: dict[str, int] = {}
+        self._redirects: dict[int, int] = {}
+        self._next_id = 1
+        self._next_relation_id = 1
+        # Unknown for legacy data, found from the used chunk ids on first use
+        self._next_chunk_id: int | None = None
+        # Lookup maps, built on the first query and updated incrementally
+        self._graph: GraphIndex | None = None
+
+        # Persisted state: item key -> fingerprint per section, the last log record,
+        # and the published version it belongs to
+        self._persisted: dict[str, dict] = {}
+        # Keys of the items added, changed or removed since the last save, per section
+        self._dirty: dict[str, set] = {section: set() for section in ITEM_ADAPTERS}
+        self._log_seq = 0
+        self._version: int | None = None
+        # The next save writes a full snapshot instead of the changes
+        self._rewrite = False
+        self._compactor: threading.Thread | None = None
 
         if folder:
             self._load_from_folder(folder)
         else:
             log.info("No folder specified, creating empty storage")
 
+    @property
+    def entities(self) -> list[Entity]:
+        return list(self._entities.values())
+
+    @entities.setter
+    def entities(self, entities: list[Entity]):
+        self._graph = None
+        self._dirty["entities"].update(self._entities)
+        self._entities.clear()
+        self._name_ids.clear()
+        self._redirects.clear()
+        self._next_id = 1 + max(
+            (getattr(e, "id", None) or 0 for e in entities), default=0
+        )
+        self.add_entities(entities)
+        # Endpoint ids of existing relations may point to dropped entities
+        self._bind_relations(self._relations.values())
+        self._bind_relations(self._image_relations.values())
+        self._dirty["relations"].update(self._relations)
+        self._dirty["image_relations"].update(self._image_relations)
+
+    @property
+    def relations(self) -> list[Relation]:
+        return list(self._relations.values())
+
+    @relations.setter
+    def relations(self, relations: list[Relation]):
+        self._graph = None
+        self._dirty["relations"].update(self._relations)
+        self._relations = {}
+        self.add_relations(relations)
+
+    @property
+    def image_relations(self) -> list[Relation]:
+        return list(self._image_relations.values())
+
+    @image_relations.setter
+    def image_relations(self, relations: list[Relation]):
+        self._graph = None
+        self._dirty["image_relations"].update(self._image_relations)
+        self._image_relations = {}
+        self.add_relations(relations, images=True)
+
+    def __getattr__(self, name: str):
+        # Only called for missing attributes, i.e. those of pending sections
+        section = _ATTR_SECTIONS.get(name)
+        if section is None or section not in self.__dict__.get("_pending", ()):
+            raise AttributeError(
+                f"'{type(self).__name__}' object has no attribute '{name}'"
+            )
+        self._load_section(section)
+        return self.__dict__[name]
+
     def _item_path_dict(self, root_folder: str) -> dict:
+        """Legacy pickle files, read when there is no snapshot"""
         return {
             "entities": os.path.join(root_folder, "entities.pkl"),
             "relations": os.path.join(root_folder, "relations.pkl"),
             "images": os.path.join(root_folder, "images.pkl"),
             "image_relations": os.path.join(root_folder, "image_relations.pkl"),
+            "documents": os.path.join(root_folder, "documents.pkl"),
+            "image_hashes": os.path.join(root_folder, "image_hashes.pkl"),
         }
 
     def _load_from_folder(self, folder: str):
-        """Load data from pickle files in the specified folder"""
-        paths = self._item_path_dict(folder)
+        """
+        Load the published version, or the snapshot of the folder before versions,
+        and replay the operation log. Without a snapshot, load the legacy pickle files.
+        """
+        for _ in range(3):
+            current = read_current(folder)
+            if current is None:
+                break
+            try:
+                self._load_snapshot(
+                    version_folder(folder, current["version"]), current["log_seq"]
+                )
+                self._version = current["version"]
+                return
+            except FileNotFoundError:
+                # The version was collected after reading the pointer, read it again
+                log.debug(f"Version {current['version']} of {folder} is gone, retrying")
+        if os.path.exists(os.path.join(folder, SNAPSHOT_FILE)):
+            self._load_snapshot(folder)
+            return
 
+        paths = self._item_path_dict(folder)
         for key, path in paths.items():
             if os.path.exists(path):
                 with open(path, "rb") as f:
                     data = pickle.load(f)
-                    self.__dict__[key] = data
+                if isinstance(data, list):
+                    # Items pickled before a field was added lack it, take its default
+                    data = [type(i).model_construct(**i.__dict__) for i in data]
+                setattr(self, key, data)
 
-    def save_to_folder(self, folder: str | None = None):
-        """Save data to pickle files in the specified folder"""
+    def _load_snapshot(self, folder: str, log_seq: int | None = None):
+        """Load the snapshot of a folder and replay its operation log up to `log_seq`"""
+        snapshot = SnapshotReader(os.path.join(folder, SNAPSHOT_FILE))
+        oplog = OpLog(os.path.join(folder, OPLOG_FILE))
+        if log_seq is not None and log_seq > snapshot.log_seq and not oplog.size():
+            snapshot.close()
+            raise FileNotFoundError(oplog.path)
+        self._snapshot = snapshot
+        for section in snapshot.sections:
+            for attr in _SECTION_ATTRS.get(section, ()):
+                self.__dict__.pop(attr, None)
+            self._pending.add(section)
+        self._log_seq = snapshot.log_seq
+        records = oplog.read(self._log_seq, log_seq)
+        if records:
+            log.info(f"Replaying {len(records)} saves from the operation log")
+        for record in records:
+            self._replay(record)
+
+    def _load_section(self, section: str):
+        assert self._snapshot is not None
+        self._pending.discard(section)
+        data, lines = self._snapshot.load(section)
+        if section == "entities":
+            self._entities = {e.id: e for e in data}
+        elif section == "relations":
+            self._relations = {}
+            # Relations saved before they had ids are written again with theirs
+            self._rewrite |= any(r.id is None for r in data)
+            self._assign_relation_ids(data)
+            self._relations = {r.id: r for r in data}
+        elif section == "images":
+            self.images = data
+        elif section == "image_relations":
+            self._image_relations = {}
+            self._rewrite |= any(r.id is None for r in data)
+            self._assign_relation_ids(data)
+            self._image_relations = {r.id: r for r in data}
+        elif section == "indexes":
+            self.documents = data["documents"]
+            self.image_hashes = data["image_hashes"]
+            self._name_ids = data["name_ids"]
+            self._redirects = dict(data["redirects"])
+            self._next_id = data["next_id"]
+            self._next_relation_id = data.get("next_relation_id", 1)
+            self._next_chunk_id = data.get("next_chunk_id")
+            self._persisted["indexes"] = self._index_state()
+            return
+
+        if lines is None:
+            # Version 1 sections have no item lines to fingerprint
+            self._rewrite = True
+            return
+        self._persisted[section] = {
+            _item_key(section, item): hash(line) for item, line in zip(data, lines)
+        }
+
+    def _section_value(self, section: str):
+        if section == "entities":
+            return list(self._entities.values())
+        if section == "relations":
+            return list(self._relations.values())
+        if section == "images":
+            return self.images
+        if section == "image_relations":
+            return list(self._image_relations.values())
+        return {
+            "documents": self.documents,
+            "image_hashes": self.image_hashes,
+            "name_ids": self._name_ids,
+            "redirects": list(self._redirects.items()),
+            "next_id": self._next_id,
+            "next_relation_id": self._next_relation_id,
+            "next_chunk_id": self._next_chunk_id,
+        }
+
+    def _index_state(self) -> dict:
+        """Copy of the indexes, to find their changes on save"""
+        return {
+            "documents": {k: tuple(v) for k, v in self.documents.items()},
+            "image_hashes": dict(self.image_hashes),
+            "name_ids": dict(self._name_ids),
+            "redirects": dict(self._redirects),
+            "next_id": self._next_id,
+            "next_relation_id": self._next_relation_id,
+            "next_chunk_id": self._next_chunk_id,
+        }
+
+    def _section_items(self, section: str) -> dict:
+        """The items of a list section by their key in the operation log"""
+        if section == "images":
+            return {i.path: i for i in self.images}
+        return {
+            "entities": self._entities,
+            "relations": self._relations,
+            "image_relations": self._image_relations,
+        }[section]
+
+    def mark_changed(self, items: Iterable[Entity | Relation | Image]):
+        """Have the next save write items that were changed in place"""
+        for item in items:
+            if isinstance(item, Entity):
+                self._dirty["entities"].add(item.id)
+            elif isinstance(item, Image):
+                self._dirty["images"].add(item.path)
+            elif item.id in self._image_relations:
+                self._dirty["image_relations"].add(item.id)
+            else:
+                self._dirty["relations"].add(item.id)
+
+    def _changes(self) -> tuple[bytes | None, dict]:
+        """
+        Diff the items changed since the last save, and the indexes,
+        against the persisted state
+
+        Returns:
+            tuple: The encoded log record without its seq, None if nothing changed,
+                and the persisted fingerprints it changes, None for removed items
+        """
+        parts: list[bytes] = []
+        persisted: dict[str, dict] = {}
+        for section in ITEM_ADAPTERS:
+            dirty = self._dirty[section]
+            if section in self._pending or not dirty:
+                continue
+            before = self._persisted.get(section, {})
+            items = self._section_items(section)
+            changed: dict[Any, int | None] = {}
+            put = []
+            # In section order, so a replay keeps the order of the items
+            for key in [k for k in items if k in dirty]:
+                line = dump_item(items[key])
+                if before.get(key) != hash(line):
+                    put.append(line)
+                    changed[key] = hash(line)
+            delete = [k for k in dirty if k not in items and k in before]
+            changed.update(dict.fromkeys(delete))
+            persisted[section] = changed
+            if put or delete:
+                parts.append(
+                    b'"%s":{"delete":%s,"put":[%s]}'
+                    % (section.encode(), json.dumps(delete).encode(), b",".join(put))
+                )
+
+        if "indexes" not in self._pending:
+            before = self._persisted.get("indexes") or {k: {} for k in _INDEX_MAPS}
+            after = self._index_state()
+            changes: dict[str, Any] = {}
+            for name in _INDEX_MAPS:
+                put = [[k, v] for k, v in after[name].items() if before[name].get(k) != v]
+                delete = [k for k in before[name] if k not in after[name]]
+                if put or delete:
+                    changes[name] = {"delete": delete, "put": put}
+            for name in _INDEX_VALUES:
+                if before.get(name) != after[name]:
+                    changes[name] = after[name]
+            persisted["indexes"] = after
+            if changes:
+                parts.append(b'"indexes":' + json.dumps(changes).encode())
+
+        return (b",".join(parts) if parts else None), persisted
+
+    def _replay(self, record: dict):
+        """Apply a save from the operation log"""
+        for section in ITEM_ADAPTERS:
+            if section not in record:
+                continue
+            adapter = ITEM_ADAPTERS[section]
+            delete = set(record[section]["delete"])
+            put = {}
+            for data in record[section]["put"]:
+                item = adapter.validate_python(data)
+                put[_item_key(section, item)] = item
+            if section == "images":
+                images = [
+                    put.pop(i.path, i) for i in self.images if i.path not in delete
+                ]
+                self.images = images + list(put.values())
+            else:
+                items = {
+                    "entities": self._entities,
+                    "relations": self._relations,
+                    "image_relations": self._image_relations,
+                }[section]
+                for key in delete:
+                    items.pop(key, None)
+                items.update(put)
+
+            persisted = self._persisted.setdefault(section, {})
+            for key in delete:
+                persisted.pop(key, None)
+            for key, item in put.items():
+                persisted[key] = hash(dump_item(item))
+
+        changes = record.get("indexes", {})
+        for name in _INDEX_MAPS:
+            if name not in changes:
+                continue
+            target = {
+                "documents": self.documents,
+                "image_hashes": self.image_hashes,
+                "name_ids": self._name_ids,
+                "redirects": self._redirects,
+            }[name]
+            # JSON object keys are strings, redirects are keyed by id
+            cast = int if name == "redirects" else str
+            for key in changes[name]["delete"]:
+                target.pop(cast(key), None)
+            for key, value in changes[name]["put"]:
+                target[cast(key)] = value
+        for name in _INDEX_VALUES:
+            if name in changes:
+                setattr(self, f"_{name}", changes[name])
+        if changes:
+            self._persisted["indexes"] = self._index_state()
+        self._log_seq = record["seq"]
+
+    def save_to_folder(self, folder: str | None = None, export_eris: bool | None = None):
+        """
+        Save data to the specified folder.
+        The changes since the last save are appended to the operation log of the
+        published version, a full snapshot is published as a new version.
+        Items changed in place are only saved once passed to `mark_changed`.
+
+        Args:
+            folder (str, optional): Defaults to the folder of the storage.
+            export_eris (bool, optional): Also export `eris.txt`. Defaults to the env `MMKG_EXPORT_ERIS`.
+        """
         save_folder = folder or self.folder
         os.makedirs(save_folder, exist_ok=True)
 
-        paths = self._item_path_dict(save_folder)
-        for key, path in paths.items():
-            with open(path, "wb") as f:
-                pickle.dump(self.__dict__[key], f)
+        if save_folder != self.folder or self._rewrite or self._version is None:
+            self._write_snapshot(save_folder)
+        elif not self._append_changes():
+            self._write_snapshot(save_folder)
+
+        if export_eris is None:
+            export_eris = os.environ.get("MMKG_EXPORT_ERIS", "").lower() in (
+                "1",
+                "true",
+                "yes",
+            )
+        if export_eris:
+            self.export_eris(save_folder)
+
+    def _write_snapshot(self, folder: str, compacting: bool = False):
+        """
+        Write a full snapshot and publish it as a new version.
+        Sections that were never loaded are copied without decoding.
+
+        Args:
+            folder (str): The storage folder.
+            compacting (bool): Drop the snapshot when another version was published meanwhile.
+        """
+        if self._compactor is not None:
+            self._compactor.join()
+        sections = {}
+        for section in SECTIONS:
+            if section in self._pending:
+                assert self._snapshot is not None
+                sections[section] = self._snapshot.read_section(section)
+            else:
+                sections[section] = encode_section(
+                    section, self._section_value(section)
+                )
+        with folder_lock(folder):
+            version, path = new_version(folder)
+        write_snapshot(os.path.join(path, SNAPSHOT_FILE), sections, self._log_seq)
+
+        with folder_lock(folder):
+            current = read_current(folder) if folder == self.folder else None
+            log_seq = self._log_seq
+            if current is not None and current["version"] == self._version:
+                # Saves appended to the loaded version meanwhile move to the new one
+                old_log = OpLog(os.path.join(version_folder(folder, self._version), OPLOG_FILE))
+                records = old_log.read(self._log_seq, current["log_seq"])
+                OpLog(os.path.join(path, OPLOG_FILE)).append(
+                    [json.dumps(r, ensure_ascii=False).encode("utf-8") for r in records]
+                )
+                log_seq = current["log_seq"]
+            elif current is not None and compacting:
+                shutil.rmtree(path, ignore_errors=True)
+                log.info(f"Dropped the compaction of {folder}, a new version was saved")
+                return
+            write_current(folder, version, log_seq)
+            # The snapshot and log from before versions
+            for name in (SNAPSHOT_FILE, OPLOG_FILE):
+                if os.path.exists(os.path.join(folder, name)):
+                    os.remove(os.path.join(folder, name))
+            collect_versions(folder)
+        log.debug(f"Published version {version} of {folder}")
+        if folder != self.folder:
+            return
+
+        self._version = version
+        self._log_seq = log_seq
+        for section, encoded in sections.items():
+            if section == "indexes" and section not in self._pending:
+                self._persisted[section] = self._index_state()
+            elif encoded["lines"] is not None:
+                self._persisted[section] = {
+                    _item_key(section, item): hash(line)
+                    for item, line in zip(self._section_value(section), encoded["lines"])
+                }
+        for dirty in self._dirty.values():
+            dirty.clear()
+        self._rewrite = False
+
+    def _append_changes(self) -> bool:
+        """
+        Append the changes to the log of the published version and publish them.
+
+        Returns:
+            bool: False if the published version moved on, a full snapshot is needed
+        """
+        record, persisted = self._changes()
+        if record is None:
+            self._apply_persisted(persisted)
+            return True
+        with folder_lock(self.folder):
+            current = read_current(self.folder)
+            # A compaction of our saves publishes a new version at the same log record
+            if current is None or current["log_seq"] != self._log_seq:
+                log.warning(f"{self.folder} was saved by another storage, rewriting it")
+                return False
+            self._version = current["version"]
+            path = version_folder(self.folder, self._version)
+            oplog = OpLog(os.path.join(path, OPLOG_FILE))
+            oplog.append([b'{"seq":%d,%s}' % (self._log_seq + 1, record)])
+            self._log_seq += 1
+            write_current(self.folder, self._version, self._log_seq)
+        self._apply_persisted(persisted)
+
+        snapshot_size = os.path.getsize(os.path.join(path, SNAPSHOT_FILE))
+        if oplog.size() > max(_COMPACT_MIN_BYTES, snapshot_size * _COMPACT_RATIO):
+            self.compact()
+        return True
+
+    def _apply_persisted(self, persisted: dict):
+        """Record the changes of a written log record as persisted"""
+        for section, changed in persisted.items():
+            if section == "indexes":
+                self._persisted[section] = changed
+                continue
+            fingerprints = self._persisted.setdefault(section, {})
+            for key, fingerprint in changed.items():
+                if fingerprint is None:
+                    fingerprints.pop(key, None)
+                else:
+                    fingerprints[key] = fingerprint
+            self._dirty[section].clear()
+
+    def compact(self, background: bool = True):
+        """
+        Fold the operation log into a new snapshot.
+        The snapshot is rebuilt from the published version, so saves can go on meanwhile.
+        """
+        if self._compactor is not None and self._compactor.is_alive():
+            return
 
-        with open(self.folder + "/eris.txt", "w", encoding="utf-8") as f:
+        def run():
+            try:
+                storage = MemoryStorage(self.folder)
+                storage._write_snapshot(self.folder, compacting=True)
+                log.info(f"Compacted the operation log of {self.folder}")
+            except Exception as e:
+                log.warning(f"Failed to compact the operation log of {self.folder}: {e}")
+
+        if not background:
+            run()
+            return
+        self._compactor = threading.Thread(target=run, name="storage-compaction")
+        self._compactor.start()
+
+    def export_eris(self, folder: str):
+        """Export entities, relations and images to a readable `eris.txt` JSON lines dump"""
+        with open(os.path.join(folder, "eris.txt"), "w", encoding="utf-8") as f:
             f.write("# Entities\n")
             f.write("\n".join([e.model_dump_json() for e in self.entities]))
             f.write("\n\n# Relations\n")
@@ -67,31 +601,179 @@ class MemoryStorage:
             f.write("\n\n# Image Relations\n")
             f.write("\n".join([r.model_dump_json() for r in self.image_relations]))
 
-        if os.environ.get("NEO4J_URL"):
-            self.save_to_neo4j(
-                os.environ.get("NEO4J_URL"),
-                os.environ.get("NEO4J_USER"),
-                os.environ.get("NEO4J_PASSWORD"),
-            )
+    def iter_lines(self, section: str) -> Iterator[bytes]:
+        """
+        The JSON line of every item of a list section, as in a snapshot.
+        Sections that were not loaded are streamed from the snapshot without decoding.
+        """
+        if (
+            section in self._pending
+            and self._snapshot is not None
+            and self._snapshot.sections[section].get("codec") == "zlib-lines"
+        ):
+            yield from self._snapshot.iter_lines(section)
+            return
+        for item in self._section_value(section):
+            yield dump_item(item)
 
     def add_entities(self, entities: list[Entity]):
         if not entities:
             return
-        self.entities.extend(entities)
+        for e in entities:
+            if getattr(e, "id", None) is None or (
+                e.id in self._entities and self._entities[e.id] is not e
+            ):
+                e.id = self._next_id
+            self._next_id = max(self._next_id, e.id + 1)
+            self._entities[e.id] = e
+            self._dirty["entities"].add(e.id)
+            self._name_ids.setdefault(e.name, e.id)
+            if self._graph is not None:
+                self._graph.add_entity(e)
 
     def add_relations(self, relations: list[Relation], images: bool = False):
         # Only add new relations
         if not relations:
             return
-        if images:
-            self.image_relations.extend(relations)
-        else:
-            self.relations.extend(relations)
+        self._assign_relation_ids(relations)
+        self._bind_relations(relations)
+        target = self._image_relations if images else self._relations
+        dirty = self._dirty["image_relations" if images else "relations"]
+        for r in relations:
+            target[r.id] = r
+            dirty.add(r.id)
+            if self._graph is None:
+                continue
+            if images:
+                self._graph.add_image_relation(r)
+            else:
+                self._graph.add_relation(r)
 
     def add_images(self, images: list[Image]):
         if not images:
             return
         self.images.extend(images)
+        for image in images:
+            self._dirty["images"].add(image.path)
+            if self._image_index is not None:
+                self._add_image_hash(image)
+            if self._graph is not None:
+                self._graph.add_image(image)
+
+    def records(self) -> tuple[EntityRecords, RelationRecords, RelationRecords]:
+        """
+        Compact records of the entities, relations and image relations.
+        Sections that were not loaded are read from the snapshot lines without validation.
+
+        Returns:
+            tuple: The entity, relation and image relation records, sharing one name pool
+        """
+        names = StringPool()
+        records = []
+        for section, record_class in (
+            ("entities", EntityRecords),
+            ("relations", RelationRecords),
+            ("image_relations", RelationRecords),
+        ):
+            lines = None
+            if section in self._pending:
+                assert self._snapshot is not None
+                lines = self._snapshot.read_lines(section)
+            if lines is not None:
+                # One decode call for the section is faster than one per line
+                items = iter(json.loads(b"[" + b",".join(lines) + b"]"))
+            else:
+                items = iter(self._section_value(section))
+            records.append(record_class.from_items(items, names))
+        return records[0], records[1], records[2]
+
+    @property
+    def graph(self) -> GraphIndex:
+        """Alias, label, adjacency and image maps, built on first use"""
+        if self._graph is None:
+            graph = GraphIndex()
+            for e in self._entities.values():
+                graph.add_entity(e)
+            for r in self._relations.values():
+                graph.add_relation(r)
+            for i in self.images:
+                graph.add_image(i)
+            for r in self._image_relations.values():
+                graph.add_image_relation(r)
+            self._graph = graph
+        return self._graph
+
+    def remove_entities(self, names: list[str]):
+        """Remove entities and their relations"""
+        graph = self.graph
+        removed = set()
+        for name in names:
+            entity_id = self.entity_id(name)
+            entity = self._entities.pop(entity_id, None) if entity_id else None
+            if entity is None:
+                continue
+            removed.add(entity_id)
+            self._dirty["entities"].add(entity_id)
+            graph.remove_entity(entity)
+            self.remove_relations(
+                list(graph.out_relations.get(entity_id, {}).values())
+                + list(graph.in_relations.get(entity_id, {}).values())
+            )
+            self.remove_relations(
+                list(graph.entity_image_relations.get(entity_id, {}).values()),
+                images=True,
+            )
+        # Names of the removed entities, including those merged into them
+        for name, entity_id in list(self._name_ids.items()):
+            if self.resolve_id(entity_id) in removed:
+                del self._name_ids[name]
+
+    def remove_relations(self, relations: list[Relation], images: bool = False):
+        target = self._image_relations if images else self._relations
+        dirty = self._dirty["image_relations" if images else "relations"]
+        for r in relations:
+            if target.pop(r.id, None) is None:
+                continue
+            dirty.add(r.id)
+            if self._graph is None:
+                continue
+            if images:
+                self._graph.remove_image_relation(r)
+            else:
+                self._graph.remove_relation(r)
+
+    def remove_images(self, paths: list[str]):
+        """Remove images and their relations"""
+        graph = self.graph
+        paths = set(paths)
+        for path in paths:
+            image = graph.images.get(path)
+            if image is None:
+                continue
+            graph.remove_image(image)
+            self.remove_relations(
+                list(graph.image_relations.get(path, {}).values()), images=True
+            )
+            self.image_hashes.pop(path, None)
+            if self._image_index is not None:
+                self._image_index.remove(path)
+        self.images = [i for i in self.images if i.path not in paths]
+        self._dirty["images"].update(paths)
+
+    @property
+    def image_index(self) -> ImageHashIndex:
+        """Perceptual hash index over the images, for near-duplicate lookup"""
+        if self._image_index is None:
+            self._image_index = ImageHashIndex()
+            for image in self.images:
+                self._add_image_hash(image)
+        return self._image_index
+
+    def _add_image_hash(self, image: Image):
+        assert self._image_index is not None
+        value = self._image_index.add(image, self.image_hashes.get(image.path))
+        if value is not None:
+            self.image_hashes[image.path] = value
 
     def get_entities(
         self, wheres: Callable[[Entity], bool] = lambda x: True
@@ -108,86 +790,236 @@ class MemoryStorage:
     ) -> list[Image]:
         return [i for i in self.images if wheres(i)]
 
+    def register_document(self, path: str, num_chunks: int) -> list[int]:
+        """
+        Allocate database-wide chunk ids for a document
+        Returns the ids of its chunks, in order
+        """
+        if self._next_chunk_id is None:
+            used = [c for ids in self.documents.values() for c in ids] + [
+                c for e in self._entities.values() for c in e.chunks or []
+            ]
+            self._next_chunk_id = max(used, default=0) + 1
+        first = self._next_chunk_id
+        chunk_ids = list(range(first, first + num_chunks))
+        self._next_chunk_id = first + num_chunks
+        self.documents.setdefault(path, []).extend(chunk_ids)
+        return chunk_ids
+
+    def remove_document(self, path: str) -> dict[str, int]:
+        """
+        Retract what a document contributed, by the chunk provenance of the items.
+        Items only found in its chunks are removed, with the relations of removed
+        entities. Images are kept while other image relations link them. Items also
+        found in other chunks keep their remaining chunks, their merged descriptions
+        are kept. Relations without provenance are only removed with their entities,
+        images without provenance once they are left without relations.
+
+        Returns:
+            dict[str, int]: The number of removed entities, relations, images and image relations
+        """
+        chunk_ids = set(self.documents.pop(path, []))
+        removed = {"entities": 0, "relations": 0, "images": 0, "image_relations": 0}
+        if not chunk_ids:
+            log.warning(f"Document {path} is not in the storage")
+            return removed
+
+        def retract(item: Entity | Relation | Image) -> bool:
+            """Drop the chunks of the document, True if nothing else is left"""
+            if not item.chunks or chunk_ids.isdisjoint(item.chunks):
+                return False
+            item.chunks = [c for c in item.chunks if c not in chunk_ids]
+            self.mark_changed([item])
+            return not item.chunks
+
+        before = {section: len(getattr(self, section)) for section in removed}
+        # Images without provenance go once they lose all their relations
+        linked = {r.target for r in self._image_relations.values()}
+        linked -= {i.path for i in self.images if i.chunks}
+        retracted = {i.path for i in self.images if retract(i)}
+        self.remove_entities([e.name for e in list(self._entities.values()) if retract(e)])
+        self.remove_relations([r for r in self._relations.values() if retract(r)])
+        self.remove_relations(
+            [r for r in self._image_relations.values() if retract(r)], images=True
+        )
+        orphans = (linked | retracted) - {
+            r.target for r in self._image_relations.values()
+        }
+        self.remove_images(list(orphans))
+        for item in list(self._entities.values()) + list(self._relations.values()):
+            if item.images and not orphans.isdisjoint(item.images):
+                item.images = [i for i in item.images if i not in orphans]
+                self.mark_changed([item])
+        for section in removed:
+            removed[section] = before[section] - len(getattr(self, section))
+        log.info(f"Removed document {path}: {removed}")
+        return removed
+
     def clear(self):
-        self.entities.clear()
-        self.relations.clear()
-        self.images.clear()
-        self.image_relations.clear()
+        self._pending.clear()
+        self._entities = {}
+        self._relations = {}
+        self.images = []
+        self._image_relations = {}
+        self.documents = {}
+        self.image_hashes = {}
+        self._image_index = None
+        self._name_ids = {}
+        self._redirects = {}
+        self._next_id = 1
+        self._next_relation_id = 1
+        self._next_chunk_id = 1
+        self._graph = None
+        for dirty in self._dirty.values():
+            dirty.clear()
+        # Pending sections are dropped without knowing their items
+        self._rewrite = True
+
+    def entity_id(self, name: str) -> int | None:
+        """Get the id of the entity with the given name"""
+        entity_id = self._name_ids.get(name)
+        return None if entity_id is None else self.resolve_id(entity_id)
+
+    def resolve_id(self, entity_id: int) -> int:
+        """Follow merge redirects to the id of the surviving entity"""
+        root = entity_id
+        while root in self._redirects:
+            root = self._redirects[root]
+        # Path compression keeps later lookups constant time
+        while entity_id != root:
+            self._redirects[entity_id], entity_id = root, self._redirects[entity_id]
+        return root
+
+    def get_entity(self, entity_id: int) -> Entity | None:
+        return self._entities.get(self.resolve_id(entity_id))
+
+    def get_entity_by_name(self, name: str) -> Entity | None:
+        entity_id = self.entity_id(name)
+        return None if entity_id is None else self._entities.get(entity_id)
+
+    def get_entities_by_alias(self, alias: str) -> list[Entity]:
+        return [self._entities[i] for i in self.graph.aliases.get(alias, ())]
+
+    def get_entities_by_label(self, label: str) -> list[Entity]:
+        return [self._entities[i] for i in self.graph.labels.get(label, ())]
 
     def get_entity_relations(self, entity_name: str) -> list[Relation]:
-        """Get relations for a given entity"""
+        """Get incoming and outgoing relations for a given entity"""
+        entity_id = self.entity_id(entity_name)
+        if entity_id is None:
+            return []
+        relations = dict(self.graph.out_relations.get(entity_id, {}))
+        relations.update(self.graph.in_relations.get(entity_id, {}))
+        return list(relations.values())
+
+    def get_neighbours(
+        self,
+        entity_name: str,
+        label: str | None = None,
+        relation_label: str | None = None,
+    ) -> list[Entity]:
+        """
+        Get the entities related to an entity in either direction
+
+        Args:
+            label (str, optional): Only neighbours with this label
+            relation_label (str, optional): Only neighbours through relations with this label
+        """
+        entity_id = self.entity_id(entity_name)
+        neighbours: dict[int, Entity] = {}
+        for r in self.get_entity_relations(entity_name):
+            if relation_label is not None and r.label != relation_label:
+                continue
+            other_id = r.target_id if r.source_id == entity_id else r.source_id
+            other = self._entities.get(other_id) if other_id is not None else None
+            if other is not None and (label is None or other.label == label):
+                neighbours[other_id] = other
+        return list(neighbours.values())
+
+    def get_relations_between(self, source: str, target: str) -> list[Relation]:
+        """Get the relations from one entity to another"""
+        source_id, target_id = self.entity_id(source), self.entity_id(target)
+        if source_id is None or target_id is None:
+            return []
         return [
             r
-            for r in self.relations
-            if r.source == entity_name or r.source == entity_name
+            for r in self.graph.out_relations.get(source_id, {}).values()
+            if r.target_id == target_id
         ]
 
+    def get_image(self, path: str) -> Image | None:
+        return self.graph.images.get(path)
+
+    def get_image_relations(self, path: str) -> list[Relation]:
+        """Get the relations from entities to an image"""
+        return list(self.graph.image_relations.get(path, {}).values())
+
     def deduplicate(self, entities: list[Entity], merged_entity: Entity):
         """
         Deduplicate entities and merge their properties
-        merge the entities into one entity and update related relations
-        """
-        old_entity_names = [e.name for e in entities]
-        for r in self.relations:
-            if r.source in old_entity_names:
-                r.source = merged_entity.name
-            if r.target in old_entity_names:
-                r.target = merged_entity.name
+        merge the entities into one entity, old ids are redirected to the merged one
+        """
+        graph = self.graph
+        merged_entity.id = None
+        self.add_entities([merged_entity])
+        assert merged_entity.id is not None
         for e in entities:
-            self.entities.remove(e)
-        self.entities.append(merged_entity)
+            old_id = self.resolve_id(e.id) if e.id is not None else None
+            if old_id is None or old_id == merged_entity.id:
+                continue
+            old = self._entities.pop(old_id, None)
+            self._dirty["entities"].add(old_id)
+            self._redirects[old_id] = merged_entity.id
+            self._name_ids[e.name] = merged_entity.id
+            if old is not None:
+                graph.remove_entity(old)
+            # Only the incident relations are moved to the merged entity
+            for relations, end in (
+                (graph.out_relations.get(old_id, {}), "source"),
+                (graph.in_relations.get(old_id, {}), "target"),
+                (graph.entity_image_relations.get(old_id, {}), "source"),
+            ):
+                for r in list(relations.values()):
+                    image = r.id in self._image_relations
+                    if image:
+                        graph.remove_image_relation(r)
+                    else:
+                        graph.remove_relation(r)
+                    setattr(r, f"{end}_id", merged_entity.id)
+                    setattr(r, end, merged_entity.name)
+                    self.mark_changed([r])
+                    if image:
+                        graph.add_image_relation(r)
+                    else:
+                        graph.add_relation(r)
+        self._name_ids[merged_entity.name] = merged_entity.id
 
-    def save_to_neo4j(self, url: str, user: str, password: str) -> bool:
+    def _assign_relation_ids(self, relations: Iterable[Relation]):
+        """Give new relations an id, relations keep an id no other relation holds"""
+        for r in relations:
+            # Relations pickled before they had ids lack the attribute
+            relation_id = getattr(r, "id", None)
+            holder = self._relations.get(relation_id) or self._image_relations.get(
+                relation_id
+            )
+            if relation_id is None or (holder is not None and holder is not r):
+                r.id = self._next_relation_id
+            self._next_relation_id = max(self._next_relation_id, r.id + 1)
 
-        from neo4j import Driver, GraphDatabase
-
-        with GraphDatabase.driver(url, auth=(user, password)) as driver:
-            with driver.session() as session:
-                # Clear the database
-                session.run("MATCH (n) DETACH DELETE n")
-
-                # Add entities
-                for entity in self.entities:
-                    session.run(
-                        "CREATE (n:Entity {name: $name, label: $label, description: $description, aliases: $aliases, references: $references})",
-                        name=entity.name,
-                        label=entity.label,
-                        description=entity.description,
-                        aliases=entity.aliases,
-                        references=entity.references,
-                    )
-
-                # Add relations
-                for relation in self.relations:
-                    session.run(
-                        "MATCH (source:Entity {name: $source}), (target:Entity {name: $target}) CREATE (source)-[:RELATION {label: $label, description: $description, references: $references}]->(target)",
-                        source=relation.source,
-                        target=relation.target,
-                        label=relation.label,
-                        description=relation.description,
-                        references=relation.references,
-                    )
-
-                # Add image entity
-                # image properties: path, caption, description, texts
-                for image in self.images:
-                    session.run(
-                        "CREATE (n:Image {path: $path, caption: $caption, description: $description, texts: $texts})",
-                        path=image.path,
-                        caption=image.caption,
-                        description=image.description,
-                        texts=image.texts,
-                    )
-
-                # Add image relations
-                for relation in self.image_relations:
-                    session.run(
-                        "MATCH (source:Entity {name: $source}), (target:Image {path: $target}) CREATE (source)-[:RELATION {label: $label, description: $description, references: $references}]->(target)",
-                        source=relation.source,
-                        target=relation.target,
-                        label=relation.label,
-                        description=relation.description,
-                        references=relation.references,
-                    )
+    def _bind_relations(self, relations: Iterable[Relation]):
+        """Resolve the endpoint ids of relations from their entity names"""
+        for r in relations:
+            r.source_id = self.entity_id(r.source)
+            r.target_id = self.entity_id(r.target)
 
+    def save_to_neo4j(self, url: str, user: str, password: str) -> bool:
+        """Replace the graph in Neo4j with the storage, see `Neo4jSync` for incremental syncs"""
+        state_path = os.path.join(self.folder, SYNC_STATE_FILE) if self.folder else None
+        Neo4jSync(
+            url,
+            user,
+            password,
+            state_path=state_path,
+            database=database_name(self.folder),
+        ).sync(self, full=True)
         return True
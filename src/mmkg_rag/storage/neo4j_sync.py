@@ -0,0 +1,351 @@
+import os
+import json
+import logging
+import threading
+from typing import Any
+
+from ..utils import md5
+
+log = logging.getLogger("mgrag")
+
+SYNC_STATE_FILE = "neo4j_sync.json"
+# States of other versions are not diffed against, the graph is sent again
+_STATE_VERSION = 3
+
+# Databases share the graph, every node and relation holds the name of its database
+SCHEMA = [
+    # Entities were keyed by name, and nodes were not scoped by database, before
+    "DROP CONSTRAINT entity_name IF EXISTS",
+    "DROP CONSTRAINT image_path IF EXISTS",
+    "CREATE CONSTRAINT entity_key IF NOT EXISTS FOR (n:Entity) "
+    + "REQUIRE (n.database, n.id) IS UNIQUE",
+    "CREATE CONSTRAINT image_key IF NOT EXISTS FOR (n:Image) "
+    + "REQUIRE (n.database, n.path) IS UNIQUE",
+    "CREATE INDEX entity_name_lookup IF NOT EXISTS FOR (n:Entity) ON (n.name)",
+    "CREATE INDEX relation_id IF NOT EXISTS FOR ()-[r:RELATION]-() ON (r.id)",
+    "CREATE FULLTEXT INDEX entity_text IF NOT EXISTS FOR (n:Entity) ON EACH [n.name, n.alias_text]",
+    "CREATE FULLTEXT INDEX image_text IF NOT EXISTS FOR (n:Image) ON EACH [n.caption, n.text_snippets]",
+]
+# Nodes without a database were written before the graph was shared, they go too
+_CLEAR = (
+    "MATCH (n) WHERE (n:Entity OR n:Image) "
+    + "AND (n.database = $database OR n.database IS NULL) WITH n LIMIT $limit "
+    + "DETACH DELETE n RETURN count(n) AS deleted"
+)
+_DELETE_RELATIONS = (
+    "UNWIND $keys AS id "
+    + "MATCH ()-[r:RELATION {database: $database, id: id}]->() DELETE r"
+)
+_DELETE = {
+    "relations": _DELETE_RELATIONS,
+    "image_relations": _DELETE_RELATIONS,
+    "entities": "UNWIND $keys AS id "
+    + "MATCH (n:Entity {database: $database, id: id}) DETACH DELETE n",
+    "images": "UNWIND $keys AS path "
+    + "MATCH (n:Image {database: $database, path: path}) DETACH DELETE n",
+}
+# Relations whose endpoints are missing are not written, the ids of the written ones
+# are returned
+_PUT = {
+    "entities": "UNWIND $rows AS row "
+    + "MERGE (n:Entity {database: $database, id: row.id}) SET n += row",
+    "images": "UNWIND $rows AS row "
+    + "MERGE (n:Image {database: $database, path: row.path}) SET n += row",
+    "relations": "UNWIND $rows AS row "
+    + "MATCH (s:Entity {database: $database, id: row.source_id}), "
+    + "(t:Entity {database: $database, id: row.target_id}) "
+    + "MERGE (s)-[r:RELATION {id: row.props.id}]->(t) "
+    + "SET r += row.props, r.database = $database RETURN collect(r.id) AS written",
+    "image_relations": "UNWIND $rows AS row "
+    + "MATCH (s:Entity {database: $database, id: row.source_id}), "
+    + "(t:Image {database: $database, path: row.target}) "
+    + "MERGE (s)-[r:RELATION {id: row.props.id}]->(t) "
+    + "SET r += row.props, r.database = $database RETURN collect(r.id) AS written",
+}
+_RELATION_KINDS = ("relations", "image_relations")
+# Relations go before the nodes they are attached to when deleting, after them when writing
+_DELETE_ORDER = ("relations", "image_relations", "entities", "images")
+_PUT_ORDER = ("entities", "images", "relations", "image_relations")
+
+# One sync at a time per state file
+_LOCKS: dict[str, threading.Lock] = {}
+_LOCKS_GUARD = threading.Lock()
+
+
+def database_name(folder: str | None) -> str:
+    """The name of a database in the shared graph, the name of its folder"""
+    return os.path.basename(os.path.normpath(folder)) if folder else "default"
+
+
+def _rows(storage) -> dict[str, dict[str, dict]]:
+    """Neo4j rows of every item of a storage, by item key"""
+    relation_kinds = {
+        "relations": storage.relations,
+        "image_relations": storage.image_relations,
+    }
+    image_hashes = storage.image_hashes
+    rows: dict[str, dict[str, dict]] = {
+        "entities": {
+            str(e.id): {
+                "id": e.id,
+                "name": e.name,
+                "label": e.label,
+                "description": e.description,
+                "aliases": e.aliases,
+                "references": e.references,
+                # Full-text indexes only cover string properties
+                "alias_text": " ".join(e.aliases or []),
+            }
+            for e in storage.entities
+        },
+        "images": {
+            i.path: {
+                "path": i.path,
+                "caption": i.caption,
+                "description": i.description,
+                "texts": i.texts,
+                "text_snippets": " ".join(i.texts or []),
+                # Hashes are unsigned 64-bit, Neo4j integers are signed
+                "phash": (
+                    format(image_hashes[i.path], "016x")
+                    if i.path in image_hashes
+                    else None
+                ),
+            }
+            for i in storage.images
+        },
+    }
+    for kind, relations in relation_kinds.items():
+        rows[kind] = {
+            str(r.id): {
+                "source_id": r.source_id,
+                # Images are keyed by path
+                **(
+                    {"target": r.target}
+                    if kind == "image_relations"
+                    else {"target_id": r.target_id}
+                ),
+                "props": {
+                    "id": r.id,
+                    "label": r.label,
+                    "description": r.description,
+                    "references": r.references,
+                },
+            }
+            for r in relations
+        }
+    return rows
+
+
+class Neo4jSync:
+    """
+    Batched, idempotent export of a storage to Neo4j.
+    Entity ids and image paths are unique and indexed, writes are `UNWIND` batches
+    of `MERGE`, and only the items changed since the last sync are sent.
+    The databases share the graph, a sync only writes and clears the nodes and
+    relations of its `database`.
+    The fingerprints of the synced items are kept in `neo4j_sync.json` of the storage folder.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        user: str | None,
+        password: str | None,
+        batch_size: int = 1000,
+        state_path: str | None = None,
+        database: str = "default",
+    ):
+        self.url = url
+        self.auth = (user, password) if user else None
+        self.batch_size = batch_size
+        self.state_path = state_path
+        self.database = database
+        with _LOCKS_GUARD:
+            self._lock = _LOCKS.setdefault(
+                os.path.abspath(state_path) if state_path else f"{url}#{database}",
+                threading.Lock(),
+            )
+
+    @classmethod
+    def from_env(cls, folder: str | None = None) -> "Neo4jSync | None":
+        """
+        Create the sync from `NEO4J_URI` (or `NEO4J_URL`), `NEO4J_USER`, `NEO4J_PASSWORD`
+        and `NEO4J_BATCH_SIZE`, None if no Neo4j is configured
+        """
+        url = os.environ.get("NEO4J_URI") or os.environ.get("NEO4J_URL")
+        if not url:
+            return None
+        return cls(
+            url,
+            os.environ.get("NEO4J_USER") or os.environ.get("NEO4J_USERNAME"),
+            os.environ.get("NEO4J_PASSWORD"),
+            batch_size=int(os.environ.get("NEO4J_BATCH_SIZE") or 1000),
+            state_path=os.path.join(folder, SYNC_STATE_FILE) if folder else None,
+            database=database_name(folder),
+        )
+
+    def _load_state(self) -> dict[str, dict[str, str]] | None:
+        """The state of the last sync, None if the graph has to be sent again"""
+        if not self.state_path or not os.path.exists(self.state_path):
+            return {}
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            log.warning(f"Invalid Neo4j sync state {self.state_path}, resync all: {e}")
+            return {}
+        if state.pop("version", None) != _STATE_VERSION:
+            log.info(f"Neo4j sync state {self.state_path} is outdated, resync all")
+            return None
+        return state
+
+    def _save_state(self, state: dict[str, dict[str, str]]):
+        if not self.state_path:
+            return
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": _STATE_VERSION, **state}, f)
+        os.replace(tmp_path, self.state_path)
+
+    def changes(self, storage, full: bool = False) -> tuple[dict[str, dict], dict]:
+        """
+        Diff a storage against the last sync
+
+        Returns:
+            tuple: Kind -> {"put": rows, "delete": keys}, and the sync state after they are sent
+        """
+        return self._diff(storage, {} if full else self._load_state() or {})
+
+    def _diff(self, storage, before: dict) -> tuple[dict[str, dict], dict]:
+        changes: dict[str, dict[str, Any]] = {}
+        state: dict[str, dict[str, str]] = {}
+        for kind, rows in _rows(storage).items():
+            synced = before.get(kind, {})
+            after = {
+                key: md5(json.dumps(row, ensure_ascii=False, sort_keys=True))
+                for key, row in rows.items()
+            }
+            changed = [key for key, value in after.items() if synced.get(key) != value]
+            changes[kind] = {
+                "put": [rows[key] for key in changed],
+                "delete": [key for key in synced if key not in after],
+            }
+            if kind in _RELATION_KINDS:
+                # A changed relation is recreated, its endpoints may have changed.
+                # New ones too, a failed send may have written them with other endpoints.
+                changes[kind]["delete"] += changed
+            if kind != "images":
+                changes[kind]["delete"] = [int(key) for key in changes[kind]["delete"]]
+            state[kind] = after
+        return changes, state
+
+    def sync(self, storage, full: bool = False, background: bool = False):
+        """
+        Send the changes of a storage to Neo4j.
+        The diff is taken at once, sending can run in a background thread.
+        One sync runs at a time per state file, from the diff to the end of the send,
+        so a sync waits for the previous one and diffs against the state it saved.
+
+        Args:
+            full (bool, optional): Clear the graph and send every item. Defaults to False.
+            background (bool, optional): Return the sending thread instead of waiting. Defaults to False.
+        """
+        self._lock.acquire()
+        try:
+            before = {} if full else self._load_state()
+            # An outdated state does not tell what the graph holds
+            full = full or before is None
+            changes, state = self._diff(storage, before or {})
+        except BaseException:
+            self._lock.release()
+            raise
+        if not full and not any(c["put"] or c["delete"] for c in changes.values()):
+            self._lock.release()
+            log.info("Neo4j is up to date")
+            return None
+        if not background:
+            self._send(changes, state, full)
+            return None
+        thread = threading.Thread(
+            target=self._send, args=(changes, state, full), name="neo4j-sync"
+        )
+        thread.start()
+        return thread
+
+    def _batches(self, items: list) -> list[list]:
+        return [
+            items[i : i + self.batch_size] for i in range(0, len(items), self.batch_size)
+        ]
+
+    def _send(self, changes: dict[str, dict], state: dict, full: bool):
+        """Send the changes of a sync, then release the lock it holds"""
+        try:
+            self._write(changes, state, full)
+        finally:
+            self._lock.release()
+
+    def _write(self, changes: dict[str, dict], state: dict, full: bool):
+        from neo4j import GraphDatabase
+
+        written: dict[str, set[int]] = {kind: set() for kind in _RELATION_KINDS}
+        try:
+            with GraphDatabase.driver(self.url, auth=self.auth) as driver:
+                with driver.session() as session:
+                    for statement in SCHEMA:
+                        session.run(statement).consume()
+                    while full:
+                        record = session.execute_write(
+                            lambda tx: tx.run(
+                                _CLEAR, limit=self.batch_size, database=self.database
+                            ).single()
+                        )
+                        full = bool(record and record["deleted"])
+                    for kind in _DELETE_ORDER:
+                        for keys in self._batches(changes[kind]["delete"]):
+                            session.execute_write(
+                                lambda tx: tx.run(
+                                    _DELETE[kind], keys=keys, database=self.database
+                                ).consume()
+                            )
+                    for kind in _PUT_ORDER:
+                        for rows in self._batches(changes[kind]["put"]):
+                            if kind not in _RELATION_KINDS:
+                                session.execute_write(
+                                    lambda tx: tx.run(
+                                        _PUT[kind], rows=rows, database=self.database
+                                    ).consume()
+                                )
+                                continue
+                            record = session.execute_write(
+                                lambda tx: tx.run(
+                                    _PUT[kind], rows=rows, database=self.database
+                                ).single()
+                            )
+                            written[kind].update(record["written"] if record else [])
+        except Exception as e:
+            # The state is kept, so the next sync sends these changes again
+            log.error(f"Failed to sync to Neo4j {self.url}: {e}")
+            return
+        for kind in _RELATION_KINDS:
+            # Relations without both endpoints in the graph are sent again next time
+            missed = [
+                row["props"]["id"]
+                for row in changes[kind]["put"]
+                if row["props"]["id"] not in written[kind]
+            ]
+            for relation_id in missed:
+                state[kind].pop(str(relation_id), None)
+            if missed:
+                log.warning(
+                    f"{len(missed)} {kind} were not written to Neo4j, "
+                    + "their endpoints are missing"
+                )
+        self._save_state(state)
+        log.info(
+            f"Synced {self.database} to Neo4j: "
+            + ", ".join(
+                f"{kind} +{len(c['put'])} -{len(c['delete'])}"
+                for kind, c in changes.items()
+            )
+        )
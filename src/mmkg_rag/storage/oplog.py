@@ -0,0 +1,69 @@
+import os
+import json
+import logging
+import threading
+
+log = logging.getLogger("mgrag")
+
+# One lock per log file, shared by every storage of the same folder
+_LOCKS: dict[str, threading.Lock] = {}
+_LOCKS_GUARD = threading.Lock()
+
+
+def _path_lock(path: str) -> threading.Lock:
+    with _LOCKS_GUARD:
+        return _LOCKS.setdefault(os.path.abspath(path), threading.Lock())
+
+
+class OpLog:
+    """
+    Append-only log of storage changes next to the snapshot.
+    Every record is one JSON line with an increasing `seq`,
+    a snapshot includes the records up to its `log_seq`.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = _path_lock(path)
+
+    def size(self) -> int:
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def append(self, lines: list[bytes]):
+        """Append encoded records, flushed to disk before returning"""
+        if not lines:
+            return
+        with self._lock:
+            with open(self.path, "ab") as f:
+                f.write(b"".join(line + b"\n" for line in lines))
+                f.flush()
+                os.fsync(f.fileno())
+
+    def read(self, after_seq: int = 0, upto_seq: int | None = None) -> list[dict]:
+        """
+        Read the records after a sequence number, in order.
+        A record written by a save that crashed before publishing it
+        is replaced by the next record with the same sequence number.
+
+        Args:
+            after_seq (int): Skip the records included in the snapshot.
+            upto_seq (int, optional): Skip the records that were not published yet.
+        """
+        records: dict[int, dict] = {}
+        with self._lock:
+            if not os.path.exists(self.path):
+                return []
+            with open(self.path, "rb") as f:
+                for line_no, line in enumerate(f, start=1):
+                    if not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError as e:
+                        # A crash may leave a truncated last line
+                        log.warning(f"Skip invalid log line {line_no} in {self.path}: {e}")
+                        continue
+                    seq = record["seq"]
+                    if seq > after_seq and (upto_seq is None or seq <= upto_seq):
+                        records[seq] = record
+        return [records[seq] for seq in sorted(records)]
@@ -0,0 +1,68 @@
+from ..types import Image
+from ..utils.image import dhash
+
+
+class ImageHashIndex:
+    """
+    Perceptual hash index over images for near-duplicate lookup.
+    The 64-bit hashes are split into 8 bands of 8 bits, two hashes within
+    a hamming distance of 7 share at least one band (pigeonhole principle),
+    so only the images in matching buckets are compared.
+    """
+
+    BANDS = 8
+    BAND_BITS = 8
+
+    def __init__(self):
+        self.images: dict[str, Image] = {}
+        self.hashes: dict[str, int] = {}
+        self._buckets: list[dict[int, set[str]]] = [{} for _ in range(self.BANDS)]
+
+    def _bands(self, value: int) -> list[int]:
+        mask = (1 << self.BAND_BITS) - 1
+        return [(value >> (i * self.BAND_BITS)) & mask for i in range(self.BANDS)]
+
+    def add(self, image: Image, value: int | None = None) -> int | None:
+        """Add an image, its hash is computed from the file if not given"""
+        if value is None:
+            value = dhash(image.path)
+        if value is None:
+            return None
+        self.remove(image.path)
+        self.images[image.path] = image
+        self.hashes[image.path] = value
+        for bucket, band in zip(self._buckets, self._bands(value)):
+            bucket.setdefault(band, set()).add(image.path)
+        return value
+
+    def remove(self, path: str):
+        value = self.hashes.pop(path, None)
+        self.images.pop(path, None)
+        if value is None:
+            return
+        for bucket, band in zip(self._buckets, self._bands(value)):
+            bucket.get(band, set()).discard(path)
+
+    def find(self, value: int, max_distance: int = 5) -> list[tuple[Image, int]]:
+        """Find images within max_distance of the hash, nearest first"""
+        if max_distance < self.BANDS:
+            paths = set()
+            for bucket, band in zip(self._buckets, self._bands(value)):
+                paths |= bucket.get(band, set())
+        else:
+            paths = set(self.hashes)
+
+        matches = []
+        for path in paths:
+            distance = (self.hashes[path] ^ value).bit_count()
+            if distance <= max_distance:
+                matches.append((self.images[path], distance))
+        return sorted(matches, key=lambda m: m[1])
+
+    def find_image(self, image_path: str, max_distance: int = 5) -> Image | None:
+        """Find the indexed image nearest to the image file"""
+        value = dhash(image_path)
+        if value is None:
+            return None
+        matches = self.find(value, max_distance)
+        return matches[0][0] if matches else None
@@ -0,0 +1,176 @@
+"""
+Inverted indexes over the texts of items, as arrays.
+`Postings` lists the items of every key, e.g. a word or a normalized name,
+so the graph snapshot stores them next to the records and the retrieval
+maps them instead of building them. A save updates them by item, see
+`Postings.update`.
+"""
+
+import re
+from typing import Iterable
+
+import numpy as np
+
+from ..types import Image
+from .records import EntityRecords, StringTable
+
+_WORD = re.compile(r"\w+")
+
+
+def normalize(text: str) -> str:
+    """Case folded, with the whitespace collapsed"""
+    return " ".join(text.casefold().split())
+
+
+def tokenize(text: str) -> list[str]:
+    """The case folded words of a text"""
+    return _WORD.findall(text.casefold())
+
+
+class Postings:
+    """
+    Items by key. The items of key `k` are `items[offsets[k]:offsets[k + 1]]`
+    in item order, with the times the key occurs in each in `counts`.
+    `totals` holds the number of keys of every item, e.g. its length in words.
+    """
+
+    __slots__ = ("keys", "offsets", "items", "counts", "totals")
+
+    def __init__(
+        self,
+        keys: StringTable,
+        offsets: np.ndarray,
+        items: np.ndarray,
+        counts: np.ndarray,
+        totals: np.ndarray,
+    ):
+        self.keys = keys
+        self.offsets = offsets
+        self.items = items
+        self.counts = counts
+        self.totals = totals
+
+    @classmethod
+    def from_keys(cls, keys: Iterable[list[str]]) -> "Postings":
+        """The postings of the keys of every item"""
+        codes: dict[str, int] = {}
+        code = codes.setdefault
+        key_codes: list[int] = []
+        totals: list[int] = []
+        for item_keys in keys:
+            key_codes.extend([code(k, len(codes)) for k in item_keys])
+            totals.append(len(item_keys))
+        items = np.repeat(np.arange(len(totals), dtype=np.int64), totals)
+        return cls._grouped(
+            StringTable.from_strings(list(codes)),
+            np.array(key_codes, dtype=np.int64),
+            items,
+            np.ones(len(items), dtype=np.int64),
+            np.array(totals, dtype=np.uint32),
+        )
+
+    @classmethod
+    def _grouped(
+        cls,
+        keys: StringTable,
+        key_codes: np.ndarray,
+        items: np.ndarray,
+        counts: np.ndarray,
+        totals: np.ndarray,
+    ) -> "Postings":
+        """Postings from (key, item, count) triples, the counts of equal pairs add up"""
+        num_items = max(len(totals), 1)
+        pairs, inverse = np.unique(key_codes * num_items + items, return_inverse=True)
+        counts = np.bincount(inverse, weights=counts, minlength=len(pairs))
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(pairs // num_items, minlength=len(keys)), out=offsets[1:])
+        return cls(
+            keys,
+            offsets,
+            (pairs % num_items).astype(np.uint32),
+            counts.astype(np.uint32),
+            totals,
+        )
+
+    def __len__(self) -> int:
+        return len(self.totals)
+
+    def nbytes(self) -> int:
+        return (
+            self.keys.nbytes()
+            + self.offsets.nbytes
+            + self.items.nbytes
+            + self.counts.nbytes
+            + self.totals.nbytes
+        )
+
+    def span(self, key: str) -> slice | None:
+        """The postings of a key, None for a missing key"""
+        code = self.keys.find(key)
+        if code is None:
+            return None
+        return slice(int(self.offsets[code]), int(self.offsets[code + 1]))
+
+    def update(self, rows: np.ndarray, new: "Postings") -> "Postings":
+        """
+        The postings after a save. The items of `new` are the saved ones, and
+        updated item `i` is the old item `rows[i]` or the saved item
+        `rows[i] - len(self)`. Keys no item uses any more stay until a rebuild.
+        """
+        num_old = len(self)
+        rows = np.asarray(rows, dtype=np.int64)
+        renumber = np.full(num_old + len(new), -1, dtype=np.int64)
+        renumber[rows] = np.arange(len(rows))
+        keys, new_codes = self.keys.extended(new.keys.tolist())
+        key_codes = np.concatenate(
+            [
+                np.repeat(np.arange(len(self.keys)), np.diff(self.offsets)),
+                new_codes[np.repeat(np.arange(len(new.keys)), np.diff(new.offsets))],
+            ]
+        ).astype(np.int64)
+        items = renumber[
+            np.concatenate([self.items, num_old + new.items.astype(np.int64)])
+        ]
+        counts = np.concatenate([self.counts, new.counts]).astype(np.int64)
+        kept = items >= 0
+        totals = np.concatenate([self.totals, new.totals])[rows]
+        return self._grouped(
+            keys, key_codes[kept], items[kept], counts[kept], totals.astype(np.uint32)
+        )
+
+
+def text_postings(
+    texts: list[list[str]], documents: Iterable[str] | None = None
+) -> tuple[Postings, Postings]:
+    """
+    The postings searched by keywords: the normalized texts of the items, and
+    the words of their documents, the texts joined by default
+    """
+    if documents is None:
+        documents = (" ".join(item_texts) for item_texts in texts)
+    return (
+        Postings.from_keys([normalize(t) for t in item_texts] for item_texts in texts),
+        Postings.from_keys(tokenize(d) for d in documents),
+    )
+
+
+def entity_postings(entities: EntityRecords) -> tuple[Postings, Postings]:
+    """The names and aliases of the entities, their words with the descriptions"""
+    texts = entities.all_search_texts()
+    descriptions = entities.all_descriptions()
+    return text_postings(
+        texts, (" ".join(t + [d]) for t, d in zip(texts, descriptions))
+    )
+
+
+def image_search_texts(image: Image) -> list[str]:
+    """The caption and texts of an image"""
+    return [image.caption] + (image.texts or [])
+
+
+def image_postings(images: list[Image]) -> tuple[Postings, Postings]:
+    """The captions and texts of the images, their words with the descriptions"""
+    return text_postings(
+        [image_search_texts(i) for i in images],
+        (" ".join([i.caption, i.description] + (i.texts or [])) for i in images),
+    )
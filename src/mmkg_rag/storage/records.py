@@ -0,0 +1,500 @@
+"""
+Compact columnar records of entities and relations.
+
+Every field is a column: integers in `array`s, labels and names interned
+once in a `StringPool`, descriptions and the rarely read fields packed in
+a `TextArena`. Pydantic models are only built for the rows handed out,
+with `model_construct`, since the records hold already validated data.
+The columns can also be read-only buffers, e.g. numpy views of a memory map,
+with a `StringTable` in place of the pools.
+"""
+
+import sys
+import json
+from array import array
+from itertools import accumulate
+from typing import Any, Iterable, Iterator
+import numpy as np
+from ..types import Entity, Relation
+
+# Fields kept as one JSON blob per row, only decoded when a model is built
+_ENTITY_EXTRAS = ("references", "images", "chunks")
+_RELATION_EXTRAS = ("references", "images", "chunks")
+_NONE = -1
+_dump_extras = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+
+
+def _fields(item: Any) -> dict:
+    """The fields of a model, or its JSON decoded dict"""
+    return item if type(item) is dict else item.__dict__
+
+
+def _extras(data: dict, keys: tuple[str, ...]) -> str | None:
+    extras = {k: v for k in keys if (v := data.get(k)) is not None}
+    return _dump_extras(extras) if extras else None
+
+
+def _optional(value: int | None) -> int:
+    return _NONE if value is None else value
+
+
+def _sizeof_array(values: Any) -> int:
+    return len(values) * values.itemsize
+
+
+class StringPool:
+    """Interned strings by code, equal strings are stored once"""
+
+    __slots__ = ("strings", "_codes")
+
+    def __init__(self):
+        self.strings: list[str] = []
+        self._codes: dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.strings)
+
+    def code(self, value: str) -> int:
+        """The code of a string, added to the pool if new"""
+        code = self._codes.get(value)
+        if code is None:
+            code = len(self.strings)
+            value = sys.intern(value)
+            self.strings.append(value)
+            self._codes[value] = code
+        return code
+
+    def __getitem__(self, code: int) -> str:
+        return self.strings[code]
+
+    def find(self, value: str) -> int | None:
+        return self._codes.get(value)
+
+    def tolist(self) -> list[str]:
+        """The strings by code"""
+        return self.strings
+
+    def nbytes(self) -> int:
+        return (
+            sys.getsizeof(self.strings)
+            + sys.getsizeof(self._codes)
+            + sum(sys.getsizeof(s) for s in self.strings)
+        )
+
+
+class StringTable:
+    """
+    Read-only string pool over packed buffers, strings are decoded on access.
+    `order` lists the codes by their UTF-8 bytes, so a string is found by bisection.
+    """
+
+    __slots__ = ("data", "offsets", "order")
+
+    def __init__(self, data: Any, offsets: Any, order: Any):
+        self.data = data
+        self.offsets = offsets
+        self.order = order
+
+    @classmethod
+    def from_strings(cls, strings: list[str]) -> "StringTable":
+        """Pack strings, returns the table of numpy arrays"""
+        encoded = [s.encode("utf-8") for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.uint64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        order = np.array(
+            sorted(range(len(encoded)), key=encoded.__getitem__), dtype=np.uint32
+        )
+        return cls(np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets, order)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def _bytes(self, code: int) -> bytes:
+        return self.data[int(self.offsets[code]) : int(self.offsets[code + 1])].tobytes()
+
+    def __getitem__(self, code: int) -> str:
+        return self._bytes(code).decode("utf-8")
+
+    def tolist(self) -> list[str]:
+        """The strings by code, decoded at once"""
+        data = bytes(self.data)
+        offsets = np.asarray(self.offsets).tolist()
+        return [
+            data[start:end].decode("utf-8") for start, end in zip(offsets, offsets[1:])
+        ]
+
+    def bisect(self, key: bytes) -> int:
+        """The position in `order` of the first string not below the UTF-8 key"""
+        low, high = 0, len(self.order)
+        while low < high:
+            middle = (low + high) // 2
+            if self._bytes(self.order[middle]) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def find(self, value: str) -> int | None:
+        key = value.encode("utf-8")
+        low = self.bisect(key)
+        if low < len(self.order) and self._bytes(self.order[low]) == key:
+            return int(self.order[low])
+        return None
+
+    def extended(self, strings: list[str]) -> tuple["StringTable", np.ndarray]:
+        """
+        The table with the missing strings appended, the old codes are kept
+
+        Returns:
+            tuple: The table, and the code of every given string
+        """
+        num_old = len(self)
+        codes = np.empty(len(strings), dtype=np.int64)
+        new: dict[bytes, int] = {}
+        positions: list[int] = []
+        for i, value in enumerate(strings):
+            key = value.encode("utf-8")
+            position = self.bisect(key)
+            if position < len(self.order) and self._bytes(self.order[position]) == key:
+                codes[i] = self.order[position]
+            else:
+                if key not in new:
+                    new[key] = num_old + len(new)
+                    positions.append(position)
+                codes[i] = new[key]
+        if not new:
+            return self, codes
+        keys = list(new)
+        offsets = np.asarray(self.offsets, dtype=np.uint64)
+        lengths = np.array([len(key) for key in keys], dtype=np.uint64)
+        # The new strings inserted in the sorted old ones
+        inserted = sorted(range(len(keys)), key=lambda i: (positions[i], keys[i]))
+        order = np.insert(
+            np.asarray(self.order, dtype=np.uint32),
+            [positions[i] for i in inserted],
+            [num_old + i for i in inserted],
+        )
+        table = StringTable(
+            np.concatenate(
+                [np.asarray(self.data), np.frombuffer(b"".join(keys), dtype=np.uint8)]
+            ),
+            np.concatenate([offsets, offsets[-1] + np.cumsum(lengths)]),
+            order.astype(np.uint32),
+        )
+        return table, codes
+
+    def nbytes(self) -> int:
+        return self.data.nbytes + self.offsets.nbytes + self.order.nbytes
+
+
+class TextArena:
+    """Strings packed in one UTF-8 buffer, addressed by their index"""
+
+    __slots__ = ("_data", "_offsets")
+
+    def __init__(self, data: Any = None, offsets: Any = None):
+        # Given buffers are read-only, e.g. numpy views of a memory map
+        self._data = bytearray() if data is None else data
+        self._offsets = array("Q", [0]) if offsets is None else offsets
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def add(self, value: str) -> int:
+        return self.add_all([value])[0]
+
+    def add_all(self, values: "list[str | None]") -> list[int]:
+        """Add strings at once, returns the index of each, -1 for None"""
+        encoded = [v.encode("utf-8") for v in values if v is not None]
+        first = len(self)
+        offsets = accumulate(map(len, encoded), initial=len(self._data))
+        next(offsets)
+        self._offsets.extend(offsets)
+        self._data += b"".join(encoded)
+        indexes = iter(range(first, first + len(encoded)))
+        return [_NONE if v is None else next(indexes) for v in values]
+
+    def get(self, index: int) -> str:
+        start, end = int(self._offsets[index]), int(self._offsets[index + 1])
+        return bytes(self._data[start:end]).decode("utf-8")
+
+    def buffers(self) -> tuple[bytes, array]:
+        """The packed UTF-8 data and the offsets of the strings"""
+        return bytes(self._data), self._offsets
+
+    def nbytes(self) -> int:
+        return len(self._data) + _sizeof_array(self._offsets)
+
+
+class _ArrayRows:
+    """Rows by code over a read-only array, -1 for codes without a row"""
+
+    __slots__ = ("rows",)
+
+    def __init__(self, rows: Any):
+        self.rows = rows
+
+    def get(self, code: int) -> int | None:
+        row = int(self.rows[code]) if code < len(self.rows) else _NONE
+        return None if row == _NONE else row
+
+
+def _from_columns(records, names, labels, texts, columns: dict):
+    records.names, records.labels, records.texts = names, labels, texts
+    for name in records.COLUMNS:
+        setattr(records, name, columns[name])
+    return records
+
+
+class EntityRecords:
+    """Columnar entities, a row per entity in insertion order"""
+
+    COLUMNS = (
+        "ids",
+        "name_codes",
+        "label_codes",
+        "descriptions",
+        "extras",
+        "alias_offsets",
+        "alias_codes",
+    )
+
+    def __init__(self, names: StringPool | None = None):
+        # Shared with the relations, so endpoint names are stored once
+        self.names = names if names is not None else StringPool()
+        self.labels = StringPool()
+        self.texts = TextArena()
+        self.ids = array("q")
+        self.name_codes = array("I")
+        self.label_codes = array("I")
+        self.descriptions = array("q")
+        self.extras = array("q")
+        # Aliases of row i are alias_codes[alias_offsets[i]:alias_offsets[i + 1]]
+        self.alias_offsets = array("I", [0])
+        self.alias_codes = array("I")
+        self._rows: dict[int, int] = {}
+
+    @classmethod
+    def from_items(
+        cls, items: "Iterator[Entity | dict]", names: StringPool | None = None
+    ) -> "EntityRecords":
+        records = cls(names)
+        records.extend(items)
+        return records
+
+    @classmethod
+    def from_columns(
+        cls,
+        names: StringPool | StringTable,
+        labels: StringPool | StringTable,
+        texts: TextArena,
+        columns: dict[str, Any],
+        name_rows: Any,
+    ) -> "EntityRecords":
+        """Records over existing columns, e.g. read-only views of a memory map"""
+        records = _from_columns(cls.__new__(cls), names, labels, texts, columns)
+        records._rows = _ArrayRows(name_rows)
+        return records
+
+    def name_rows(self):
+        """The row of the entity of every name code as an array, -1 for other names"""
+        rows = np.full(len(self.names), _NONE, dtype=np.int64)
+        for code, row in self._rows.items():
+            rows[code] = row
+        return rows
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __iter__(self) -> Iterator[Entity]:
+        return (self.model(row) for row in range(len(self)))
+
+    def append(self, item: "Entity | dict") -> int:
+        """Add an entity model, or its JSON decoded dict, returns its row"""
+        self.extend([item])
+        return len(self.ids) - 1
+
+    def extend(self, items: "Iterable[Entity | dict]"):
+        """Add entity models, or their JSON decoded dicts without validating them"""
+        rows = [_fields(item) for item in items]
+        first = len(self.ids)
+        code = self.names.code
+        name_codes = [code(d["name"]) for d in rows]
+        self.ids.extend([_optional(d.get("id")) for d in rows])
+        self.name_codes.extend(name_codes)
+        self.label_codes.extend([self.labels.code(d["label"]) for d in rows])
+        self.descriptions.extend(self.texts.add_all([d["description"] for d in rows]))
+        self.extras.extend(
+            self.texts.add_all([_extras(d, _ENTITY_EXTRAS) for d in rows])
+        )
+        for d in rows:
+            self.alias_codes.extend([code(alias) for alias in d.get("aliases") or ()])
+            self.alias_offsets.append(len(self.alias_codes))
+        for row, name_code in enumerate(name_codes, start=first):
+            self._rows.setdefault(name_code, row)
+
+    def row(self, name: str) -> int | None:
+        """The row of the entity with a name"""
+        code = self.names.find(name)
+        return None if code is None else self._rows.get(code)
+
+    def name(self, row: int) -> str:
+        return self.names[self.name_codes[row]]
+
+    def label(self, row: int) -> str:
+        return self.labels[self.label_codes[row]]
+
+    def aliases(self, row: int) -> list[str]:
+        start, end = self.alias_offsets[row], self.alias_offsets[row + 1]
+        return [self.names[c] for c in self.alias_codes[start:end]]
+
+    def search_texts(self, row: int) -> list[str]:
+        """The name and aliases of an entity"""
+        return [self.name(row)] + self.aliases(row)
+
+    def all_search_texts(self) -> list[list[str]]:
+        """The name and aliases of every entity, the names decoded once"""
+        names = self.names.tolist()
+        offsets = np.asarray(self.alias_offsets).tolist()
+        codes = np.asarray(self.alias_codes).tolist()
+        return [
+            [names[code]] + [names[c] for c in codes[offsets[row] : offsets[row + 1]]]
+            for row, code in enumerate(np.asarray(self.name_codes).tolist())
+        ]
+
+    def all_descriptions(self) -> list[str]:
+        """The description of every entity"""
+        return [self.texts.get(i) for i in np.asarray(self.descriptions).tolist()]
+
+    def model(self, row: int) -> Entity:
+        extras = self.extras[row]
+        start, end = self.alias_offsets[row], self.alias_offsets[row + 1]
+        entity_id = self.ids[row]
+        return Entity.model_construct(
+            name=self.name(row),
+            label=self.label(row),
+            description=self.texts.get(self.descriptions[row]),
+            aliases=self.aliases(row) if end > start else None,
+            id=None if entity_id == _NONE else int(entity_id),
+            **(json.loads(self.texts.get(extras)) if extras != _NONE else {}),
+        )
+
+    def nbytes(self) -> int:
+        """Memory of the columns, without the shared name pool"""
+        return (
+            self.labels.nbytes()
+            + self.texts.nbytes()
+            + sys.getsizeof(self._rows)
+            + sum(_sizeof_array(getattr(self, c)) for c in self.COLUMNS)
+        )
+
+
+class RelationRecords:
+    """Columnar relations, a row per relation in insertion order"""
+
+    COLUMNS = (
+        "ids",
+        "sources",
+        "targets",
+        "source_ids",
+        "target_ids",
+        "label_codes",
+        "descriptions",
+        "extras",
+    )
+
+    def __init__(self, names: StringPool | None = None):
+        self.names = names if names is not None else StringPool()
+        self.labels = StringPool()
+        self.texts = TextArena()
+        self.ids = array("q")
+        self.sources = array("I")
+        self.targets = array("I")
+        self.source_ids = array("q")
+        self.target_ids = array("q")
+        self.label_codes = array("I")
+        self.descriptions = array("q")
+        self.extras = array("q")
+
+    @classmethod
+    def from_items(
+        cls, items: "Iterator[Relation | dict]", names: StringPool | None = None
+    ) -> "RelationRecords":
+        records = cls(names)
+        records.extend(items)
+        return records
+
+    @classmethod
+    def from_columns(
+        cls,
+        names: StringPool | StringTable,
+        labels: StringPool | StringTable,
+        texts: TextArena,
+        columns: dict[str, Any],
+    ) -> "RelationRecords":
+        """Records over existing columns, e.g. read-only views of a memory map"""
+        return _from_columns(cls.__new__(cls), names, labels, texts, columns)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __iter__(self) -> Iterator[Relation]:
+        return (self.model(row) for row in range(len(self)))
+
+    def append(self, item: "Relation | dict") -> int:
+        """Add a relation model, or its JSON decoded dict, returns its row"""
+        self.extend([item])
+        return len(self.ids) - 1
+
+    def extend(self, items: "Iterable[Relation | dict]"):
+        """Add relation models, or their JSON decoded dicts without validating them"""
+        rows = [_fields(item) for item in items]
+        code = self.names.code
+        self.ids.extend([_optional(d.get("id")) for d in rows])
+        self.source_ids.extend([_optional(d.get("source_id")) for d in rows])
+        self.target_ids.extend([_optional(d.get("target_id")) for d in rows])
+        self.sources.extend([code(d["source"]) for d in rows])
+        self.targets.extend([code(d["target"]) for d in rows])
+        self.label_codes.extend([self.labels.code(d["label"]) for d in rows])
+        self.descriptions.extend(
+            self.texts.add_all([d.get("description") for d in rows])
+        )
+        self.extras.extend(
+            self.texts.add_all([_extras(d, _RELATION_EXTRAS) for d in rows])
+        )
+
+    def source(self, row: int) -> str:
+        return self.names[self.sources[row]]
+
+    def target(self, row: int) -> str:
+        return self.names[self.targets[row]]
+
+    def label(self, row: int) -> str:
+        return self.labels[self.label_codes[row]]
+
+    def model(self, row: int) -> Relation:
+        description, extras = self.descriptions[row], self.extras[row]
+        ids = {
+            name: None if column[row] == _NONE else int(column[row])
+            for name, column in (
+                ("id", self.ids),
+                ("source_id", self.source_ids),
+                ("target_id", self.target_ids),
+            )
+        }
+        return Relation.model_construct(
+            source=self.source(row),
+            target=self.target(row),
+            label=self.label(row),
+            description=None if description == _NONE else self.texts.get(description),
+            **ids,
+            **(json.loads(self.texts.get(extras)) if extras != _NONE else {}),
+        )
+
+    def nbytes(self) -> int:
+        """Memory of the columns, without the shared name pool"""
+        return (
+            self.labels.nbytes()
+            + self.texts.nbytes()
+            + sum(_sizeof_array(getattr(self, c)) for c in self.COLUMNS)
+        )
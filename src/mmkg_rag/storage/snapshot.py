@@ -0,0 +1,210 @@
+"""
+Versioned binary snapshot of a storage.
+
+Layout: magic, header length, JSON header, then the compressed sections.
+The header records the offset, size and item count of every section,
+so each section can be read and decoded on its own.
+List sections hold one JSON item per line, so items can be fingerprinted
+without decoding them.
+"""
+
+import os
+import json
+import zlib
+import shutil
+import struct
+import threading
+from typing import Any, Iterator
+from pydantic import TypeAdapter
+from ..types import Entity, Relation, Image
+
+SNAPSHOT_VERSION = 2
+SNAPSHOT_MAGIC = b"MMKGSNAP"
+_HEADER_LEN = struct.Struct("<I")
+_COMPRESS_LEVEL = 3
+# Read size when streaming a section
+_BLOCK_SIZE = 1 << 20
+
+_ADAPTERS: dict[str, TypeAdapter] = {
+    "entities": TypeAdapter(list[Entity]),
+    "relations": TypeAdapter(list[Relation]),
+    "images": TypeAdapter(list[Image]),
+    "image_relations": TypeAdapter(list[Relation]),
+    "indexes": TypeAdapter(dict[str, Any]),
+}
+ITEM_ADAPTERS: dict[str, TypeAdapter] = {
+    "entities": TypeAdapter(Entity),
+    "relations": TypeAdapter(Relation),
+    "images": TypeAdapter(Image),
+    "image_relations": TypeAdapter(Relation),
+}
+SECTIONS = tuple(_ADAPTERS)
+
+
+def dump_item(item) -> bytes:
+    """JSON line of an item, the same bytes as in a snapshot section"""
+    return item.__pydantic_serializer__.to_json(item)
+
+
+def section_compressor():
+    """Compressor of a section payload, for sections encoded as a stream"""
+    return zlib.compressobj(_COMPRESS_LEVEL)
+
+
+def encode_section(name: str, value: Any) -> dict:
+    """
+    Serialise and compress the value of a section
+
+    Returns:
+        dict: The compressed payload with its codec, item count and raw size,
+            and the JSON line of every item for list sections
+    """
+    lines = None
+    if name in ITEM_ADAPTERS:
+        lines = [dump_item(v) for v in value]
+        raw, codec = b"\n".join(lines), "zlib-lines"
+    else:
+        raw, codec = _ADAPTERS[name].dump_json(value), "zlib"
+    return {
+        "payload": zlib.compress(raw, _COMPRESS_LEVEL),
+        "codec": codec,
+        "count": len(value),
+        "raw_size": len(raw),
+        "lines": lines,
+    }
+
+
+def write_snapshot(path: str, sections: dict[str, dict], log_seq: int = 0):
+    """
+    Write encoded sections to a snapshot file, atomically replacing the old one
+
+    Args:
+        path (str): The path of the snapshot file
+        sections (dict[str, dict]): Section name -> result of `encode_section`.
+            The payload may also be a binary file of `size` bytes, copied without reading it at once.
+        log_seq (int, optional): The last operation log record included in the snapshot
+    """
+    header: dict[str, Any] = {
+        "version": SNAPSHOT_VERSION,
+        "log_seq": log_seq,
+        "sections": {},
+    }
+    offset = 0
+    for name, section in sections.items():
+        size = section["size"] if "size" in section else len(section["payload"])
+        header["sections"][name] = {
+            "offset": offset,
+            "size": size,
+            "count": section["count"],
+            "raw_size": section["raw_size"],
+            "codec": section["codec"],
+        }
+        offset += size
+    header_bytes = json.dumps(header).encode("utf-8")
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(_HEADER_LEN.pack(len(header_bytes)))
+        f.write(header_bytes)
+        for section in sections.values():
+            if isinstance(section["payload"], bytes):
+                f.write(section["payload"])
+            else:
+                shutil.copyfileobj(section["payload"], f, _BLOCK_SIZE)
+    os.replace(tmp_path, path)
+
+
+class SnapshotReader:
+    """
+    Reader of a snapshot file, only the header is read on creation.
+    The file stays open, so sections can still be read after the snapshot is replaced.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "rb")
+        self._lock = threading.Lock()
+        magic = self._file.read(len(SNAPSHOT_MAGIC))
+        if magic != SNAPSHOT_MAGIC:
+            self._file.close()
+            raise ValueError(f"Not a storage snapshot: {path}")
+        (header_len,) = _HEADER_LEN.unpack(self._file.read(_HEADER_LEN.size))
+        header = json.loads(self._file.read(header_len))
+        if header["version"] > SNAPSHOT_VERSION:
+            self._file.close()
+            raise ValueError(
+                f"Snapshot version {header['version']} of {path} is newer than "
+                + f"the supported version {SNAPSHOT_VERSION}"
+            )
+        self.version: int = header["version"]
+        self.log_seq: int = header.get("log_seq", 0)
+        self.sections: dict[str, dict] = header["sections"]
+        self._data_offset = len(SNAPSHOT_MAGIC) + _HEADER_LEN.size + header_len
+
+    def close(self):
+        self._file.close()
+
+    def __del__(self):
+        if hasattr(self, "_file"):
+            self._file.close()
+
+    def read_section(self, name: str) -> dict:
+        """Read the compressed section as it is, in the format of `encode_section`"""
+        info = self.sections[name]
+        with self._lock:
+            self._file.seek(self._data_offset + info["offset"])
+            payload = self._file.read(info["size"])
+        return {
+            "payload": payload,
+            # Version 1 sections are single JSON documents
+            "codec": info.get("codec", "zlib"),
+            "count": info["count"],
+            "raw_size": info["raw_size"],
+            "lines": None,
+        }
+
+    def read_lines(self, name: str) -> list[bytes] | None:
+        """The JSON line of every item of a section, None if it is not stored by lines"""
+        section = self.read_section(name)
+        if section["codec"] != "zlib-lines":
+            return None
+        raw = zlib.decompress(section["payload"])
+        return raw.split(b"\n") if raw else []
+
+    def iter_lines(self, name: str) -> Iterator[bytes]:
+        """Stream the JSON lines of a section stored by lines, decompressed block by block"""
+        info = self.sections[name]
+        if info.get("codec", "zlib") != "zlib-lines":
+            raise ValueError(f"Section {name} of {self.path} is not stored by lines")
+        decompressor = zlib.decompressobj()
+        offset = self._data_offset + info["offset"]
+        end = offset + info["size"]
+        rest = b""
+        while offset < end:
+            with self._lock:
+                self._file.seek(offset)
+                block = self._file.read(min(_BLOCK_SIZE, end - offset))
+            if not block:
+                raise ValueError(f"Section {name} of {self.path} is truncated")
+            offset += len(block)
+            lines = (rest + decompressor.decompress(block)).split(b"\n")
+            rest = lines.pop()
+            yield from lines
+        rest += decompressor.flush()
+        if info["count"]:
+            yield rest
+
+    def load(self, name: str) -> tuple[Any, list[bytes] | None]:
+        """
+        Read and decode a section
+
+        Returns:
+            tuple: The value, and the JSON line of every item if the section is stored by lines
+        """
+        section = self.read_section(name)
+        raw = zlib.decompress(section["payload"])
+        if section["codec"] != "zlib-lines":
+            return _ADAPTERS[name].validate_json(raw), None
+        lines = raw.split(b"\n") if raw else []
+        return _ADAPTERS[name].validate_json(b"[" + b",".join(lines) + b"]"), lines
@@ -0,0 +1,87 @@
+"""
+Versions of a storage folder.
+
+Every full snapshot is written to its own `versions/<n>` folder, which is never
+modified afterwards except for appends to its operation log. The `CURRENT` file
+points to the published version and the last log record of it, and is replaced
+atomically, so readers only see complete saves and keep the files of the version
+they opened while a new one is published. Older versions are deleted, the one
+before the current is kept for readers that just read the old pointer.
+"""
+
+import os
+import json
+import shutil
+import logging
+import threading
+
+log = logging.getLogger("mgrag")
+
+CURRENT_FILE = "CURRENT"
+VERSIONS_DIR = "versions"
+# The current version and the one before it
+_KEEP_VERSIONS = 2
+
+# One publisher at a time per storage folder
+_LOCKS: dict[str, threading.Lock] = {}
+_LOCKS_GUARD = threading.Lock()
+
+
+def folder_lock(folder: str) -> threading.Lock:
+    with _LOCKS_GUARD:
+        return _LOCKS.setdefault(os.path.abspath(folder), threading.Lock())
+
+
+def version_folder(folder: str, version: int) -> str:
+    return os.path.join(folder, VERSIONS_DIR, str(version))
+
+
+def read_current(folder: str) -> dict | None:
+    """The published version and log sequence number, None if nothing is published"""
+    path = os.path.join(folder, CURRENT_FILE)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_current(folder: str, version: int, log_seq: int):
+    """Publish a version, atomically replacing the pointer"""
+    path = os.path.join(folder, CURRENT_FILE)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"version": version, "log_seq": log_seq}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def list_versions(folder: str) -> list[int]:
+    root = os.path.join(folder, VERSIONS_DIR)
+    if not os.path.isdir(root):
+        return []
+    return sorted(int(name) for name in os.listdir(root) if name.isdigit())
+
+
+def new_version(folder: str) -> tuple[int, str]:
+    """Create the folder of the next version"""
+    version = max(list_versions(folder), default=0) + 1
+    path = version_folder(folder, version)
+    os.makedirs(path)
+    return version, path
+
+
+def collect_versions(folder: str):
+    """Delete the versions older than the kept ones, and unpublished leftovers"""
+    current = read_current(folder)
+    if current is None:
+        return
+    versions = [v for v in list_versions(folder) if v <= current["version"]]
+    keep = set(versions[-_KEEP_VERSIONS:])
+    for version in list_versions(folder):
+        # Newer versions may be written by a compaction right now
+        if version in keep or version > current["version"]:
+            continue
+        shutil.rmtree(version_folder(folder, version), ignore_errors=True)
+        log.debug(f"Deleted version {version} of {folder}")
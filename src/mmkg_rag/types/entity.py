@@ -25,6 +25,9 @@ class Entity(BaseModel):
     chunks: Optional[list[int]] = None
     """The chunks associated with the entity"""
 
+    id: Optional[int] = None
+    """The integer identifier of the entity, assigned by the storage"""
+
     def __hash__(self):
         return hash(self.name + self.label + self.description)
 
@@ -18,3 +18,6 @@ class Image(BaseModel):
 
     texts: Optional[list[str]] = None
     """The text of the image."""
+
+    chunks: Optional[list[int]] = None
+    """The chunks the image is found in"""
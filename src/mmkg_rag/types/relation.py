@@ -25,6 +25,15 @@ class Relation(BaseModel):
     description: Optional[str] = None
     """The description of the relation"""
 
+    source_id: Optional[int] = None
+    """The integer identifier of the source entity, assigned by the storage"""
+
+    target_id: Optional[int] = None
+    """The integer identifier of the target entity, None for image relations"""
+
+    id: Optional[int] = None
+    """The integer identifier of the relation, assigned by the storage"""
+
     def __hash__(self):
         return hash(self.source + self.target + self.label)
 
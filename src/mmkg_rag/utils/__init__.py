@@ -3,10 +3,13 @@ from .log import setup_logging
 
 from .helper import (
     md5,
+    md5_file,
+    async_cache,
     extract_image_links,
     shorten_string,
     encode_image,
     image_base64_url,
     write_er_to_file,
 )
+from .image import prepare_image, cached_image_base64_url, image_cache_stats
 from .llm import LLM as llm
@@ -2,8 +2,10 @@ import hashlib
 import re
 import os
 import base64
+import asyncio
+import functools
 from pathlib import Path
-from typing import List
+from typing import Any, Callable, Hashable, List
 from pickle import dump
 
 
@@ -12,6 +14,57 @@ def md5(string: str) -> str:
     return hashlib.md5(string.encode()).hexdigest()
 
 
+def md5_file(file_path: str | Path) -> str:
+    """Hash the content of a file using md5."""
+    hasher = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def async_cache(key: Callable[..., Hashable | None] | None = None):
+    """
+    Cache the results of a coroutine function in memory.
+    Concurrent calls with the same key share one call, None results are not cached.
+
+    Args:
+        key (Callable, optional): Build the cache key from the call arguments,
+            return None to bypass the cache. Defaults to the positional arguments.
+    """
+
+    def decorator(func: Callable[..., Any]):
+        results: dict[Hashable, Any] = {}
+        pending: dict[Hashable, asyncio.Task] = {}
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            cache_key = key(*args, **kwargs) if key else args
+            if cache_key is None:
+                return await func(*args, **kwargs)
+            if cache_key in results:
+                return results[cache_key]
+
+            task = pending.get(cache_key)
+            # A task left by another (closed) event loop can not be awaited here
+            if task is None or task.get_loop() is not asyncio.get_running_loop():
+                task = asyncio.ensure_future(func(*args, **kwargs))
+                pending[cache_key] = task
+            try:
+                result = await asyncio.shield(task)
+            finally:
+                if task.done() and pending.get(cache_key) is task:
+                    del pending[cache_key]
+            if result is not None:
+                results[cache_key] = result
+            return result
+
+        wrapper.cache_clear = lambda: results.clear()  # type: ignore[attr-defined]
+        return wrapper
+
+    return decorator
+
+
 def extract_image_links(markdown_text: str) -> List[str]:
     """
     Extract image URLs from markdown text
@@ -57,12 +110,20 @@ def encode_image(image_path: str | Path) -> str:
         return base64.b64encode(image_file.read()).decode("utf-8")
 
 
-def image_base64_url(image_path: str) -> str:
+def image_base64_url(image_path: str, optimize: bool = True) -> str:
     """
     Return the base64 url of the image
+
+    Args:
+        image_path (str): The path of the image
+        optimize (bool, optional): Upload a downscaled and re-encoded variant. Defaults to True.
     """
-    image_type = image_path.split(".")[-1]
-    return f"data:image/{image_type};base64,{encode_image(image_path)}"
+    from .image import prepare_image
+
+    upload_path = prepare_image(image_path) if optimize else Path(image_path)
+    image_type = upload_path.suffix[1:].lower()
+    image_type = "jpeg" if image_type == "jpg" else image_type
+    return f"data:image/{image_type};base64,{encode_image(upload_path)}"
 
 
 def write_er_to_file(entities, relations, images, image_relations, save_path):
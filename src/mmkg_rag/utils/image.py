@@ -0,0 +1,221 @@
+"""
+Image preprocessing before vision calls
+"""
+
+import os
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from .helper import md5
+
+log = logging.getLogger("mgrag")
+
+_VARIANTS_DIR = ".variants"
+_FORMAT_SUFFIX = {"JPEG": "jpg", "WEBP": "webp", "PNG": "png"}
+
+
+def _env_options() -> dict:
+    """Default preprocessing options, configured by environment variables"""
+    return {
+        "max_size": int(os.environ.get("MMKG_IMAGE_MAX_SIZE") or 1568),
+        "image_format": (os.environ.get("MMKG_IMAGE_FORMAT") or "JPEG").upper(),
+        "quality": int(os.environ.get("MMKG_IMAGE_QUALITY") or 85),
+        "grayscale": os.environ.get("MMKG_IMAGE_GRAYSCALE", "").lower()
+        in ("1", "true", "yes"),
+    }
+
+
+def prepare_image(
+    image_path: str | Path,
+    max_size: int | None = None,
+    image_format: str | None = None,
+    quality: int | None = None,
+    grayscale: bool | None = None,
+) -> Path:
+    """
+    Downscale and re-encode an image for vision calls.
+    The derived variant is cached in a `.variants` folder next to the image,
+    the original path is returned if the image is already small enough or Pillow is missing.
+
+    Args:
+        image_path (str | Path): The path of the image
+        max_size (int, optional): The maximum width and height in pixels. Defaults to 1568.
+        image_format (str, optional): JPEG, WEBP or PNG. Defaults to JPEG.
+        quality (int, optional): The encoding quality of JPEG and WEBP. Defaults to 85.
+        grayscale (bool, optional): Convert to grayscale, useful for diagrams. Defaults to False.
+
+    Returns:
+        Path: The path of the image to upload
+    """
+    options = _env_options()
+    max_size = max_size or options["max_size"]
+    image_format = (image_format or options["image_format"]).upper()
+    quality = quality or options["quality"]
+    grayscale = options["grayscale"] if grayscale is None else grayscale
+
+    image_path = Path(image_path)
+    if not image_path.exists():
+        raise FileNotFoundError(f"Image not found at {image_path}")
+    if image_format not in _FORMAT_SUFFIX:
+        raise ValueError(f"Unsupported image format {image_format}")
+
+    try:
+        from PIL import Image as PILImage
+    except ImportError:
+        log.warning("Pillow is not installed, images are uploaded as is")
+        return image_path
+
+    stat = image_path.stat()
+    variant_key = md5(
+        f"{image_path.name}:{stat.st_mtime_ns}:{stat.st_size}:"
+        + f"{max_size}:{image_format}:{quality}:{grayscale}"
+    )
+    variant_path = (
+        image_path.parent
+        / _VARIANTS_DIR
+        / f"{image_path.stem}-{variant_key[:12]}.{_FORMAT_SUFFIX[image_format]}"
+    )
+    keep_marker = variant_path.with_suffix(".keep")
+    if variant_path.exists():
+        return variant_path
+    if keep_marker.exists():
+        return image_path
+
+    tmp_path = variant_path.with_suffix(variant_path.suffix + ".tmp")
+    try:
+        with PILImage.open(image_path) as img:
+            if getattr(img, "is_animated", False):
+                # Keep animations untouched
+                return image_path
+            img.thumbnail((max_size, max_size))
+            if grayscale:
+                img = img.convert("L")
+            elif image_format == "JPEG" and img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+
+            variant_path.parent.mkdir(parents=True, exist_ok=True)
+            img.save(tmp_path, format=image_format, quality=quality, optimize=True)
+    except OSError as e:
+        log.warning(f"Failed to preprocess image {image_path}, upload as is: {e}")
+        return image_path
+
+    # Keep the original if re-encoding did not save anything
+    if tmp_path.stat().st_size >= stat.st_size:
+        tmp_path.unlink()
+        keep_marker.touch()
+        return image_path
+    os.replace(tmp_path, variant_path)
+    return variant_path
+
+
+class ImageUrlCache:
+    """
+    Bounded LRU cache of base64 data urls, keyed by path, mtime and size.
+    Shared by concurrent requests, so it is guarded by a lock.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._urls: OrderedDict[tuple, str] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, image_path: str, optimize: bool = True) -> str:
+        """Return the data url of the image, encoding it on a miss"""
+        stat = os.stat(image_path)
+        key = (os.path.abspath(image_path), stat.st_mtime_ns, stat.st_size, optimize)
+        with self._lock:
+            url = self._urls.get(key)
+            if url is not None:
+                self._urls.move_to_end(key)
+                self.hits += 1
+                return url
+            self.misses += 1
+
+        from .helper import image_base64_url
+
+        url = image_base64_url(image_path, optimize=optimize)
+        with self._lock:
+            if key not in self._urls:
+                self._urls[key] = url
+                self._size += len(url)
+            while self._size > self.max_bytes and len(self._urls) > 1:
+                _, evicted = self._urls.popitem(last=False)
+                self._size -= len(evicted)
+        return url
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self._urls),
+            "bytes": self._size,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._urls.clear()
+            self._size = 0
+            self.hits = self.misses = 0
+
+
+_URL_CACHE = ImageUrlCache(
+    int(os.environ.get("MMKG_IMAGE_CACHE_MB") or 256) * 1024 * 1024
+)
+
+
+def cached_image_base64_url(image_path: str, optimize: bool = True) -> str:
+    """Return the base64 url of the image from the process-wide LRU cache"""
+    return _URL_CACHE.get(image_path, optimize=optimize)
+
+
+def image_cache_stats() -> dict:
+    """Hit-rate metrics of the process-wide image url cache"""
+    return _URL_CACHE.stats()
+
+
+def dhash(image_path: str | Path, hash_size: int = 8) -> int | None:
+    """
+    Perceptual difference hash of an image, robust to rescaling and re-encoding.
+    Returns None if the image can not be read or Pillow is missing.
+    """
+    try:
+        from PIL import Image as PILImage
+    except ImportError:
+        log.warning("Pillow is not installed, images are not hashed")
+        return None
+
+    try:
+        with PILImage.open(image_path) as img:
+            pixels = (
+                img.convert("L")
+                .resize((hash_size + 1, hash_size), PILImage.Resampling.LANCZOS)
+                .tobytes()
+            )
+    except OSError as e:
+        log.warning(f"Failed to hash image {image_path}: {e}")
+        return None
+
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def low_detail(value: int, hash_size: int = 8, min_bits: int = 8) -> bool:
+    """
+    If a difference hash has too little detail to tell images apart.
+    Blank and low-contrast images hash to almost no set bits or bit transitions,
+    so unrelated images of that kind are near each other.
+    """
+    bits = hash_size * hash_size
+    transitions = ((value ^ (value >> 1)) & ((1 << (bits - 1)) - 1)).bit_count()
+    return value.bit_count() < min_bits or transitions < min_bits
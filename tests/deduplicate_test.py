@@ -1,14 +1,22 @@
+import os
+import tempfile
 import unittest
 import asyncio
 from unittest.mock import patch
 from src.mmkg_rag.index.deduplicate import (
+    _entity_group_key,
+    _merge_entity_group,
+    _merge_relation_group,
     deduplicate,
+    deduplicate_storage,
     group_by_name_alias,
     group_by_name_alias_v2,
     group_relations,
 )
 from src.mmkg_rag.types.entity import Entity
 from src.mmkg_rag.types.relation import Relation
+from src.mmkg_rag.storage import JsonlCache, MemoryStorage
+from src.mmkg_rag.types import Image
 
 
 class TestDeduplicate(unittest.TestCase):
@@ -119,3 +127,84 @@ class TestDeduplicate(unittest.TestCase):
         self.assertEqual(len(result), 2)
         self.assertEqual(len(result[0]), 1)
         self.assertEqual(len(result[1]), 1)
+
+
+class TestDeduplicateCache(unittest.IsolatedAsyncioTestCase):
+    async def test_reuse_cached_decision(self):
+        e1 = Entity(name="GraphRAG", description="desc1", label="method")
+        e2 = Entity(name="Graph RAG", description="desc2", label="method")
+        cache = JsonlCache()
+        res = '{"same_entity": true, "entity": {"name": "GraphRAG", "label": "method", "description": "merged"}}'
+        with patch("src.mmkg_rag.index.deduplicate.llm.chat") as mock_chat:
+            mock_chat.return_value = res
+            merged, entity = await _merge_entity_group([e1, e2], cache)
+            self.assertTrue(merged)
+            # Same members in another order hit the cache
+            merged, entity = await _merge_entity_group([e2, e1], cache)
+            self.assertEqual(mock_chat.call_count, 1)
+        self.assertTrue(merged)
+        self.assertEqual(entity.description, "merged")
+
+    async def test_failures_are_not_cached(self):
+        e1 = Entity(name="GraphRAG", description="desc1", label="method")
+        e2 = Entity(name="Graph RAG", description="desc2", label="method")
+        r1 = Relation(source="GraphRAG", target="LLM", label="uses", description="d1")
+        r2 = Relation(source="GraphRAG", target="LLM", label="uses", description="d2")
+        cache = JsonlCache()
+        with patch("src.mmkg_rag.index.deduplicate.llm.chat") as mock_chat:
+            mock_chat.return_value = "not a JSON answer"
+            self.assertEqual(await _merge_entity_group([e1, e2], cache), (False, None))
+            self.assertEqual(await _merge_relation_group([r1, r2], [], cache), [r1, r2])
+            self.assertEqual(len(cache), 0)
+
+            mock_chat.return_value = '{"same_entity": false}'
+            await _merge_entity_group([e1, e2], cache)
+            mock_chat.return_value = '{"same_relationship": false}'
+            await _merge_relation_group([r1, r2], [], cache)
+            self.assertEqual(len(cache), 2)
+
+    async def test_deduplicate_storage(self):
+        storage = MemoryStorage(folder="")
+        stored = Entity(name="GraphRAG", description="desc1", label="method", chunks=[1])
+        storage.add_entities([stored, Entity(name="LLM", description="d", label="model")])
+        storage.add_relations([Relation(source="GraphRAG", target="LLM", label="uses")])
+        storage.add_images([Image(path="a.png", caption="c", description="d")])
+        storage.add_relations(
+            [Relation(source="GraphRAG", target="a.png", label="#image")], images=True
+        )
+        old_id = stored.id
+        new = Entity(name="GRAPHRAG", description="desc2", label="method", chunks=[2])
+        storage.add_entities([new])
+
+        cache = JsonlCache()
+        cache.set(
+            _entity_group_key([stored, new]),
+            {"name": "GraphRAG", "label": "method", "description": "merged"},
+        )
+        with patch("src.mmkg_rag.index.deduplicate.llm.chat") as mock_chat:
+            removed = await deduplicate_storage(storage, cache)
+            mock_chat.assert_not_called()
+        self.assertEqual(removed, (1, 0))
+
+        merged = storage.get_entity_by_name("GraphRAG")
+        self.assertEqual(merged.description, "merged")
+        self.assertEqual(merged.chunks, [1, 2])
+        # The merged ids are redirected, the relations keep their ids
+        self.assertEqual(storage.resolve_id(old_id), merged.id)
+        self.assertEqual(storage.entity_id("GRAPHRAG"), merged.id)
+        self.assertEqual([r.id for r in storage.relations], [1])
+        self.assertEqual(storage.relations[0].source_id, merged.id)
+        self.assertEqual(storage.image_relations[0].source_id, merged.id)
+        self.assertEqual(
+            [r.source for r in storage.get_image_relations("a.png")], ["GraphRAG"]
+        )
+
+    def test_cache_persisted(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "dedup_cache.jsonl")
+            JsonlCache(path).set("k", {"name": "a"})
+            JsonlCache(path).set("n", None)
+            cache = JsonlCache(path)
+            self.assertEqual(cache.get("k"), {"name": "a"})
+            self.assertIn("n", cache)
+            self.assertIsNone(cache.get("n"))
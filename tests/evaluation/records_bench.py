@@ -0,0 +1,111 @@
+"""
+Benchmark the memory per entity and per relation of the pydantic models
+against the compact records used by the retrieval, and the memory-mapped
+graph snapshot shared by the retrieval workers, its update after a save,
+and the keyword search over it.
+"""
+
+import gc
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+from src.mmkg_rag.retrieval.search import SearchIndex
+from src.mmkg_rag.storage import GraphSnapshot, MemoryStorage
+from src.mmkg_rag.storage.graph_snapshot import storage_stamp
+from src.mmkg_rag.storage.records import EntityRecords, RelationRecords, StringPool
+from src.mmkg_rag.types import Entity, Relation
+from tests.evaluation.storage_bench import build_storage
+
+
+def measured(label: str, count: int, func):
+    """Print the memory held by the result of func, per item"""
+    gc.collect()
+    tracemalloc.start()
+    result = func()
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<32}{size / count:8.0f}B/item{size / 1e6:10.1f}MB")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entities", type=int, default=100_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        build_storage(args.entities).save_to_folder(folder)
+        storage = MemoryStorage(folder)
+        # The indexes are loaded by both, keep them out of the measures
+        storage.entity_id("entity 1")
+        num_entities = storage._snapshot.sections["entities"]["count"]
+        num_relations = storage._snapshot.sections["relations"]["count"]
+
+        entities = measured("entity models", num_entities, lambda: storage.entities)
+        relations = measured(
+            "relation models", num_relations, lambda: storage.relations
+        )
+        names = StringPool()
+        measured(
+            "entity records",
+            num_entities,
+            lambda: EntityRecords.from_items(entities, names),
+        )
+        measured(
+            "relation records",
+            num_relations,
+            lambda: RelationRecords.from_items(relations, names),
+        )
+        del entities, relations, storage
+        measured(
+            "records from snapshot",
+            num_entities + num_relations,
+            lambda: MemoryStorage(folder).records(),
+        )
+
+        start = time.perf_counter()
+        GraphSnapshot.load(folder)
+        print(f"{'graph snapshot build':<32}{time.perf_counter() - start:8.3f}s")
+        start = time.perf_counter()
+        measured(
+            "graph snapshot open",
+            num_entities + num_relations,
+            lambda: GraphSnapshot.load(folder),
+        )
+        print(f"{'graph snapshot open':<32}{time.perf_counter() - start:8.3f}s")
+
+        # A save of 100 entities and relations, applied to the snapshot in use
+        graph = GraphSnapshot.load(folder)
+        storage = MemoryStorage(folder)
+        storage.add_entities(
+            [Entity(name=f"new {i}", label="concept", description="d") for i in range(100)]
+        )
+        storage.add_relations(
+            [Relation(source=f"new {i}", target="entity 1", label="r") for i in range(100)]
+        )
+        storage.save_to_folder()
+        start = time.perf_counter()
+        graph.update(folder, storage_stamp(folder))
+        print(f"{'graph snapshot update':<32}{time.perf_counter() - start:8.3f}s")
+
+        # The postings of the searched texts are mapped from the snapshot,
+        # as by a retrieval worker that holds no storage
+        del storage, graph
+        gc.collect()
+        start = time.perf_counter()
+        index = SearchIndex.load(folder)
+        index.build_search_texts()
+        print(f"{'search index load':<32}{time.perf_counter() - start:8.3f}s")
+        # An exact name, shared words and a misspelling scored against every entity,
+        # the texts of every entity are decoded by the first one
+        for keyword in ("entity 123", "entity 7 relation", "entty"):
+            start = time.perf_counter()
+            index.search_entities([keyword])
+            print(f"{'keyword ' + keyword:<32}{time.perf_counter() - start:8.3f}s")
+
+
+if __name__ == "__main__":
+    main()
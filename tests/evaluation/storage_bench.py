@@ -0,0 +1,109 @@
+"""
+Benchmark the load and save time of the storage snapshot against the legacy pickles.
+"""
+
+import os
+import time
+import pickle
+import argparse
+import tempfile
+
+from src.mmkg_rag.storage import MemoryStorage
+from src.mmkg_rag.storage.versions import read_current, version_folder
+from src.mmkg_rag.types import Entity, Relation, Image
+
+
+def build_storage(num_entities: int) -> MemoryStorage:
+    storage = MemoryStorage(folder="")
+    storage.add_entities(
+        [
+            Entity(
+                name=f"entity {i}",
+                label="concept",
+                description=f"The description of entity {i}, " * 4,
+                references=[f"reference text {i}"],
+                chunks=[i % 500],
+            )
+            for i in range(num_entities)
+        ]
+    )
+    storage.add_relations(
+        [
+            Relation(
+                source=f"entity {i}",
+                target=f"entity {(i * 7 + 1) % num_entities}",
+                label="related",
+                description=f"The relation of entity {i}",
+                chunks=[i % 500],
+            )
+            for i in range(num_entities * 2)
+        ]
+    )
+    storage.add_images(
+        [
+            Image(path=f"images/{i}.png", caption=f"figure {i}", description="desc")
+            for i in range(num_entities // 100)
+        ]
+    )
+    return storage
+
+
+def timed(label: str, func):
+    start = time.perf_counter()
+    result = func()
+    print(f"{label:<32}{time.perf_counter() - start:8.3f}s")
+    return result
+
+
+def save_pickles(storage: MemoryStorage, folder: str):
+    for key, path in storage._item_path_dict(folder).items():
+        with open(path, "wb") as f:
+            pickle.dump(getattr(storage, key), f)
+
+
+def load_pickles(folder: str) -> MemoryStorage:
+    storage = MemoryStorage(folder)
+    # Pickles are decoded eagerly, touch the data for a fair comparison
+    storage.relations
+    return storage
+
+
+def folder_size(folder: str, suffix: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(folder, f))
+        for f in os.listdir(folder)
+        if f.endswith(suffix)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entities", type=int, default=100_000)
+    args = parser.parse_args()
+
+    storage = timed("build", lambda: build_storage(args.entities))
+    with tempfile.TemporaryDirectory() as pickle_folder:
+        timed("pickle save", lambda: save_pickles(storage, pickle_folder))
+        timed("pickle load", lambda: load_pickles(pickle_folder))
+        print(f"{'pickle size':<32}{folder_size(pickle_folder, '.pkl') / 1e6:8.1f}MB")
+
+    with tempfile.TemporaryDirectory() as snapshot_folder:
+        timed("snapshot save", lambda: storage.save_to_folder(snapshot_folder))
+        loaded = timed("snapshot open", lambda: MemoryStorage(snapshot_folder))
+        timed("snapshot load indexes", lambda: loaded.entity_id("entity 1"))
+        timed("snapshot load entities", lambda: loaded.entities)
+        timed("snapshot load relations", lambda: loaded.relations)
+        loaded.add_entities(
+            [Entity(name=f"new {i}", label="concept", description="d") for i in range(20)]
+        )
+        timed("delta save, 20 entities", lambda: loaded.save_to_folder())
+        timed("replay on load", lambda: MemoryStorage(snapshot_folder).entities)
+        timed("compaction", lambda: loaded.compact(background=False))
+        current = version_folder(
+            snapshot_folder, read_current(snapshot_folder)["version"]
+        )
+        print(f"{'snapshot size':<32}{folder_size(current, '.snapshot') / 1e6:8.1f}MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,8 @@
+import tempfile
 import unittest
-from src.mmkg_rag.utils.helper import md5, rename_markdown_images
+from pathlib import Path
+from src.mmkg_rag.utils.helper import md5, rename_markdown_images, image_base64_url
+from src.mmkg_rag.utils.image import ImageUrlCache, prepare_image
 
 
 class TestHelper(unittest.TestCase):
@@ -21,3 +24,58 @@ class TestHelper(unittest.TestCase):
     def test_rename_graphrag_md_iamges(self):
         res = rename_markdown_images("examples/rag/lightrag.md")
         self.assertGreater(len(res), 10)
+
+
+class TestPrepareImage(unittest.TestCase):
+    def test_downscale_and_reencode(self):
+        from PIL import Image as PILImage
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = Path(folder) / "figure.png"
+            noise = PILImage.effect_noise((3000, 2000), 64).convert("RGB")
+            noise.save(path)
+
+            variant = prepare_image(path, max_size=1024, image_format="JPEG")
+            self.assertEqual(variant.parent.name, ".variants")
+            self.assertLess(variant.stat().st_size, path.stat().st_size)
+            with PILImage.open(variant) as img:
+                self.assertEqual(max(img.size), 1024)
+            # Cached variant is reused
+            self.assertEqual(prepare_image(path, max_size=1024), variant)
+            self.assertTrue(image_base64_url(str(path)).startswith("data:image/jpeg"))
+
+    def test_keep_small_original(self):
+        from PIL import Image as PILImage
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = Path(folder) / "icon.png"
+            PILImage.new("L", (8, 8)).save(path)
+            self.assertEqual(prepare_image(path, image_format="JPEG"), path)
+            self.assertEqual(prepare_image(path, image_format="JPEG"), path)
+
+
+class TestImageUrlCache(unittest.TestCase):
+    def test_hits_and_invalidation(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = Path(folder) / "figure.gif"
+            path.write_bytes(b"GIF89a-first")
+            cache = ImageUrlCache()
+            first = cache.get(str(path), optimize=False)
+            self.assertEqual(cache.get(str(path), optimize=False), first)
+            self.assertEqual(cache.stats()["hits"], 1)
+            self.assertEqual(cache.stats()["hit_rate"], 0.5)
+
+            # A changed file is a new key
+            path.write_bytes(b"GIF89a-second-version")
+            self.assertNotEqual(cache.get(str(path), optimize=False), first)
+            self.assertEqual(cache.stats()["misses"], 2)
+
+    def test_bounded(self):
+        with tempfile.TemporaryDirectory() as folder:
+            cache = ImageUrlCache(max_bytes=200)
+            for i in range(5):
+                path = Path(folder) / f"{i}.gif"
+                path.write_bytes(b"x" * 60)
+                cache.get(str(path), optimize=False)
+            self.assertLessEqual(cache.stats()["bytes"], 200)
+            self.assertLess(cache.stats()["entries"], 5)
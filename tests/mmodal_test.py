@@ -1,10 +1,24 @@
+import os
+import asyncio
+import tempfile
 import unittest
-from unittest.mock import patch, mock_open
+from unittest.mock import patch, mock_open, AsyncMock
 import base64
 from pathlib import Path
 
-from src.mmkg_rag.index.mmodal import image_description
-from src.mmkg_rag.types.image import Image
+from rapidfuzz.fuzz import token_sort_ratio
+
+from src.mmkg_rag.index.mmodal import (
+    image_description,
+    describe_and_link_image,
+    _ChunkLocality,
+    _EntityTerms,
+    _find_duplicate_images,
+    _search_related_entities,
+    _select_candidates,
+)
+from src.mmkg_rag.types import Chunk, Entity, Image
+from src.mmkg_rag.utils import md5_file
 
 
 class ImageDescriptionTest(unittest.TestCase):
@@ -59,3 +73,176 @@ class ImageDescriptionTest(unittest.TestCase):
 
         # Verify result still contains path but empty fields
         self.assertIsInstance(result, Image)
+
+
+class ImageDescriptionCacheTest(unittest.IsolatedAsyncioTestCase):
+    async def test_description_cached_by_content(self):
+        with tempfile.TemporaryDirectory() as folder:
+            for name in ("a.png", "b.png"):
+                with open(os.path.join(folder, name), "wb") as f:
+                    f.write(b"same_image_bytes")
+            response = '{"caption": "Figure 1", "text_snippets": ["x"], "description": "desc"}'
+            with patch.dict(os.environ, {"MMKG_CACHE_DIR": folder}), patch(
+                "src.mmkg_rag.index.mmodal.llm.chat_msg_sync", new_callable=AsyncMock
+            ) as mock_chat:
+                mock_chat.return_value = response
+                # Concurrent calls for the same image share one LLM call
+                first, again = await asyncio.gather(
+                    image_description(os.path.join(folder, "a.png"), "ctx"),
+                    image_description(os.path.join(folder, "a.png"), "ctx"),
+                )
+                # The same bytes under another path hit the disk cache
+                copy = await image_description(os.path.join(folder, "b.png"), "ctx")
+                self.assertEqual(mock_chat.call_count, 1)
+
+            self.assertEqual(first, again)
+            # Callers do not share the cached image
+            self.assertIsNot(first, again)
+            self.assertEqual(copy.caption, "Figure 1")
+            self.assertEqual(copy.path, os.path.join(folder, "b.png"))
+
+    async def test_cache_dir(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "c.png")
+            with open(path, "wb") as f:
+                f.write(b"cache_dir_bytes")
+            cache_dir = os.path.join(folder, "cache")
+            response = '{"caption": "Figure 1", "text_snippets": [], "description": "desc"}'
+            env = {k: v for k, v in os.environ.items() if k != "MMKG_CACHE_DIR"}
+            with patch.dict(os.environ, env, clear=True), patch(
+                "src.mmkg_rag.index.mmodal.llm.chat_msg_sync", new_callable=AsyncMock
+            ) as mock_chat, patch(
+                "src.mmkg_rag.index.mmodal.md5_file", wraps=md5_file
+            ) as mock_md5:
+                mock_chat.return_value = response
+                await image_description(path, "ctx", cache_dir)
+                # The image is read once for the in-memory and the disk cache
+                self.assertEqual(mock_md5.call_count, 1)
+            self.assertTrue(
+                os.path.exists(os.path.join(cache_dir, "image_descriptions.jsonl"))
+            )
+
+
+class DuplicateImagesTest(unittest.TestCase):
+    def test_low_contrast_images_are_not_duplicates(self):
+        from PIL import Image as PILImage, ImageDraw
+
+        with tempfile.TemporaryDirectory() as folder:
+            a, b = os.path.join(folder, "a.png"), os.path.join(folder, "b.png")
+            image = PILImage.new("L", (400, 300), 250)
+            ImageDraw.Draw(image).text((20, 20), "Accuracy table", fill=240)
+            image.save(a)
+            image = PILImage.new("L", (400, 300), 250)
+            ImageDraw.Draw(image).ellipse((250, 150, 300, 200), outline=244)
+            image.save(b)
+            # Both hash to almost no set bits
+            self.assertEqual(_find_duplicate_images([(a, ""), (b, "")], None), {})
+
+            noise = PILImage.effect_noise((400, 300), 64)
+            noise.save(a)
+            noise.resize((200, 150)).save(b)
+            self.assertEqual(_find_duplicate_images([(a, ""), (b, "")], None), {b: a})
+
+
+class RelatedEntitiesTest(unittest.TestCase):
+    @staticmethod
+    def _reference_ranking(entities, image):
+        """Per-pair scoring, as computed before vectorisation"""
+
+        def avg(list1, list2):
+            sims = [
+                token_sort_ratio(s1.upper(), s2.upper()) / 100.0
+                for s1 in list1
+                for s2 in list2
+            ]
+            return sum(sims) / len(sims)
+
+        scored = []
+        for e in entities:
+            names = [e.name] + (e.aliases or [])
+            text = avg(names, image.texts) if image.texts else 0.0
+            caption = avg(names, [image.caption]) if image.caption else 0.0
+            scored.append((e, caption * 0.6 + text * 0.4))
+        return [
+            e for e, s in sorted(scored, key=lambda x: x[1], reverse=True) if s >= 0.1
+        ]
+
+    def test_same_ranking_as_pairwise(self):
+        names = ["Graph RAG", "LightRAG", "Knowledge Graph", "LLM", "Community"]
+        entities = [
+            Entity(
+                name=f"{n} {i}" if i else n,
+                label="concept",
+                description="",
+                aliases=[n.lower()] if i % 2 else None,
+            )
+            for i, n in enumerate(names * 4)
+        ]
+        image = Image(
+            path="figure.png",
+            caption="Figure 1: Graph RAG pipeline",
+            description="",
+            texts=["Knowledge Graph", "Community summaries", "LLM"],
+        )
+        expected = self._reference_ranking(entities, image)
+        self.assertEqual(_search_related_entities(entities, image), expected)
+        self.assertEqual(
+            _search_related_entities(entities, image, top_k=5), expected[:5]
+        )
+
+        caption_only = Image(path="p.png", caption="LightRAG", description="")
+        self.assertEqual(
+            _search_related_entities(entities, caption_only),
+            self._reference_ranking(entities, caption_only),
+        )
+
+
+class ChunkLocalityTest(unittest.TestCase):
+    def test_local_candidates_first(self):
+        chunks = [
+            Chunk(id=11, text="intro", images=[]),
+            Chunk(id=12, text="![](images/fig1.png)", images=["images/fig1.png"]),
+            Chunk(id=13, text="method", images=[]),
+            Chunk(id=14, text="results", images=[]),
+        ]
+        far = Entity(name="Graph RAG", label="m", description="", chunks=[14])
+        own = Entity(name="Community", label="m", description="", chunks=[12])
+        near = Entity(name="Indexing", label="m", description="", chunks=[13])
+        entities = [far, own, near]
+        locality = _ChunkLocality(chunks, entities)
+        self.assertEqual(locality.candidates("images/fig1.png"), [own, near])
+        self.assertEqual(locality.chunks("images/fig1.png"), [12])
+        self.assertIsNone(locality.chunks("images/fig2.png"))
+
+        image = Image(path="fig1.png", caption="Graph RAG pipeline", description="")
+        terms = _EntityTerms(entities)
+        selected = _select_candidates(
+            image, locality.candidates("images/fig1.png"), entities, terms, top_k=2
+        )
+        self.assertEqual(set(e.name for e in selected), {"Community", "Indexing"})
+        # The whole graph is only a fallback to fill up the candidates
+        selected = _select_candidates(image, [own], entities, terms, top_k=2)
+        self.assertEqual(selected, [own, far])
+
+
+class DescribeAndLinkTest(unittest.IsolatedAsyncioTestCase):
+    async def test_single_call(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "fig.png")
+            with open(path, "wb") as f:
+                f.write(b"describe_and_link_bytes")
+            candidates = [Entity(name="Graph RAG", label="method", description="")]
+            response = """{"caption": "Figure 1", "text_snippets": [], "description": "desc",
+            "links": [{"entity": "Graph RAG", "label": "SHOWS", "description": "d", "references": []}]}"""
+            with patch.dict(os.environ, {"MMKG_CACHE_DIR": folder}), patch(
+                "src.mmkg_rag.index.mmodal.llm.chat_msg_sync", new_callable=AsyncMock
+            ) as mock_chat:
+                mock_chat.return_value = response
+                image, relations = await describe_and_link_image(path, "ctx", candidates)
+                self.assertEqual(mock_chat.call_count, 1)
+
+            self.assertEqual(image.caption, "Figure 1")
+            self.assertEqual(len(relations), 1)
+            self.assertEqual(relations[0].source, "Graph RAG")
+            self.assertEqual(relations[0].target, path)
+            self.assertEqual(relations[0].label, "#imageSHOWS")
@@ -3,9 +3,10 @@ from src.mmkg_rag.index.parser import (
     parse_er,
     parse_alias,
     parse_image_description,
+    parse_image_description_links,
     parse_json_list,
 )
-from src.mmkg_rag.retrieval.parser import parse_classify_response
+from src.mmkg_rag.retrieval.parser import parse_classify_response, parse_visual_flag
 from src.mmkg_rag.types import Entity, Relation
 
 
@@ -396,3 +397,39 @@ class ClassifyParseTest(unittest.TestCase):
         response_type, content = parse_classify_response(partial_response)
         self.assertEqual(response_type, "retrieval")
         self.assertEqual(content, [])
+
+
+class TestImageDescLinksParse(unittest.TestCase):
+    def test_description_and_links(self):
+        text = """
+        {
+            "caption": "Figure 1",
+            "text_snippets": ["text1"],
+            "description": "desc1",
+            "links": [
+                {"entity": "Graph RAG", "label": "SHOWS", "description": "d", "references": ["r"]},
+                {"label": "NO_ENTITY"}
+            ]
+        }
+        """
+        caption, snippets, desc, links = parse_image_description_links(text)
+        self.assertEqual(caption, "Figure 1")
+        self.assertEqual(snippets, ["text1"])
+        self.assertEqual(desc, "desc1")
+        self.assertEqual(len(links), 1)
+        self.assertEqual(links[0]["entity"], "Graph RAG")
+
+    def test_missing_links(self):
+        text = '{"caption": "Figure 1", "text_snippets": [], "description": "desc1"}'
+        caption, _, _, links = parse_image_description_links(text)
+        self.assertEqual(caption, "Figure 1")
+        self.assertEqual(links, [])
+
+
+class VisualFlagParseTest(unittest.TestCase):
+    def test_visual_flag(self):
+        response = '{"classification": "retrieval", "keywords": ["chart"], "visual": true}'
+        self.assertTrue(parse_visual_flag(response))
+        response = '{"classification": "retrieval", "keywords": ["chart"]}'
+        self.assertFalse(parse_visual_flag(response))
+        self.assertFalse(parse_visual_flag("Invalid response format"))
@@ -1,28 +1,289 @@
+import os
+import sys
+import shutil
+import asyncio
+import tempfile
 import unittest
 from pathlib import Path
+from unittest.mock import AsyncMock, MagicMock, patch
+from src.mmkg_rag.storage import MemoryStorage, import_jsonl
+from src.mmkg_rag.storage.graph_snapshot import storage_stamp
 from src.mmkg_rag.types import Entity, Image, Relation
 from src.mmkg_rag.retrieval.search import (
+    SearchIndex,
+    SearchIndexRegistry,
+    _SearchTexts,
     _search_entities,
     _search_images,
     load_default_ers,
+    search_eris,
 )
+from src.mmkg_rag.retrieval.backend import MemoryBackend, Neo4jBackend, _lucene_query
+from src.mmkg_rag.retrieval.bm25 import BM25Index
+from src.mmkg_rag.utils.image import dhash
 
+# A small database about Graph RAG, as exported by `export_jsonl`
+FIXTURE_DATABASE = Path(__file__).parent / "assets" / "rag_database"
+
+
+class FixtureDatabaseTest(unittest.TestCase):
+    """Tests over the fixture database, imported into a temporary folder"""
 
-class SearchTest(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
-        """Load test data before running tests"""
-        # Use absolute path to test data
-        test_data_dir = str(Path("databases/RAG"))
-        load_default_ers(test_data_dir)
+        cls.folder = tempfile.mkdtemp()
+        cls.database = os.path.join(cls.folder, "RAG")
+        import_jsonl(str(FIXTURE_DATABASE), cls.database, workers=1)
+        load_default_ers(cls.database)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder, ignore_errors=True)
+
 
+class SearchTest(FixtureDatabaseTest):
     def test_search_entities_basic(self):
         """Test basic entity search functionality"""
-        # Test exact match
         results = _search_entities(
             ["overall architecture", "Graph RAG", "architecture diagram", "explanation"],
             max_num=5,
             similarity_threshold=10,
         )
-        print(len(results))
-        print([e.name for e in results])
+        self.assertEqual(len(results), 5)
+        self.assertEqual(results[0].name, "Graph RAG")
+
+    def test_search_eris(self):
+        entities, relations, related, images, image_entities, image_relations = (
+            search_eris(["Graph RAG", "architecture"], max_num=3)
+        )
+        self.assertEqual(entities[0].name, "Graph RAG")
+        self.assertIn(("Graph RAG", "LLM"), [(r.source, r.target) for r in relations])
+        self.assertIn("LLM", [e.name for e in related])
+        self.assertEqual([i.path for i in images], ["images/graphrag_architecture.png"])
+        self.assertIn("Graph RAG", [e.name for e in image_entities])
+        self.assertEqual(len(image_relations), 2)
+
+
+class SearchTextsTest(unittest.TestCase):
+    def test_ranking(self):
+        texts = _SearchTexts.from_texts(
+            [["LLM"], ["GraphRAG", "Graph RAG"], ["Graph RAG"], ["BERT"], ["RAG"]]
+        )
+        # The best text of an item counts, equal scores keep the item order
+        self.assertEqual(texts.search(["Graph RAG"], max_num=2), [1, 2])
+        self.assertEqual(texts.search(["Graph RAG"], max_num=10)[:3], [1, 2, 4])
+        self.assertEqual(texts.search(["BERT"], max_num=3, similarity_threshold=90), [3])
+        self.assertEqual(texts.search([], max_num=3), [])
+        self.assertEqual(_SearchTexts.from_texts([]).search(["RAG"]), [])
+
+    def test_exact_matches_first(self):
+        texts = _SearchTexts.from_texts(
+            [["Graph RAGs"], ["LLM", "graph  rag"], ["BERT"]],
+            ["Graph RAGs", "LLM graph rag", "a model that reads graph structures"],
+        )
+        # Ahead of a closer text by the case and whitespace
+        self.assertEqual(texts.search(["Graph RAG"], max_num=2), [1, 0])
+        # Found by the description, but not similar enough by the name
+        self.assertEqual(texts.search(["structures"], similarity_threshold=90), [])
+        self.assertEqual(texts.search(["BERT structures"], max_num=1), [2])
+        # Without a shared word every item is scored
+        self.assertEqual(texts.search(["BRET"], max_num=1), [2])
+
+    def test_bm25(self):
+        index = BM25Index.from_documents(["graph rag", "graph", "rag rag rag", ""])
+        docs, scores = index.scores(["Graph", "vector"])
+        self.assertEqual(docs.tolist(), [0, 1])
+        # The shorter document weighs the word more
+        self.assertGreater(scores[1], scores[0])
+        self.assertEqual(index.top(["rag graph"], 2).tolist(), [0, 2])
+        self.assertEqual(len(index.top(["vector"], 2)), 0)
+
+
+class SearchIndexRegistryTest(unittest.TestCase):
+    def _database(self, folder: str, names: list[str]) -> str:
+        storage = MemoryStorage(folder="")
+        storage.add_entities(
+            [Entity(name=n, label="concept", description=f"about {n}") for n in names]
+        )
+        storage.add_relations(
+            [Relation(source=names[0], target=n, label="related") for n in names[1:]]
+        )
+        storage.save_to_folder(folder)
+        return folder
+
+    def test_databases_are_separate(self):
+        with tempfile.TemporaryDirectory() as folder:
+            registry = SearchIndexRegistry(max_indexes=2)
+            a = self._database(os.path.join(folder, "a"), ["GraphRAG", "LLM"])
+            b = self._database(os.path.join(folder, "b"), ["LightRAG", "BERT"])
+            index_a, index_b = registry.get(a), registry.get(b)
+            self.assertIsInstance(index_a, SearchIndex)
+            self.assertIs(registry.get(a + os.sep), index_a)
+            self.assertEqual(
+                [e.name for e in index_a.search_entities(["GraphRAG"], max_num=1)],
+                ["GraphRAG"],
+            )
+            self.assertEqual(
+                [e.name for e in index_b.search_entities(["GraphRAG"], max_num=1)],
+                ["LightRAG"],
+            )
+            _, relations, related, *_ = index_b.search_eris(["LightRAG"], max_num=1)
+            self.assertEqual([e.name for e in related], ["BERT"])
+            self.assertEqual([r.target for r in relations], ["BERT"])
+
+    def test_eviction(self):
+        with tempfile.TemporaryDirectory() as folder:
+            a = self._database(os.path.join(folder, "a"), ["GraphRAG", "LLM"])
+            b = self._database(os.path.join(folder, "b"), ["LightRAG", "BERT"])
+            c = self._database(os.path.join(folder, "c"), ["RAG", "T5"])
+
+            registry = SearchIndexRegistry(max_indexes=2)
+            registry.get(a), registry.get(b), registry.get(a), registry.get(c)
+            self.assertEqual(
+                [a in registry, b in registry, c in registry], [True, False, True]
+            )
+
+            # Over the memory budget, only the last used index stays
+            registry = SearchIndexRegistry(max_indexes=3, max_bytes=1)
+            registry.get(a), registry.get(b)
+            self.assertEqual([a in registry, b in registry], [False, True])
+
+            registry.invalidate(b)
+            self.assertEqual(len(registry), 0)
+
+    def test_refresh(self):
+        with tempfile.TemporaryDirectory() as folder:
+            storage = MemoryStorage(folder="")
+            storage.folder = os.path.join(folder, "a")
+            storage.add_entities(
+                [Entity(name=n, label="concept", description="d") for n in ("GraphRAG", "LLM")]
+            )
+            storage.save_to_folder()
+            registry = SearchIndexRegistry(refresh_interval=0)
+            old = registry.get(storage.folder)
+
+            storage.add_entities([Entity(name="LightRAG", label="concept", description="d")])
+            storage.save_to_folder()
+            # The new version is noticed on use and loaded in the background
+            self.assertIs(registry.get(storage.folder), old)
+            registry.refresh(storage.folder, wait=True)
+            new = registry.get(storage.folder)
+            self.assertIsNot(new, old)
+            self.assertEqual(new.stamp, storage_stamp(storage.folder))
+            self.assertEqual(
+                [e.name for e in new.search_entities(["LightRAG"], max_num=1)],
+                ["LightRAG"],
+            )
+            # Queries that got the old index still search the old version
+            self.assertEqual(len(old.entities), 2)
+
+
+class SearchBackendTest(FixtureDatabaseTest):
+    def test_memory_backend(self):
+        keywords = ["Graph RAG", "architecture"]
+        results = asyncio.run(MemoryBackend().search_eris(keywords, max_num=3))
+        self.assertEqual(results[0][0].name, "Graph RAG")
+        self.assertEqual(len(results[3]), 1)
+        self.assertEqual(
+            [[x.model_dump() for x in xs] for xs in results],
+            [[x.model_dump() for x in xs] for xs in search_eris(keywords, max_num=3)],
+        )
+        # The database is searched by its folder
+        results = asyncio.run(
+            MemoryBackend().search_eris(["LightRAG"], max_num=1, database=self.database)
+        )
+        self.assertEqual([e.name for e in results[0]], ["LightRAG"])
+
+    def _neo4j(self, records: dict[str, list[list[dict]]]) -> MagicMock:
+        """Mock the Neo4j driver, the queries starting with a key return its records in turn"""
+
+        async def execute_query(statement: str, **kwargs):
+            for start, results in records.items():
+                if statement.lstrip().startswith(start):
+                    return results.pop(0), None, None
+            return [], None, None
+
+        driver = MagicMock()
+        driver.execute_query = AsyncMock(side_effect=execute_query)
+        neo4j = MagicMock()
+        neo4j.AsyncGraphDatabase.driver.return_value = driver
+        modules = patch.dict(sys.modules, {"neo4j": neo4j})
+        modules.start()
+        self.addCleanup(modules.stop)
+        return driver
+
+    def _queries(self, driver: MagicMock, start: str) -> list[tuple[str, dict]]:
+        return [
+            (c.args[0], c.kwargs)
+            for c in driver.execute_query.call_args_list
+            if c.args[0].lstrip().startswith(start)
+        ]
+
+    def test_neo4j_backend(self):
+        backend = Neo4jBackend("neo4j://localhost:7687", None, None)
+        node = {"id": 1, "name": "Graph RAG", "label": "method", "description": "d"}
+        row = {
+            "source": "Graph RAG",
+            "target": "LLM",
+            "props": {"id": 2, "label": "uses", "database": "RAG"},
+        }
+        record = {
+            "seeds": [node],
+            "entities": [node, {**node, "id": 3, "name": "LLM"}],
+            "relations": [row],
+            "images": [],
+            "image_entities": [],
+            "image_relations": [],
+        }
+        driver = self._neo4j({"CALL {": [[record]]})
+        entities, relations, related, *_ = asyncio.run(
+            backend.search_eris(["Graph RAG"], max_num=3, database="databases/RAG")
+        )
+        self.assertEqual([e.name for e in entities], ["Graph RAG"])
+        self.assertEqual([e.name for e in related], ["LLM"])
+        self.assertEqual((relations[0].source, relations[0].id), ("Graph RAG", 2))
+        # The search is scoped to the database
+        [(query, kwargs)] = self._queries(driver, "CALL {")
+        self.assertIn("WHERE node.database = $database", query)
+        self.assertEqual(kwargs["database"], "RAG")
+        self.assertEqual(kwargs["query"], "(Graph RAG)")
+
+    def test_neo4j_image_index_refresh(self):
+        from PIL import Image as PILImage
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "figure.png")
+            PILImage.effect_noise((64, 64), 64).save(path)
+            node = {
+                "path": "figure.png",
+                "caption": "c",
+                "description": "d",
+                "phash": format(dhash(path), "016x"),
+            }
+            backend = Neo4jBackend(
+                "neo4j://localhost:7687", None, None, image_refresh_interval=0
+            )
+            load = "MATCH (i:Image {database: $database}) WHERE"
+            driver = self._neo4j({load: [[], [{"i": node}]]})
+            # The image synced after the first search is found by the second one
+            self.assertIsNone(asyncio.run(backend.search_image_by_example(path))[0])
+            image, entities, _ = asyncio.run(
+                backend.search_image_by_example(path, database="databases/RAG")
+            )
+            self.assertEqual(image.path, "figure.png")
+            self.assertEqual(entities, [])
+            [(_, kwargs)] = self._queries(driver, "MATCH (i:Image {database: $database, path")
+            self.assertEqual((kwargs["database"], kwargs["path"]), ("RAG", "figure.png"))
+
+            # Kept for the interval
+            backend.image_refresh_interval = 60
+            image, *_ = asyncio.run(backend.search_image_by_example(path, database="RAG"))
+            self.assertEqual(image.path, "figure.png")
+            loads = self._queries(driver, load)
+            self.assertEqual([kwargs["database"] for _, kwargs in loads], ["RAG", "RAG"])
+
+    def test_lucene_query(self):
+        self.assertEqual(
+            _lucene_query(["Graph RAG", "C++ (v2)", " "]),
+            "(Graph RAG) OR (C\\+\\+ \\(v2\\))",
+        )
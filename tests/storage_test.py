@@ -0,0 +1,781 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+from src.mmkg_rag.storage import (
+    GraphSnapshot,
+    ImageHashIndex,
+    MemoryStorage,
+    Neo4jSync,
+    SnapshotReader,
+    export_jsonl,
+    import_jsonl,
+)
+from src.mmkg_rag.storage.snapshot import dump_item
+from src.mmkg_rag.storage.graph_snapshot import (
+    GRAPH_FILE,
+    IMAGE_RELATION,
+    storage_stamp,
+)
+from src.mmkg_rag.storage.postings import Postings
+from src.mmkg_rag.storage.versions import (
+    list_versions,
+    read_current,
+    version_folder,
+    write_current,
+)
+from src.mmkg_rag.types import Entity, Image, Relation
+
+
+def _sample_storage() -> MemoryStorage:
+    storage = MemoryStorage(folder="")
+    storage.add_entities(
+        [
+            Entity(name="GraphRAG", label="method", description="desc1"),
+            Entity(name="Graph RAG", label="method", description="desc2"),
+            Entity(name="LLM", label="model", description="desc3"),
+        ]
+    )
+    storage.add_relations(
+        [
+            Relation(source="GraphRAG", target="LLM", label="uses"),
+            Relation(source="LLM", target="Graph RAG", label="powers"),
+        ]
+    )
+    return storage
+
+
+class TestMemoryStorageIds(unittest.TestCase):
+    def test_ids_assigned(self):
+        storage = _sample_storage()
+        ids = [e.id for e in storage.entities]
+        self.assertEqual(ids, [1, 2, 3])
+        self.assertEqual(storage.entity_id("LLM"), 3)
+        self.assertEqual(storage.relations[0].source_id, 1)
+        self.assertEqual(storage.relations[0].target_id, 3)
+
+    def test_entity_relations_both_directions(self):
+        storage = _sample_storage()
+        relations = storage.get_entity_relations("LLM")
+        self.assertEqual(len(relations), 2)
+
+    def test_deduplicate_redirects(self):
+        storage = _sample_storage()
+        merged = Entity(name="Graph RAG", label="method", description="merged")
+        storage.deduplicate(storage.entities[:2], merged)
+
+        self.assertEqual(len(storage.entities), 2)
+        self.assertEqual(storage.entity_id("GraphRAG"), merged.id)
+        self.assertEqual(storage.get_entity(1), merged)
+        self.assertEqual(storage.relations[0].source, "Graph RAG")
+        self.assertEqual(storage.relations[0].source_id, merged.id)
+        self.assertEqual(storage.relations[1].target_id, merged.id)
+        self.assertEqual(len(storage.get_entity_relations("Graph RAG")), 2)
+
+    def test_chained_redirects(self):
+        storage = _sample_storage()
+        first = Entity(name="GraphRAG", label="method", description="merged")
+        storage.deduplicate(storage.entities[:2], first)
+        second = Entity(name="Graph-RAG", label="method", description="merged2")
+        storage.deduplicate([first], second)
+
+        self.assertEqual(storage.resolve_id(1), second.id)
+        self.assertEqual(storage.relations[1].target, "Graph-RAG")
+
+    def test_relation_ids(self):
+        storage = MemoryStorage(folder="")
+        storage.add_entities([Entity(name=n, label="m", description="d") for n in ("A", "B")])
+        relations = [
+            Relation(source="A", target="B", label="r"),
+            Relation(source="B", target="A", label="r"),
+        ]
+        storage.add_relations(relations)
+        self.assertEqual([r.id for r in relations], [1, 2])
+        # A taken id is replaced
+        again = Relation(source="A", target="B", label="r", id=1)
+        storage.add_relations([again])
+        self.assertEqual(again.id, 3)
+        self.assertEqual([r.id for r in storage.relations], [1, 2, 3])
+
+
+class TestMemoryStorageGraph(unittest.TestCase):
+    def _storage(self) -> MemoryStorage:
+        storage = _sample_storage()
+        storage.add_entities(
+            [Entity(name="BERT", label="model", description="d", aliases=["Bidirectional Encoder"])]
+        )
+        storage.add_relations([Relation(source="GraphRAG", target="BERT", label="uses")])
+        storage.add_images([Image(path="a.png", caption="chart", description="d")])
+        storage.add_relations(
+            [Relation(source="LLM", target="a.png", label="shown_in")], images=True
+        )
+        return storage
+
+    def test_typed_queries(self):
+        storage = self._storage()
+        self.assertEqual(storage.get_entity_by_name("LLM").id, 3)
+        self.assertEqual(
+            [e.name for e in storage.get_entities_by_alias("Bidirectional Encoder")],
+            ["BERT"],
+        )
+        self.assertEqual(
+            [e.name for e in storage.get_entities_by_label("model")], ["LLM", "BERT"]
+        )
+        self.assertEqual(
+            [e.name for e in storage.get_neighbours("GraphRAG", label="model")],
+            ["LLM", "BERT"],
+        )
+        self.assertEqual(
+            [e.name for e in storage.get_neighbours("LLM", relation_label="powers")],
+            ["Graph RAG"],
+        )
+        self.assertEqual(
+            [r.label for r in storage.get_relations_between("GraphRAG", "LLM")],
+            ["uses"],
+        )
+        self.assertEqual(storage.get_relations_between("LLM", "GraphRAG"), [])
+        self.assertEqual(storage.get_image("a.png").caption, "chart")
+        self.assertEqual(
+            [r.source for r in storage.get_image_relations("a.png")], ["LLM"]
+        )
+
+    def test_index_follows_merges(self):
+        storage = self._storage()
+        storage.graph
+        merged = Entity(name="Graph RAG", label="method", description="merged")
+        storage.deduplicate(storage.entities[:2], merged)
+
+        self.assertEqual(
+            {e.name for e in storage.get_neighbours("GraphRAG")}, {"LLM", "BERT"}
+        )
+        self.assertEqual(len(storage.get_relations_between("Graph RAG", "BERT")), 1)
+        self.assertEqual(len(storage.get_relations_between("LLM", "Graph RAG")), 1)
+        self.assertEqual(
+            [e.name for e in storage.get_entities_by_label("method")], ["Graph RAG"]
+        )
+
+    def test_remove(self):
+        storage = self._storage()
+        storage.remove_entities(["LLM"])
+        self.assertIsNone(storage.entity_id("LLM"))
+        self.assertEqual(len(storage.relations), 1)
+        self.assertEqual(storage.get_image_relations("a.png"), [])
+        self.assertEqual([e.name for e in storage.get_entities_by_label("model")], ["BERT"])
+
+        storage.remove_images(["a.png"])
+        self.assertIsNone(storage.get_image("a.png"))
+        self.assertEqual(storage.images, [])
+
+        storage.add_entities([Entity(name="LLM", label="model", description="new")])
+        self.assertEqual(storage.get_entity_by_name("LLM").description, "new")
+
+
+class TestMemoryStorageDocuments(unittest.TestCase):
+    def test_register_document(self):
+        storage = MemoryStorage(folder="")
+        self.assertEqual(storage.register_document("a.md", 3), [1, 2, 3])
+        self.assertEqual(storage.register_document("b.md", 2), [4, 5])
+        self.assertEqual(storage.documents, {"a.md": [1, 2, 3], "b.md": [4, 5]})
+
+    def test_chunk_ids_are_not_reused(self):
+        with tempfile.TemporaryDirectory() as folder:
+            storage = MemoryStorage(folder="")
+            storage.register_document("a.md", 2)
+            storage.register_document("b.md", 1)
+            storage.remove_document("b.md")
+            storage.save_to_folder(folder)
+
+            loaded = MemoryStorage(folder=folder)
+            self.assertEqual(loaded.register_document("c.md", 1), [4])
+
+    def test_remove_document(self):
+        storage = MemoryStorage(folder="")
+        a = storage.register_document("a.md", 2)
+        b = storage.register_document("b.md", 1)
+        storage.add_entities(
+            [
+                Entity(name="GraphRAG", label="method", description="d", chunks=a + b),
+                Entity(name="LLM", label="model", description="d", chunks=[a[0]]),
+                Entity(name="BERT", label="model", description="d", chunks=b),
+                Entity(name="Old", label="model", description="d"),
+            ]
+        )
+        storage.add_relations(
+            [
+                Relation(source="GraphRAG", target="LLM", label="uses", chunks=[a[0]]),
+                Relation(source="GraphRAG", target="BERT", label="uses", chunks=a + b),
+                Relation(source="Old", target="GraphRAG", label="uses"),
+            ]
+        )
+        storage.add_images(
+            [
+                Image(path="a.png", caption="c", description="d"),
+                Image(path="b.png", caption="c", description="d"),
+                # Without relations, removed by their provenance
+                Image(path="c.png", caption="c", description="d", chunks=[a[1]]),
+                Image(path="d.png", caption="c", description="d", chunks=a + b),
+            ]
+        )
+        storage.add_relations(
+            [
+                Relation(source="LLM", target="a.png", label="#image"),
+                Relation(source="GraphRAG", target="b.png", label="#image", chunks=[a[1]]),
+                Relation(source="BERT", target="b.png", label="#image", chunks=b),
+            ],
+            images=True,
+        )
+
+        removed = storage.remove_document("a.md")
+        self.assertEqual(
+            removed, {"entities": 1, "relations": 1, "images": 2, "image_relations": 2}
+        )
+        self.assertEqual([e.name for e in storage.entities], ["GraphRAG", "BERT", "Old"])
+        self.assertEqual(storage.get_entity_by_name("GraphRAG").chunks, b)
+        self.assertEqual([r.target for r in storage.relations], ["BERT", "GraphRAG"])
+        self.assertEqual(storage.relations[0].chunks, b)
+        self.assertEqual([i.path for i in storage.images], ["b.png", "d.png"])
+        self.assertEqual(storage.images[1].chunks, b)
+        self.assertEqual([r.source for r in storage.get_image_relations("b.png")], ["BERT"])
+        self.assertIsNone(storage.entity_id("LLM"))
+        self.assertEqual(storage.documents, {"b.md": b})
+        self.assertEqual(storage.remove_document("a.md")["entities"], 0)
+
+
+def _posting_lists(postings: Postings) -> dict:
+    """The (item, count) pairs of every key in use, and the totals of the items"""
+    keys = postings.keys.tolist()
+    lists = {
+        keys[k]: list(zip(postings.items[s:e].tolist(), postings.counts[s:e].tolist()))
+        for k, (s, e) in enumerate(zip(postings.offsets[:-1], postings.offsets[1:]))
+        if e > s
+    }
+    return {"keys": lists, "totals": postings.totals.tolist()}
+
+
+def _snapshot_path(folder: str) -> str:
+    """The snapshot of the published version of a folder"""
+    version = read_current(folder)["version"]
+    return os.path.join(version_folder(folder, version), "storage.snapshot")
+
+
+class TestMemoryStorageSnapshot(unittest.TestCase):
+    def test_round_trip(self):
+        with tempfile.TemporaryDirectory() as folder:
+            storage = _sample_storage()
+            storage.folder = folder
+            storage.deduplicate(
+                storage.entities[:2],
+                Entity(name="Graph RAG", label="method", description="merged"),
+            )
+            storage.add_images([Image(path="a.png", caption="c", description="d")])
+            storage.register_document("a.md", 2)
+            storage.save_to_folder()
+            self.assertFalse(os.path.exists(os.path.join(folder, "eris.txt")))
+
+            loaded = MemoryStorage(folder)
+            self.assertEqual(loaded.entities, storage.entities)
+            self.assertEqual(loaded.relations, storage.relations)
+            self.assertEqual(loaded.images, storage.images)
+            self.assertEqual(loaded.documents, {"a.md": [1, 2]})
+            self.assertEqual(loaded.resolve_id(1), storage.resolve_id(1))
+            self.assertEqual(loaded.entity_id("GraphRAG"), storage.entity_id("GraphRAG"))
+
+    def test_lazy_sections(self):
+        with tempfile.TemporaryDirectory() as folder:
+            storage = _sample_storage()
+            storage.save_to_folder(folder)
+
+            loaded = MemoryStorage(folder)
+            self.assertEqual(len(loaded.images), 0)
+            self.assertIn("entities", loaded._pending)
+            self.assertNotIn("images", loaded._pending)
+
+            # Untouched sections are copied to a new snapshot
+            loaded.add_images([Image(path="a.png", caption="c", description="d")])
+            loaded.save_to_folder(os.path.join(folder, "copy"), export_eris=True)
+            self.assertTrue(os.path.exists(os.path.join(folder, "copy", "eris.txt")))
+            reader = SnapshotReader(_snapshot_path(os.path.join(folder, "copy")))
+            self.assertEqual(reader.sections["entities"]["count"], 3)
+            self.assertEqual(reader.sections["images"]["count"], 1)
+            self.assertEqual(len(MemoryStorage(os.path.join(folder, "copy")).relations), 2)
+            reader.close()
+
+    def test_operation_log(self):
+        with tempfile.TemporaryDirectory() as folder:
+            storage = _sample_storage()
+            storage.folder = folder
+            storage.save_to_folder()
+            log_path = os.path.join(os.path.dirname(_snapshot_path(folder)), "storage.oplog")
+
+            storage.add_entities([Entity(name="BERT", label="model", description="d")])
+            storage.entities = [e for e in storage.entities if e.name != "LLM"]
+            storage.relations[0].description = "updated"
+            storage.mark_changed([storage.relations[0]])
+            storage.save_to_folder()
+            # Only the changes are logged
+            with open(log_path, "rb") as f:
+                record = f.read()
+            self.assertIn(b"BERT", record)
+            self.assertNotIn(b"GraphRAG", record.split(b'"relations"')[0])
+
+            storage.deduplicate(
+                storage.entities[:2],
+                Entity(name="Graph RAG", label="method", description="merged"),
+            )
+            storage.save_to_folder()
+            # A crash may leave a truncated record
+            with open(log_path, "ab") as f:
+                f.write(b'{"seq":3,"entities":{"del')
+
+            loaded = MemoryStorage(folder)
+            self.assertEqual(
+                [(e.id, e.name) for e in loaded.entities],
+                [(e.id, e.name) for e in storage.entities],
+            )
+            self.assertEqual(loaded.relations[0].description, "updated")
+            self.assertEqual(loaded.relations[0].source, "Graph RAG")
+            self.assertEqual(loaded.entity_id("GraphRAG"), storage.entity_id("GraphRAG"))
+
+            loaded.compact(background=False)
+            reader = SnapshotReader(_snapshot_path(folder))
+            self.assertEqual(reader.log_seq, 2)
+            self.assertEqual(reader.sections["entities"]["count"], 2)
+            reader.close()
+            self.assertEqual(read_current(folder), {"version": 2, "log_seq": 2})
+            self.assertEqual(len(MemoryStorage(folder).entities), 2)
+
+            # Saves of the writer go on in the compacted version
+            storage.add_entities([Entity(name="T5", label="model", description="d")])
+            storage.save_to_folder()
+            self.assertEqual(read_current(folder)["log_seq"], 3)
+            self.assertEqual(len(MemoryStorage(folder).entities), 3)
+
+    def test_only_changed_items_are_written(self):
+        with tempfile.TemporaryDirectory() as folder:
+            storage = _sample_storage()
+            storage.folder = folder
+            storage.save_to_folder()
+
+            relation = storage.relations[0]
+            relation.description = "updated"
+            # Changes in place are only saved once marked
+            storage.save_to_folder()
+            self.assertEqual(read_current(folder)["log_seq"], 0)
+            storage.mark_changed([relation])
+            storage.add_entities([Entity(name="BERT", label="model", description="d")])
+            with patch("src.mmkg_rag.storage.index.dump_item", wraps=dump_item) as dump:
+                storage.save_to_folder()
+                self.assertEqual(dump.call_count, 2)
+
+            loaded = MemoryStorage(folder)
+            self.assertEqual(loaded.relations[0].description, "updated")
+            self.assertEqual(len(loaded.entities), 4)
+
+    def test_versions(self):
+        with tempfile.TemporaryDirectory() as folder:
+            storage = _sample_storage()
+            storage.folder = folder
+            storage.save_to_folder()
+            reader = MemoryStorage(folder)
+
+            # Unpublished log records are not read
+            storage.add_entities([Entity(name="BERT", label="model", description="d")])
+            storage.save_to_folder()
+            write_current(folder, 1, 0)
+            self.assertEqual(len(MemoryStorage(folder).entities), 3)
+            write_current(folder, 1, 1)
+
+            # A reader keeps its version while new ones are published
+            storage.clear()
+            storage.add_entities([Entity(name="T5", label="model", description="d")])
+            storage.save_to_folder()
+            storage.add_entities([Entity(name="GPT", label="model", description="d")])
+            storage._rewrite = True
+            storage.save_to_folder()
+            self.assertEqual(read_current(folder), {"version": 3, "log_seq": 1})
+            self.assertEqual([e.name for e in MemoryStorage(folder).entities], ["T5", "GPT"])
+            self.assertEqual(len(reader.entities), 3)
+            self.assertEqual(len(reader.relations), 2)
+
+            # The current and the previous versions are kept
+            self.assertEqual(list_versions(folder), [2, 3])
+
+    def test_legacy_pickles(self):
+        # Pickles written by the storage before entities and relations had ids
+        legacy = Path(__file__).parent / "assets" / "legacy_storage"
+        with tempfile.TemporaryDirectory() as folder:
+            shutil.copytree(legacy, folder, dirs_exist_ok=True)
+            loaded = MemoryStorage(folder)
+            self.assertEqual([e.id for e in loaded.entities], [1, 2, 3])
+            self.assertEqual([r.id for r in loaded.relations], [1, 2])
+            self.assertEqual([r.id for r in loaded.image_relations], [3])
+            self.assertEqual(loaded.relations[1].source_id, 3)
+            self.assertEqual(len(loaded.get_entity_relations("LLM")), 2)
+            self.assertIsNone(loaded.images[0].chunks)
+
+            # Saved as a snapshot, the pickles are not read again
+            loaded.save_to_folder()
+            again = MemoryStorage(folder)
+            self.assertEqual([r.id for r in again.relations], [1, 2])
+            self.assertEqual(again.image_relations[0].source_id, 1)
+
+
+class TestJsonlExport(unittest.TestCase):
+    def _storage(self, folder: str) -> MemoryStorage:
+        storage = _sample_storage()
+        storage.folder = folder
+        storage.deduplicate(
+            storage.entities[:2],
+            Entity(name="Graph RAG", label="method", description="merged"),
+        )
+        storage.add_images([Image(path="a.png", caption="c", description="d")])
+        storage.add_relations(
+            [Relation(source="LLM", target="a.png", label="#image", chunks=[1])],
+            images=True,
+        )
+        storage.register_document("a.md", 2)
+        storage.save_to_folder()
+        return storage
+
+    def _assert_same(self, loaded: MemoryStorage, storage: MemoryStorage):
+        for section in ("entities", "relations", "images", "image_relations"):
+            self.assertEqual(
+                [dump_item(i) for i in getattr(loaded, section)],
+                [dump_item(i) for i in getattr(storage, section)],
+            )
+        self.assertEqual(loaded.documents, storage.documents)
+        self.assertEqual(loaded.entity_id("GraphRAG"), storage.entity_id("GraphRAG"))
+        self.assertEqual(loaded.resolve_id(1), storage.resolve_id(1))
+
+    def test_round_trip(self):
+        with tempfile.TemporaryDirectory() as folder:
+            storage = self._storage(os.path.join(folder, "db"))
+            # Sections that were not loaded are streamed from the snapshot
+            lazy = MemoryStorage(storage.folder)
+            manifest = export_jsonl(lazy, os.path.join(folder, "export"))
+            self.assertIn("entities", lazy._pending)
+            self.assertEqual(manifest["counts"]["entities"], 2)
+            self.assertTrue(
+                os.path.exists(os.path.join(folder, "export", "relations.jsonl.gz"))
+            )
+
+            loaded = import_jsonl(
+                os.path.join(folder, "export"), os.path.join(folder, "copy")
+            )
+            self._assert_same(loaded, storage)
+            # The copy goes on like a saved storage
+            loaded.add_entities([Entity(name="BERT", label="model", description="d")])
+            loaded.save_to_folder()
+            self.assertEqual(len(MemoryStorage(loaded.folder).entities), 3)
+
+            with self.assertRaises(FileExistsError):
+                import_jsonl(os.path.join(folder, "export"), loaded.folder)
+
+    def test_uncompressed(self):
+        with tempfile.TemporaryDirectory() as folder:
+            storage = self._storage(os.path.join(folder, "db"))
+            export_jsonl(storage, os.path.join(folder, "export"), compress=False)
+            with open(os.path.join(folder, "export", "entities.jsonl"), "rb") as f:
+                self.assertEqual(len(f.read().splitlines()), 2)
+            loaded = import_jsonl(
+                os.path.join(folder, "export"), os.path.join(folder, "copy"), workers=1
+            )
+            self._assert_same(loaded, storage)
+
+            with open(os.path.join(folder, "export", "images.jsonl"), "ab") as f:
+                f.write(b'{"path":"b.png"}\n')
+            with self.assertRaisesRegex(ValueError, "line 2"):
+                import_jsonl(
+                    os.path.join(folder, "export"), os.path.join(folder, "bad"), workers=1
+                )
+
+
+class TestRecords(unittest.TestCase):
+    def test_models_round_trip(self):
+        storage = _sample_storage()
+        storage.add_entities(
+            [Entity(name="BERT", label="model", description="d", aliases=["Bert"], chunks=[1])]
+        )
+        storage.add_relations(
+            [Relation(source="LLM", target="a.png", label="shown_in", references=["r"])],
+            images=True,
+        )
+        entities, relations, image_relations = storage.records()
+
+        for records, models in (
+            (entities, storage.entities),
+            (relations, storage.relations),
+            (image_relations, storage.image_relations),
+        ):
+            self.assertEqual(
+                [m.model_dump() for m in records], [m.model_dump() for m in models]
+            )
+        self.assertEqual(entities.row("BERT"), 3)
+        self.assertEqual(entities.search_texts(3), ["BERT", "Bert"])
+        self.assertEqual(relations.source(1), "LLM")
+        # Names are interned once for the entities and the relation endpoints
+        self.assertIs(entities.names, relations.names)
+        self.assertEqual(len(entities.names), 6)
+
+    def test_from_snapshot_lines(self):
+        with tempfile.TemporaryDirectory() as folder:
+            storage = _sample_storage()
+            storage.save_to_folder(folder)
+
+            loaded = MemoryStorage(folder)
+            entities, relations, _ = loaded.records()
+            self.assertIn("entities", loaded._pending)
+            self.assertEqual(list(entities), storage.entities)
+            self.assertEqual(
+                [r.model_dump() for r in relations],
+                [r.model_dump() for r in storage.relations],
+            )
+
+
+class TestGraphSnapshot(unittest.TestCase):
+    def _storage(self, folder: str) -> MemoryStorage:
+        storage = _sample_storage()
+        storage.add_relations([Relation(source="LLM", target="GraphRAG", label="serves")])
+        storage.add_images([Image(path="a.png", caption="chart", description="d")])
+        storage.image_hashes["a.png"] = 0xFFFF_0000_FFFF_0000
+        storage.add_relations(
+            [Relation(source="LLM", target="a.png", label="shown_in")], images=True
+        )
+        storage.save_to_folder(folder)
+        return storage
+
+    def test_mapped_round_trip(self):
+        with tempfile.TemporaryDirectory() as folder:
+            storage = self._storage(folder)
+            graph = GraphSnapshot.load(folder)
+            self.assertTrue(os.path.exists(os.path.join(folder, GRAPH_FILE)))
+            # Views of the read-only memory map
+            self.assertFalse(graph.nodes.flags.writeable)
+
+            self.assertEqual(list(graph.entities), storage.entities)
+            self.assertEqual(
+                [r.model_dump() for r in graph.relations],
+                [r.model_dump() for r in storage.relations],
+            )
+            self.assertEqual(graph.images, storage.images)
+            self.assertEqual(graph.names.find("Graph RAG"), graph.node("Graph RAG"))
+            self.assertIsNone(graph.node("missing"))
+            self.assertEqual(
+                graph.image_index.find(0xFFFF_0000_FFFF_0001)[0][0].path, "a.png"
+            )
+
+    def test_adjacency(self):
+        with tempfile.TemporaryDirectory() as folder:
+            self._storage(folder)
+            graph = GraphSnapshot.load(folder)
+            llm, image = graph.node("LLM"), graph.node("a.png")
+
+            # GraphRAG -> LLM and LLM -> GraphRAG are one undirected edge, the last one
+            edges = sorted(graph.edges(llm))
+            self.assertEqual(len(edges), 3)
+            self.assertIn((graph.node("GraphRAG"), 2, 1), edges)
+            self.assertIn((image, 0, IMAGE_RELATION), edges)
+            self.assertEqual(graph.image(image).path, "a.png")
+            self.assertIsNone(graph.entity_row(image))
+            self.assertEqual(graph.entity_row(llm), 2)
+            self.assertEqual(
+                graph.neighbourhood([image], 2),
+                {image, llm, graph.node("GraphRAG"), graph.node("Graph RAG")},
+            )
+
+    def test_rebuilt_when_stale(self):
+        with tempfile.TemporaryDirectory() as folder:
+            storage = self._storage(folder)
+            self.assertEqual(len(GraphSnapshot.load(folder).entities), 3)
+            storage.add_entities([Entity(name="BERT", label="model", description="d")])
+            storage.save_to_folder(folder)
+            self.assertEqual(len(GraphSnapshot.load(folder).entities), 4)
+
+    def test_not_written_without_storage(self):
+        with tempfile.TemporaryDirectory() as folder:
+            self.assertEqual(len(GraphSnapshot.load(folder).entities), 0)
+            self.assertEqual(os.listdir(folder), [])
+
+    def test_updated_with_saves(self):
+        with tempfile.TemporaryDirectory() as folder:
+            storage = _sample_storage()
+            storage.folder = folder
+            storage.add_images([Image(path="a.png", caption="chart", description="d")])
+            storage.save_to_folder()
+            graph = GraphSnapshot.load(folder)
+
+            storage.add_entities(
+                [Entity(name="BERT", label="model", description="d", aliases=["LM"])]
+            )
+            storage.deduplicate(
+                [storage.get_entity_by_name("GraphRAG"), storage.get_entity_by_name("LLM")],
+                Entity(name="LLM", label="model", description="merged"),
+            )
+            storage.save_to_folder()
+            storage.remove_images(["a.png"])
+            storage.add_images([Image(path="b.png", caption="table", description="d")])
+            storage.add_relations(
+                [Relation(source="BERT", target="b.png", label="shown_in")], images=True
+            )
+            storage.save_to_folder()
+
+            updated = graph.update(folder, storage_stamp(folder))
+            self.assertIsNotNone(updated)
+            rebuilt = GraphSnapshot.from_storage(MemoryStorage(folder))
+            self.assertEqual(list(updated.entities), list(rebuilt.entities))
+            for relations, expected in (
+                (updated.relations, rebuilt.relations),
+                (updated.image_relations, rebuilt.image_relations),
+            ):
+                self.assertEqual(
+                    [r.model_dump() for r in relations], [r.model_dump() for r in expected]
+                )
+            self.assertEqual(updated.images, rebuilt.images)
+            # The searched texts are updated by item
+            for prefix in ("entities", "images"):
+                for name in ("exact", "words"):
+                    self.assertEqual(
+                        _posting_lists(updated.postings(f"{prefix}.search.{name}")),
+                        _posting_lists(rebuilt.postings(f"{prefix}.search.{name}")),
+                    )
+            [(row, _)] = _posting_lists(updated.postings("entities.search.exact"))[
+                "keys"
+            ]["lm"]
+            self.assertEqual(updated.entities.name(row), "BERT")
+            # Nodes are coded as in a rebuild
+            for name in ("BERT", "LM", "LLM", "b.png", "a.png"):
+                code = rebuilt.node(name)
+                self.assertEqual(updated.node(name), code)
+                if code is not None:
+                    self.assertEqual(updated.edges(code), rebuilt.edges(code))
+
+            # A compaction publishes a new version, the log does not lead to it
+            storage.compact(background=False)
+            self.assertIsNone(updated.update(folder, storage_stamp(folder)))
+            self.assertEqual(len(GraphSnapshot.load(folder, updated).entities), 3)
+
+
+class TestNeo4jSync(unittest.TestCase):
+    def test_changes(self):
+        with tempfile.TemporaryDirectory() as folder:
+            sync = Neo4jSync(
+                "neo4j://localhost:7687",
+                None,
+                None,
+                state_path=os.path.join(folder, "neo4j_sync.json"),
+            )
+            storage = _sample_storage()
+            changes, state = sync.changes(storage)
+            self.assertEqual(len(changes["entities"]["put"]), 3)
+            self.assertEqual(len(changes["relations"]["put"]), 2)
+            # Written relations are deleted first, so resending them does not duplicate them
+            self.assertEqual(changes["relations"]["delete"], [1, 2])
+            sync._save_state(state)
+
+            storage.deduplicate(
+                storage.entities[:2],
+                Entity(name="Graph RAG", label="method", description="merged"),
+            )
+            changes, _ = sync.changes(storage)
+            merged = storage.get_entity_by_name("Graph RAG")
+            self.assertEqual([e["id"] for e in changes["entities"]["put"]], [merged.id])
+            self.assertEqual(changes["entities"]["delete"], [1, 2])
+            # The relations of the merged entities are recreated
+            self.assertEqual(changes["relations"]["delete"], [1, 2])
+            self.assertEqual(changes["relations"]["put"][0]["source_id"], merged.id)
+            self.assertEqual(len(sync.changes(storage, full=True)[0]["entities"]["put"]), 2)
+
+    def test_unwritten_relations_are_sent_again(self):
+        with tempfile.TemporaryDirectory() as folder:
+            sync = Neo4jSync(
+                "neo4j://localhost:7687",
+                None,
+                None,
+                state_path=os.path.join(folder, "neo4j_sync.json"),
+                database="RAG",
+            )
+            # Only the first relation finds its endpoints
+            tx = MagicMock()
+            tx.run.return_value.single.return_value = {"written": [1]}
+            session = MagicMock()
+            session.execute_write.side_effect = lambda work: work(tx)
+            neo4j = MagicMock()
+            driver = neo4j.GraphDatabase.driver.return_value.__enter__.return_value
+            driver.session.return_value.__enter__.return_value = session
+            storage = _sample_storage()
+            with patch.dict(sys.modules, {"neo4j": neo4j}):
+                sync.sync(storage)
+
+            calls = tx.run.call_args_list
+            self.assertIn("MERGE (n:Entity {database: $database, id: row.id})", calls[-2].args[0])
+            # Every write is scoped to the database of the storage
+            self.assertEqual({c.kwargs["database"] for c in calls}, {"RAG"})
+            self.assertEqual(list(sync._load_state()["relations"]), ["1"])
+            changes, _ = sync.changes(storage)
+            self.assertEqual([r["props"]["id"] for r in changes["relations"]["put"]], [2])
+
+    def test_syncs_wait_for_the_previous_send(self):
+        with tempfile.TemporaryDirectory() as folder:
+            sync = Neo4jSync(
+                "neo4j://localhost:7687",
+                None,
+                None,
+                state_path=os.path.join(folder, "neo4j_sync.json"),
+            )
+            sent, release = [], threading.Event()
+
+            def write(changes, state, full):
+                release.wait(5)
+                sent.append(changes)
+                sync._save_state(state)
+
+            sync._write = write
+            storage = _sample_storage()
+            first = sync.sync(storage, background=True)
+            second = threading.Thread(target=sync.sync, args=(storage,))
+            second.start()
+            second.join(0.2)
+            self.assertTrue(second.is_alive())
+            release.set()
+            first.join()
+            second.join()
+            # The second sync diffed against the state saved by the first send
+            self.assertEqual(len(sent), 1)
+
+
+class TestImageHashIndex(unittest.TestCase):
+    def test_near_duplicates(self):
+        from PIL import Image as PILImage, ImageDraw
+
+        with tempfile.TemporaryDirectory() as folder:
+            figure = PILImage.new("RGB", (640, 480), "white")
+            draw = ImageDraw.Draw(figure)
+            draw.rectangle((40, 40, 300, 200), fill="black")
+            draw.ellipse((350, 220, 600, 440), fill="gray")
+            figure.save(Path(folder) / "figure.png")
+            # Screenshot-like copy: rescaled and re-encoded
+            figure.resize((320, 240)).save(Path(folder) / "copy.jpg", quality=70)
+            other = PILImage.new("RGB", (640, 480), "white")
+            ImageDraw.Draw(other).rectangle((300, 0, 640, 480), fill="black")
+            other.save(Path(folder) / "other.png")
+
+            index = ImageHashIndex()
+            original = Image(
+                path=str(Path(folder) / "figure.png"), caption="", description=""
+            )
+            index.add(original)
+            index.add(
+                Image(path=str(Path(folder) / "other.png"), caption="", description="")
+            )
+
+            self.assertEqual(index.find_image(str(Path(folder) / "copy.jpg")), original)
+            index.remove(original.path)
+            self.assertIsNone(index.find_image(str(Path(folder) / "copy.jpg")))
+
+
+if __name__ == "__main__":
+    unittest.main()